@@ -18,7 +18,17 @@ import time
 import streamlit as st
 import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from shared.connections import get_sql_login_engine, connect
+from shared.query_cache import cached_select, invalidate
+from shared.sql_writer import BatchWriter, row_hash_sql, quote_name, VERSION_COLUMN
+from shared.editor_payload import normalize_payload, payload_to_keys, row_versions
+from shared.editor_pager import KeysetPager
+from shared.write_behind import submit as submit_write, show_submission
+from shared.incremental import refresh_table, change_tracking_ddl, enable_change_tracking, forget_changed_tables
+from shared.metrics import timed
+from shared.query_executor import run_with_timeout, show_job, QUERY_TIMEOUT
+from shared.arrow_fetch import fetch_arrow
 
 # Connection string
 SERVER = st.secrets["server"]
@@ -30,8 +40,24 @@ DRIVER = st.secrets["driver"]
 DATABASE = '<name-of-database>' #e.g.'sandbox'
 TABLE_SCHEMA = '<name-of-schema>' #e.g. 'dbo'
 TABLE_NAME = '<name-of-table>' #e.g. 'product'
-QUERY = f'select id, name, category from {TABLE_SCHEMA}.{TABLE_NAME};'
+TABLE_COLUMNS = ['id', 'name', 'category']
+PAGE_SIZE = 100 # rows per page in the paginated editor
+REFRESH_MODE = 'change_tracking' # how the incremental refresh finds changed rows: 'change_tracking' or 'rowversion' (see shared/incremental.py)
+ROWVERSION_COLUMN = None # name of the rowversion column of the table, needed for REFRESH_MODE = 'rowversion' and used for optimistic concurrency when set
+COLUMN_TYPES = {'id': int, 'name': str, 'category': str} # python types the editor values are bound as
+WRITE_CHUNK_SIZE = 1000 # rows sent per round trip when submitting the editor changes
+COLUMN_SQL_TYPES = {'id': 'INT', 'name': 'VARCHAR(100)', 'category': 'VARCHAR(100)'} # column types of the staging table
+SET_BASED_THRESHOLD = 500 # changed rows from which the changes are applied with one MERGE from a staging table instead of per-row statements
+# Optimistic concurrency: every row is loaded with its version (the rowversion column, or else a hash of its columns) and
+# updates/deletes only apply to rows that still have it, rows someone else changed meanwhile are reported as conflicts
+HASH_COLUMNS = ['name', 'category'] # columns whose hash is the row version when the table has no rowversion column
+VERSION_SQL = quote_name(ROWVERSION_COLUMN) if ROWVERSION_COLUMN else row_hash_sql(HASH_COLUMNS, sql_types=COLUMN_SQL_TYPES)
+# the same version over the table aliased as t, as the incremental refresh reads it (see shared/incremental.py)
+REFRESH_VERSION_SQL = f"t.{quote_name(ROWVERSION_COLUMN)}" if ROWVERSION_COLUMN else row_hash_sql(HASH_COLUMNS, 't', sql_types=COLUMN_SQL_TYPES)
+QUERY = f'select id, name, category, {VERSION_SQL} as {VERSION_COLUMN} from {TABLE_SCHEMA}.{TABLE_NAME};'
+COMMAND_TIMEOUT = 300 # seconds the create/drop demo table commands and the submits may run before they are cancelled
 DROP_TABLE = f"DROP TABLE {TABLE_SCHEMA}.{TABLE_NAME}"
+ENABLE_CHANGE_TRACKING = change_tracking_ddl(TABLE_SCHEMA, TABLE_NAME, key_column='id')
 INIT_TABLE = f"""
 IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = '{TABLE_NAME}' AND schema_id = SCHEMA_ID('{TABLE_SCHEMA}'))
 CREATE TABLE {TABLE_SCHEMA}.{TABLE_NAME} (
@@ -47,8 +73,8 @@ VALUES
 ('Product C', 'Category 3');
 """
 
-# Uses st.cache_resource to only run once.
-#@st.cache_resource
+# The engine is shared by all pages and sessions through the process-wide registry in shared/connections.py,
+# so this only creates it (and logs in) once per server process.
 def init_connection():
     """
     Initializes a connection to the database using the provided credentials.
@@ -56,68 +82,65 @@ def init_connection():
     Returns:
         engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object representing the database connection.
     """
-    # Create connection engine
-    connection_string = f'mssql+pyodbc://{USERNAME}:{PASSWORD}@{SERVER}/{DATABASE}?driver={DRIVER}'
-    engine = create_engine(connection_string, echo=True)
-    return engine
+    return get_sql_login_engine(SERVER, DATABASE, USERNAME, PASSWORD, DRIVER, echo=True)
 
 # Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 1 sec (10 min=ttl=600).
-#@st.cache_data(ttl=1)
-def Select_query(query):
-    engine = init_connection()
-    with engine.connect() as connection:
-        result = pd.read_sql_query(query, connection.connection)
-        return result
-
+# Uses the shared query cache (shared/query_cache.py), results are kept for a few minutes and dropped as soon as this app writes to the table.
+@timed('select_query', page='DataEditorAzureSQTable')
+def Select_query_job(job, engine, query):
+    # runs as job on the shared query pool (shared/query_executor.py), so a slow query doesn't freeze the page, and
+    # registers the cursor with the job, so the query is cancelled on the server on timeout or when the user clicks Cancel
+    return cached_select(engine, query, lambda: fetch_arrow(engine, query, on_cursor=job.set_cursor).to_pandas())
+
+@timed('execute_sql_command', page='DataEditorAzureSQTable')
 def execute_sql_command(batch_command):
     """
     Executes a batch SQL command.
     """
     engine = init_connection()
-    with engine.begin() as conn:
-        conn.execute(text(batch_command))
+    def execute(job):
+        with connect(engine, begin=True) as conn:
+            cursor = conn.connection.cursor()
+            job.set_cursor(cursor)
+            try:
+                cursor.execute(batch_command)
+            finally:
+                cursor.close()
+    # runs on the shared query pool (shared/query_executor.py), a hanging statement is cancelled after COMMAND_TIMEOUT seconds
+    run_with_timeout(execute, timeout=COMMAND_TIMEOUT, description='Command')
+    # drop the cached results of the tables the command wrote to
+    invalidate(engine, batch_command)
+    # a dropped or recreated table is loaded in full by the next incremental refresh
+    forget_changed_tables(engine, batch_command)
+
+# The ALTER DATABASE of change tracking has to run outside of a transaction, see shared/incremental.py
+# Fails with a message when the table has no primary key, change tracking needs one
+def enable_table_change_tracking():
+    try:
+        enable_change_tracking(init_connection(), TABLE_SCHEMA, TABLE_NAME, key_column='id')
+    except ValueError as e:
+        st.session_state['change_tracking_error'] = str(e)
 
 # CRUD operations
-def insert_added_rows(added_rows):
+# The changes are queued on a BatchWriter and sent as parameterized statements in one transaction by submitPayload
+def insert_added_rows(writer, added_rows):
     if not added_rows:
         return
-    insert_commands = [f"INSERT INTO {TABLE_SCHEMA}.{TABLE_NAME} (name, category) VALUES ('{row['name']}', '{row['category']}')" for row in added_rows]
-    batch_command = "; ".join(insert_commands)
-    execute_sql_command(batch_command)
+    writer.insert({'name': row.get('name'), 'category': row.get('category')} for row in added_rows)
 
-def delete_deleted_rows(deleted_rows):
+# deleted_rows and edited_rows refer to the ID values from the database table rather than the index numbers from the DF (see submitPayload)
+# versions holds the version of every changed row when it was loaded, rows changed by someone else since are not written
+def delete_deleted_rows(writer, deleted_rows, versions):
     if not deleted_rows:
         return
-    delete_commands = []
-    
-    for row_index in deleted_rows:
-        # Get the ID value from database table rather than the index number from the DF.
-        productID = df["id"][row_index]
-
-        # Append each delete command to the list
-        delete_commands.append(f"DELETE FROM {TABLE_SCHEMA}.{TABLE_NAME} WHERE id = {productID}")
-    batch_command = "; ".join(delete_commands)
+    writer.delete(deleted_rows, versions)
 
-    execute_sql_command(batch_command)
-
-def update_edited_rows(edited_rows):
+def update_edited_rows(writer, edited_rows, versions):
     if not edited_rows:
         return
-    update_commands = []
-
-    for row_index, row in edited_rows.items():
-        # Get the ID value from database table rather than the index number from the DF.
-        productID = df["id"][row_index]
-        # Construct the SET part of the SQL command dynamically based on edited fields
-        set_parts = [f"{column} = '{value}'" for column, value in row.items()]
-        set_command = ", ".join(set_parts)
-
-        update_commands.append(f"UPDATE {TABLE_SCHEMA}.{TABLE_NAME} SET {set_command} WHERE id = {productID}")
-
-    batch_command = "; ".join(update_commands)
-    print(batch_command)
-    execute_sql_command(batch_command)
+    for productID, row in edited_rows.items():
+        # Only the edited fields are part of the SET clause
+        writer.update(productID, row, versions.get(productID))
 
 ################################################ Page code Starts here ################################################
 
@@ -138,63 +161,138 @@ with col2:
 
 st.write('## View table data from Azure SQL Database')
 st.write(f'Shows the current data in the {TABLE_SCHEMA}.{TABLE_NAME} table. Will show an error if table does not exists.')
-df = Select_query(QUERY)
-
-st.table(df)
-
-st.write('## Insert, update, and delete data in Azure SQL Database')
-st.markdown('''
-        :blue-background[Note] Product ID column has been disabled because it is automatic incremental identity column.
-        ''')
-with st.expander("Data Editor Features"):
+# Paginated mode only loads one page of the table at a time, for tables too large to load into every session
+paginated = st.toggle('Paginated editor (for large tables)', key='paginated')
+if paginated:
+    pager = KeysetPager('MyEditorPager', init_connection(), TABLE_SCHEMA, TABLE_NAME, TABLE_COLUMNS, key_column='id', page_size=PAGE_SIZE,
+                        version_sql=VERSION_SQL)
+    df = pager.page()
+    editor_key = pager.editor_key
+else:
+    # Incremental refresh keeps the last loaded table and only reads the rows changed since then on every rerun
+    incremental = st.toggle('Incremental refresh (only read changed rows)', key='incremental')
+    df = None
+    if incremental:
+        with st.expander("Change tracking setup"):
+            st.code(ENABLE_CHANGE_TRACKING, language='sql')
+            st.button('Enable change tracking', on_click=enable_table_change_tracking)
+            if 'change_tracking_error' in st.session_state:
+                st.error(st.session_state.pop('change_tracking_error'))
+        try:
+            # every row carries its version for optimistic concurrency, also the rows read by an incremental refresh
+            df, refresh_info = refresh_table(init_connection(), TABLE_SCHEMA, TABLE_NAME, TABLE_COLUMNS, key_column='id',
+                                             mode=REFRESH_MODE, rowversion_column=ROWVERSION_COLUMN, version_sql=REFRESH_VERSION_SQL)
+            if refresh_info['refresh'] == 'full':
+                st.caption(f"Loaded all {refresh_info['rows']} rows, the next reruns only read the changed rows.")
+            else:
+                st.caption(f"Refreshed incrementally: {refresh_info['upserted']} rows inserted/updated, {refresh_info['deleted']} deleted.")
+        except Exception as e:
+            st.error(f"Incremental refresh not possible, reading the whole table instead: {e}")
+    editor_key = "MyEditor"
+
+def submitPayload(df):
+    if paginated:
+        # changes of all visited pages, already keyed by ID
+        payloadJson = pager.collect()
+        versions = payloadJson.get('versions', {})
+    else:
+        print(st.session_state["MyEditor"])
+        # Get the ID values from database table rather than the index numbers from the DF.
+        # Only the cells that differ from the loaded rows are written, see normalize_payload in shared/editor_payload.py
+        payloadJson = payload_to_keys(normalize_payload(st.session_state["MyEditor"], df), df, key_column='id')
+        versions = row_versions(payloadJson, df, key_column='id')
+
+    writer = BatchWriter(init_connection(), TABLE_SCHEMA, TABLE_NAME, key_column='id', column_types=COLUMN_TYPES, chunk_size=WRITE_CHUNK_SIZE,
+                         sql_types=COLUMN_SQL_TYPES, set_based_threshold=SET_BASED_THRESHOLD, use_merge=True,
+                         rowversion_column=ROWVERSION_COLUMN, hash_columns=HASH_COLUMNS)
+    insert_added_rows(writer, payloadJson['added_rows'])
+    delete_deleted_rows(writer, payloadJson['deleted_rows'], versions)
+    update_edited_rows(writer, payloadJson['edited_rows'], versions)
+    if st.session_state.get('write_behind'):
+        # returns right away, the changes are committed together with those of other sessions (shared/write_behind.py)
+        st.session_state['write_submission'] = submit_write(writer)
+    else:
+        # runs on the shared query pool (shared/query_executor.py), a hanging commit is cancelled and rolled back after COMMAND_TIMEOUT seconds
+        st.session_state['write_stats'] = run_with_timeout(lambda job: writer.commit(on_cursor=job.set_cursor),
+                                                           timeout=COMMAND_TIMEOUT, description='Submit')
+
+# Shows the stats and conflicts of a committed submission
+def show_write_stats(stats):
+    st.caption(f"Inserted {stats['inserted']}, deleted {stats['deleted']} and updated {stats['updated']} rows in {stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/sec, {stats['mode']} mode)")
+    if stats['conflicts']:
+        # these rows were changed or deleted by someone else after they were loaded, the editor now shows their current values
+        st.warning(f"{len(stats['conflicts'])} rows were not saved because someone else changed them in the meantime. Check their current values and edit them again.")
+        st.dataframe(pd.DataFrame(stats['conflicts']).rename(columns={'key': 'id'}), hide_index=True)
+
+# Shows the loaded rows with the data editor and the submit button
+def show_editor(df):
+    st.table(df.drop(columns=VERSION_COLUMN, errors='ignore'))
+
+    st.write('## Insert, update, and delete data in Azure SQL Database')
     st.markdown('''
-        **Features:**
-        - Toolbar appears when hovering over the table
-        - Quick search for data
-        - Export data as a CSV file
-                
-        **Editing Data:**
-        - Double-click a cell to insert or edit data.
-        - Supports copy/paste from and to Excel.
-                
-        **Deleting a Row:**
-        - Select the row by clicking the leftmost column.
-        - Press the Delete key or click the Trash bin icon on toolbar.
-        ''')
-
-st.write(f'Data editor for table: {TABLE_SCHEMA}.{TABLE_NAME}')
-edited_df = st.data_editor(
-    df, 
-    column_config={
-        "id": "Product ID",
-        "name": "Product Name",
-        "name": "Product Category"
-    },
-    disabled=["id"],
-    hide_index=True,
-    key="MyEditor", 
-    num_rows="dynamic"
-)
-
-# st.write("Here's the value in Session State:")
-# st.write(st.session_state["MyEditor"]) # 👈 Show the value in Session State
-
-def submitPayload():
-    print(st.session_state["MyEditor"])
-    payloadJson = st.session_state["MyEditor"]
-
-    insert_added_rows(payloadJson['added_rows'])
-    delete_deleted_rows(payloadJson['deleted_rows'])
-    update_edited_rows(payloadJson['edited_rows'])
-
-submitted = st.button('Submit', on_click=submitPayload, type="primary")
-
-if submitted:
-    waittime = 5
-    with st.empty():
-        for seconds in range(waittime):
-            st.write(f"✔️ Payload submitted! ({waittime - seconds})")
-            time.sleep(1)
-        st.write("")
-
-
+            :blue-background[Note] Product ID column has been disabled because it is automatic incremental identity column.
+            ''')
+    with st.expander("Data Editor Features"):
+        st.markdown('''
+            **Features:**
+            - Toolbar appears when hovering over the table
+            - Quick search for data
+            - Export data as a CSV file
+                    
+            **Editing Data:**
+            - Double-click a cell to insert or edit data.
+            - Supports copy/paste from and to Excel.
+                    
+            **Deleting a Row:**
+            - Select the row by clicking the leftmost column.
+            - Press the Delete key or click the Trash bin icon on toolbar.
+            ''')
+
+    st.write(f'Data editor for table: {TABLE_SCHEMA}.{TABLE_NAME}')
+    edited_df = st.data_editor(
+        df, 
+        column_config={
+            "id": "Product ID",
+            "name": "Product Name",
+            "name": "Product Category",
+            VERSION_COLUMN: None
+        },
+        disabled=["id"],
+        hide_index=True,
+        key=editor_key, 
+        num_rows="dynamic"
+    )
+
+    if paginated:
+        col3, col4, col5 = st.columns([1, 1, 3])
+        with col3:
+            st.button('Previous page', on_click=pager.previous_page, disabled=pager.page_number == 1)
+        with col4:
+            st.button('Next page', on_click=pager.next_page, disabled=not pager.has_next)
+        with col5:
+            st.caption(f"Page {pager.page_number}, {pager.pending_count()} pending changes from other pages are submitted together with this page.")
+
+    # st.write("Here's the value in Session State:")
+    # st.write(st.session_state["MyEditor"]) # 👈 Show the value in Session State
+
+    # Write-behind queues the changes and commits them together with the submissions of other sessions, for busy tables
+    write_behind = st.toggle('Write-behind (group commit with other sessions)', key='write_behind')
+    st.button('Submit', on_click=submitPayload, args=[df], type="primary")
+
+    # the stats of a synchronous submit are shown once, by the first run that shows the editor again after it
+    stats = st.session_state.pop('write_stats', None)
+    if stats is not None and not write_behind:
+        show_write_stats(stats)
+        waittime = 5
+        with st.empty():
+            for seconds in range(waittime):
+                st.write(f"✔️ Payload submitted! ({waittime - seconds})")
+                time.sleep(1)
+            st.write("")
+
+if df is None:
+    # the whole table is read on the shared query pool, the page shows a placeholder (with a Cancel button) until it arrived
+    show_job('editor_select_job', QUERY, Select_query_job, show_editor, init_connection(), QUERY, timeout=QUERY_TIMEOUT)
+else:
+    show_editor(df)
+show_submission('write_submission', show_write_stats)
@@ -8,43 +8,35 @@
 import streamlit as st
 import pandas as pd
 from datetime import date, time
-from sqlalchemy import create_engine, text
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-import struct
-from itertools import chain, repeat
-import urllib
-import shutil
-import os
 import time
-from azure.storage.filedatalake import (
-    DataLakeServiceClient,
-    DataLakeDirectoryClient,
-    FileSystemClient
-)
-from sqlalchemy.exc import SQLAlchemyError  # Assuming SQLAlchemy for database operations
-from deltalake import DeltaTable
-from deltalake.writer import write_deltalake
-import numpy as np
-from concurrent.futures import ThreadPoolExecutor
+from shared.tokens import STORAGE_SCOPE, get_token_cache
+from shared.editor_payload import normalize_payload, payload_to_keys
+from shared.delta_writer import apply_changes
+from shared.delta_cache import load_table, forget_table, table_info
+from shared.staging_frame import added_rows_frame, apply_edits
+from shared.metrics import timer
+from shared.query_executor import run_with_timeout
 
 # Acquire a credential object
 def get_token():
+    # imported here so the page only loads azure.identity when logging in
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
     # credential = DefaultAzureCredential() #will automatically use the available credential
     credential = InteractiveBrowserCredential() #forces for interactive login as DefaultAzureCredential would use the available credential associated with the hosting of the app instead of the
     st.session_state['credential'] = credential
 
 def get_deltalake_conf():
-    if 'credential' not in st.session_state:
+    if st.session_state.get('credential') is None:
         get_token()
-    if 'datalake_conf' not in st.session_state:
-        # Construct storage_options dictionary with retry settings
-        datalake_conf = {
-            'token': st.session_state['credential'].get_token("https://storage.azure.com/.default").token,
-            'timeout': '100000s', 
-            'retries': '20', 
-            'retry_delay': '2',
-        }
-        st.session_state['datalake_conf'] = datalake_conf
+    # Construct storage_options dictionary with retry settings
+    # The token comes from the background refreshed token cache, so it is still valid after the first hour
+    datalake_conf = {
+        'token': get_token_cache(st.session_state['credential'], STORAGE_SCOPE).get(),
+        'timeout': '100000s', 
+        'retries': '20', 
+        'retry_delay': '2',
+    }
+    st.session_state['datalake_conf'] = datalake_conf
     return st.session_state['datalake_conf']
 
 # Initialize session state for credential and token if they don't exist
@@ -73,63 +65,67 @@ FULL_TABLE_PATH = f"{DATA_TABLES_PATH}/{DELTA_TABLE_NAME}"
 
 # Construct the URI for the Delta table
 TABLE_URI = f"abfss://{WORKSPACE_NAME}@{ACCOUNT_NAME}.dfs.fabric.microsoft.com/{FULL_TABLE_PATH}"
+DELTA_TIMEOUT = 300 # seconds reading or writing the delta table in onelake may take before the page reports it as timed out
+
+# The delta table I/O runs on the shared query pool (shared/query_executor.py), so a stalled OneLake request fails with an error
+# after DELTA_TIMEOUT seconds instead of blocking the page. Delta operations can't be cancelled, a timed out one finishes in its thread.
+def run_delta(fn, *args, description='Delta table I/O', **kwargs):
+    return run_with_timeout(lambda job: fn(*args, **kwargs), timeout=DELTA_TIMEOUT, description=description)
 
 # Create a sample delta table in Fabric Lakehouse
 def init_demo_table():
     df = pd.DataFrame(DELTA_TABLE_SAMPLE_DATA)#.astype(DELTA_TABLE_SCHEMA_DEF)
 
+    from deltalake.writer import write_deltalake
+
     DeltaLakeOptions = get_deltalake_conf()
     # Write the DataFrame to a new Delta table
-    write_deltalake(table_or_uri=TABLE_URI, 
-                    storage_options=DeltaLakeOptions,
-                    data=df,
-                    mode="overwrite"
-                    )
-
-#Inserts added rows to a staging dataframe that is loaded with fabric data    
-def add_rows_to_dataframe(df, added_rows):
-    for row in added_rows:
-        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-        # Check if 'id' column exists, if not, add it with NaN values
-        if 'id' not in df.columns:
-            df['id'] = np.nan
-
-        # Generate a random number for each row if 'id' is NaN
-        df['id'] = df['id'].apply(lambda x: np.random.randint(0, 100000) if pd.isna(x) else x)
-
-    return df.astype(DELTA_TABLE_SCHEMA_DEF)
+    with timer('delta_write', operation='overwrite') as timing:
+        run_delta(write_deltalake, table_or_uri=TABLE_URI, 
+                  storage_options=DeltaLakeOptions,
+                  data=df,
+                  mode="overwrite",
+                  description='Creating the delta table'
+                  )
+        timing.rows = len(df)
+    forget_table(TABLE_URI)
 
 #modify rows to a staging dataframe that is loaded with fabric data   
+#Edits are applied with one assignment per column instead of one per cell
 def modify_rows_in_dataframe(df, edited_rows):
-    for row_index, modifications in edited_rows.items():
-        for column, new_value in modifications.items():
-            df.at[int(row_index), column] = new_value
-    return df
+    return apply_edits(df, edited_rows).astype(DELTA_TABLE_SCHEMA_DEF)
 
-#deletes rows to a staging dataframe that is loaded with fabric data   
-def remove_rows_from_dataframe(df, deleted_rows):
-    df.drop(deleted_rows, inplace=True)
-    df.reset_index(drop=True, inplace=True)
-    return df
-
-# makes a staging dataframe of the delta table in fabric lakehouse combined with the changes from the data editor. Then syncs the changes to onelake.
+# syncs the changes from the data editor to the delta table in onelake.
+# Only the changed rows are written, with one merge on id that deletes the deleted ids, updates the edited rows and inserts the added rows,
+# so a one-cell edit rewrites one parquet file instead of the whole table (see shared/delta_writer.py).
 def submitPayload(df):
     # print(st.session_state["MyEditor"])
-    payloadJson = st.session_state["MyEditor"]
+    # Only the cells that differ from the loaded rows are written, see normalize_payload in shared/editor_payload.py
+    payloadJson = normalize_payload(st.session_state["MyEditor"], df)
+    changes = payload_to_keys(payloadJson, df, key_column='id')
 
-    #this is order essential to keep the row_index in sync for next operation in line
-    df = modify_rows_in_dataframe(df, payloadJson['edited_rows'])
-    df = remove_rows_from_dataframe(df, payloadJson['deleted_rows'])
-    df = add_rows_to_dataframe(df, payloadJson['added_rows'])
+    #the edited rows, the merge only sets the columns that were changed in each of them
+    edited = modify_rows_in_dataframe(df.copy(), payloadJson['edited_rows'])
+    edited = edited[edited['id'].isin(list(changes['edited_rows']))]
+    edited_columns = {key: list(row) for key, row in changes['edited_rows'].items()}
+    #the added rows get their ids in the write, after the highest id of the table version the merge reads (see apply_changes)
+    added = added_rows_frame(payloadJson['added_rows'], DELTA_TABLE_SCHEMA_DEF, key_column='id')
+
+    from deltalake.exceptions import CommitFailedError
 
-    # Write the DataFrame to a new Delta table
     DeltaLakeOptions = get_deltalake_conf()
-    # Write the DataFrame to a new Delta table
-    write_deltalake(table_or_uri=TABLE_URI, 
-                    storage_options=DeltaLakeOptions,
-                    data=df,
-                    mode="overwrite"
-                    )
+    try:
+        st.session_state['write_stats'] = run_delta(apply_changes, TABLE_URI, DeltaLakeOptions,
+                                                    deleted_keys=changes['deleted_rows'],
+                                                    edited_rows=edited,
+                                                    edited_columns=edited_columns,
+                                                    added_rows=added,
+                                                    key_column='id',
+                                                    description='Writing the changes')
+    except CommitFailedError:
+        #another session committed to the table while the merge ran, nothing was written
+        st.session_state.pop('write_stats', None)
+        st.session_state['write_conflict'] = True
 
 def clean_up():
     #delete folder in onelake
@@ -137,75 +133,23 @@ def clean_up():
         file_system_client = service_client.get_file_system_client(WORKSPACE_NAME)
         directory_client = file_system_client.create_directory(FULL_TABLE_PATH)
         directory_client.delete_directory()
+    forget_table(TABLE_URI)
 
 #Retrieves a DataLakeServiceClient object using the specified account name.
-def get_service_client_token_credential(account_name) -> DataLakeServiceClient:
+def get_service_client_token_credential(account_name) -> "DataLakeServiceClient":
+    from azure.storage.filedatalake import DataLakeServiceClient
+
     account_url = f"https://{account_name}.dfs.fabric.microsoft.com"
     token_credential = st.session_state['credential']
     service_client = DataLakeServiceClient(account_url, credential=token_credential)
     return service_client 
 
-# Uses st.cache_resource to only run once.
-@st.cache_resource(ttl=5)
-def init_connection():
-    """
-    Initializes a connection to the database using the provided credentials.
-
-    Returns:
-        engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object representing the database connection.
-    """
-    # Do not use a global variable in streamlit. Streamlit always rerun the code from top to bottom when there is a change in the user interface. 
-    # Instead use the built-in dictionary-like session_state
-    if 'engineLH' not in st.session_state:
-        # Create connection engine
-        connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server={SQL_ENDPOINT},1433;Database={DATABASE};Encrypt=Yes;TrustServerCertificate=No"
-
-        # prepare the access token
-        #https://debruyn.dev/2023/connect-to-fabric-lakehouses-warehouses-from-python-code/#:~:text=1%20sql_endpoint%20%3D%20%22%22%20%23%20copy%20and%20paste,%3D%20f%22Driver%3D%7B%7BODBC%20Driver%2018%20for%20SQL%20Server%7D%7D%3BServer%3D%20%7Bsql_endpoint%7D%2C1433%3BDatabase%3Df%7Bdatabase%7D%3BEncrypt%3DYes%3BTrustServerCertificate%3DNo%22
-        token_object = st.session_state['credential'].get_token("https://database.windows.net//.default") # Retrieve an access token valid to connect to SQL databases
-        token_as_bytes = bytes(token_object.token, "UTF-8") # Convert the token to a UTF-8 byte string
-        encoded_bytes = bytes(chain.from_iterable(zip(token_as_bytes, repeat(0)))) # Encode the bytes to a Windows byte string
-        token_bytes = struct.pack("<i", len(encoded_bytes)) + encoded_bytes # Package the token into a bytes object
-        attrs_before = {1256: token_bytes}  # Attribute pointing to SQL_COPT_SS_ACCESS_TOKEN to pass access token to the driver
-
-        params = urllib.parse.quote_plus(connection_string)
-        engine = create_engine("mssql+pyodbc:///?odbc_connect={0}".format(params), connect_args={'attrs_before': attrs_before}, echo=True)
-
-        st.session_state['engineLH'] = engine
-
-    return st.session_state['engineLH']
-
-# Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 1 sec (10 min=ttl=600).
-# @st.cache_data(ttl=1)
-def Select_query(query):
-    if st.session_state['credential'] is None:
-        st.error("Please get the token first.")
-        return pd.DataFrame()
-    else:
-        engine = init_connection()
-        with engine.connect() as connection:
-            result = pd.read_sql_query(query, connection.connection)
-            return result
-        
-#Check if a table exists in the fabric lakehouse
-def check_table_exists(table_name):
-    result = safe_select_query(f"SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{table_name}'")
-    return not result.empty
-
-#adding retry mechanisme if the query fails
-def safe_select_query(query, max_retries=3):
-    """Attempt to run Select_query with a specified number of retries on failure."""
-    for attempt in range(max_retries):
-        try:
-            df = Select_query(query)
-            return df  # Query succeeded, return the result
-        except SQLAlchemyError as e:  # Replace SQLAlchemyError with the specific exception Select_query might raise
-            st.error(f"Query failed on attempt {attempt + 1}: {e}")
-            if attempt == max_retries - 1:
-                st.error("Maximum retries reached, unable to fetch data.")
-                return None  # or raise an exception
-            # Optional: Add a delay between retries with time.sleep(seconds)
+#Check if a table exists in the fabric lakehouse, and its version, schema and number of files
+#Reads the _delta_log of the table in onelake (cached for a few seconds, see shared/delta_cache.py) instead of querying the sql endpoint,
+#so the check doesn't need a sql connection and doesn't wait for the endpoint's metadata sync
+def get_table_info(table_name):
+    table_uri = f"abfss://{WORKSPACE_NAME}@{ACCOUNT_NAME}.dfs.fabric.microsoft.com/{DATA_TABLES_PATH}/{table_name}"
+    return run_delta(table_info, table_uri, get_deltalake_conf(), description='Checking the delta table')
 
 ################################################ Page code Starts here ################################################
 st.write('# Dirty Data Editor for delta table in Fabric Lakehouse/OneLake')
@@ -222,8 +166,8 @@ with st.expander("This solution is not recommended for production use"):
                 The process of this solution is as follows:
                 1. (Optional, for initiation only) Create an delta table locally and upload it to the /Tables folder in Onelake of a Fabric Lakehouse. 
                 2. Retrieve the data from a delta table in the Fabric Lakehouse through its SQL Endpoint and save it as a dataframe.
-                3. Use the Streamlit Data Editor to insert, update, and delete data in the dataframe and then save it as a delta table locally
-                4. Upload the delta table to the /Tables folder in Onelake of a Fabric Lakehouse.
+                3. Use the Streamlit Data Editor to insert, update, and delete data in the dataframe.
+                4. Write only the changes to the delta table in Onelake: one merge on id deletes, updates and inserts the changed rows, and gives the added rows their ids.
                 ''')
 
 with st.expander("Jeffrey's Notes"):
@@ -251,23 +195,24 @@ with col2:
         st.write("Table deleted")
 
 #check if user is logged in and got a token
-if 'credential' in st.session_state:
+if st.session_state['credential'] is None:
+    st.error("Please get the token first.")
+else:
 
     #check if delta table exists
-    status = check_table_exists(DELTA_TABLE_NAME)
-    get_deltalake_conf()
+    info = get_table_info(DELTA_TABLE_NAME)
     #if table exists load it into a df
-    if status:
-        # Initialize the DeltaTable with the constructed URI and storage options
-        dt = DeltaTable(table_uri=TABLE_URI, storage_options=st.session_state['datalake_conf'])
-
-        # Convert the Delta table to a pandas DataFrame
-        df = dt.to_pandas()
+    if info['exists']:
+        # Load the Delta table as a pandas DataFrame. It is cached per table version (see shared/delta_cache.py),
+        # so a rerun only checks the delta log for new commits and downloads nothing while the table is unchanged
+        df, table_version = run_delta(load_table, TABLE_URI, st.session_state['datalake_conf'], columns=list(DELTA_TABLE_SCHEMA_DEF),
+                                      description='Loading the delta table')
 
         st.write('## Current table data from Fabric Lakehouse')
         st.write(f'Shows the current data in the {DELTA_TABLE_NAME} table. Will show an error if table does not exists.')
 
         overview = st.dataframe(df)
+        st.caption(f"Delta table version {table_version}, {info.get('files', 0)} data files, columns: {', '.join(f'{c} ({t})' for c, t in info.get('schema', {}).items())}")
 
         st.write('## Data Editor to insert, update, and delete data in Fabric Lakehouse')
         st.markdown('''
@@ -306,6 +251,12 @@ if 'credential' in st.session_state:
                 num_rows="dynamic"
             )
             submitted = st.button('Submit', on_click=submitPayload, args=[df], type="primary")
+            if st.session_state.pop('write_conflict', False):
+                st.warning("The table was changed by someone else while your changes were written, nothing was written. Submit again to apply them to the new version.")
+            if 'write_stats' in st.session_state:
+                stats = st.session_state['write_stats']
+                st.caption(f"Last submit: {stats['deleted']} deleted, {stats['updated']} updated, {stats['appended']} appended "
+                           f"in {stats['seconds']:.2f}s, table is at version {stats['version']}")
         with col22:
             st.write("Changes made from the Data Editor:")
             st.write(st.session_state["MyEditor"]) # 👈 Show the value in Session State
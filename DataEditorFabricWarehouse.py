@@ -8,16 +8,23 @@
 import streamlit as st
 import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-import struct
-from itertools import chain, repeat
-import pyodbc
-import urllib
-import random
+from sqlalchemy import text
+from shared.connections import get_fabric_engine, connect
+from shared.query_cache import cached_select, invalidate
+from shared.sql_writer import BatchWriter, row_hash_sql, VERSION_COLUMN, WAREHOUSE_STAGING_OPTIONS
+from shared.editor_payload import normalize_payload, payload_to_keys, row_versions
+from shared.editor_pager import KeysetPager
+from shared.write_behind import submit as submit_write, show_submission
+from shared.query_executor import run_with_timeout, show_job, QUERY_TIMEOUT
+from shared.arrow_fetch import fetch_arrow
+from shared.warehouse_load import stage_parquet, COPY_THRESHOLD
+from shared.onelake_upload import OneLakeBackend
+from shared.metrics import timed
 
 # Acquire a credential object
 def get_token():
+    # imported here so the page only loads azure.identity when logging in
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
     # credential = DefaultAzureCredential() #will automatically use the available credential
     credential = InteractiveBrowserCredential() #forces for interactive login as DefaultAzureCredential would use the available credential associated with the hosting of the app instead of the
     st.session_state['credential'] = credential
@@ -35,7 +42,21 @@ DATABASE = "<your-warehouse-name>" #also known as the fabric resource name
 
 TABLE_SCHEMA = '<name-of-schema>' #e.g.'dbo'
 TABLE_NAME = '<name-of-table>' #e.g.'product'
-QUERY = f'select id, name, category from {TABLE_SCHEMA}.{TABLE_NAME};'
+TABLE_COLUMNS = ['id', 'name', 'category']
+PAGE_SIZE = 100 # rows per page in the paginated editor
+COLUMN_TYPES = {'id': int, 'name': str, 'category': str} # python types the editor values are bound as
+WRITE_CHUNK_SIZE = 1000 # rows sent per round trip when submitting the editor changes
+COLUMN_SQL_TYPES = {'id': 'INT', 'name': 'VARCHAR(100)', 'category': 'VARCHAR(100)'} # column types of the staging table
+SET_BASED_THRESHOLD = 20 # singleton DML is very slow on Fabric, apply larger submissions set-based from a staging table
+# From COPY_THRESHOLD added rows (shared/warehouse_load.py) the new rows are staged as Parquet in the Files of a lakehouse and loaded with one statement
+STAGING_WORKSPACE = "<your-workspace-name>" #e.g. StreamlitdemoWorkspace
+STAGING_FOLDER = "<your-lakehouse-name>.Lakehouse/Files/staging" # folder the Parquet files are staged in, they are deleted after the load
+# Optimistic concurrency: Fabric Warehouse has no rowversion, every row is loaded with a hash of its columns and
+# updates/deletes only apply to rows that still have it, rows someone else changed meanwhile are reported as conflicts
+HASH_COLUMNS = ['name', 'category'] # columns whose hash is the row version
+VERSION_SQL = row_hash_sql(HASH_COLUMNS, sql_types=COLUMN_SQL_TYPES)
+QUERY = f'select id, name, category, {VERSION_SQL} as {VERSION_COLUMN} from {TABLE_SCHEMA}.{TABLE_NAME};'
+COMMAND_TIMEOUT = 300 # seconds the create/drop demo table commands and the submits may run before they are cancelled
 DROP_TABLE = f"DROP TABLE {TABLE_SCHEMA}.{TABLE_NAME}"
 INIT_TABLE = f"""
 IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = '{TABLE_NAME}' AND schema_id = SCHEMA_ID('{TABLE_SCHEMA}'))
@@ -52,8 +73,8 @@ VALUES
 (3, 'Product C', 'Category 3');
 """
 
-# Uses st.cache_resource to only run once.
-#@st.cache_resource(ttl=3600)
+# The engine is shared process-wide through shared/connections.py and gets a fresh access token for every new connection,
+# so it survives the hourly token rollover without being rebuilt.
 def init_connection():
     """
     Initializes a connection to the database using the provided credentials.
@@ -61,87 +82,77 @@ def init_connection():
     Returns:
         engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object representing the database connection.
     """
-    # Do not use a global variable in streamlit. Streamlit always rerun the code from top to bottom when there is a change in the user interface. 
-    # Instead use the built-in dictionary-like session_state
-    if 'engineDW' not in st.session_state:
-        # Create connection engine
-        connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server={SQL_ENDPOINT},1433;Database={DATABASE};Encrypt=Yes;TrustServerCertificate=No"
-
-        # prepare the access token
-        #https://debruyn.dev/2023/connect-to-fabric-lakehouses-warehouses-from-python-code/#:~:text=1%20sql_endpoint%20%3D%20%22%22%20%23%20copy%20and%20paste,%3D%20f%22Driver%3D%7B%7BODBC%20Driver%2018%20for%20SQL%20Server%7D%7D%3BServer%3D%20%7Bsql_endpoint%7D%2C1433%3BDatabase%3Df%7Bdatabase%7D%3BEncrypt%3DYes%3BTrustServerCertificate%3DNo%22
-        token_object = st.session_state['credential'].get_token("https://database.windows.net//.default") # Retrieve an access token valid to connect to SQL databases
-        token_as_bytes = bytes(token_object.token, "UTF-8") # Convert the token to a UTF-8 byte string
-        encoded_bytes = bytes(chain.from_iterable(zip(token_as_bytes, repeat(0)))) # Encode the bytes to a Windows byte string
-        token_bytes = struct.pack("<i", len(encoded_bytes)) + encoded_bytes # Package the token into a bytes object
-        attrs_before = {1256: token_bytes}  # Attribute pointing to SQL_COPT_SS_ACCESS_TOKEN to pass access token to the driver
-
-        params = urllib.parse.quote_plus(connection_string)
-        engine = create_engine("mssql+pyodbc:///?odbc_connect={0}".format(params), connect_args={'attrs_before': attrs_before}, echo=True, future=True)
-
-        st.session_state['engineDW'] = engine
-
-    return st.session_state['engineDW']
+    return get_fabric_engine(SQL_ENDPOINT, DATABASE, st.session_state['credential'], echo=True)
 
 # Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 1 sec (10 min=ttl=600).
-@st.cache_data(ttl=2)
-def Select_query(query):
-    if st.session_state['credential'] is None:
-        st.error("Please get the token first.")
-        return pd.DataFrame()
-    else:
-        engine = init_connection()
-        with engine.connect() as connection:
-            result = pd.read_sql_query(query, connection.connection)
-            return result
-
+# Uses the shared query cache (shared/query_cache.py), results are kept for a few minutes and dropped as soon as this app writes to the table.
+@timed('select_query', page='DataEditorFabricWarehouse')
+def Select_query_job(job, engine, query):
+    # runs as job on the shared query pool (shared/query_executor.py), so a slow endpoint doesn't freeze the page, and
+    # registers the cursor with the job, so the query is cancelled on the endpoint on timeout or when the user clicks Cancel
+    return cached_select(engine, query, lambda: fetch_arrow(engine, query, on_cursor=job.set_cursor).to_pandas())
+
+@timed('execute_sql_command', page='DataEditorFabricWarehouse')
 def execute_sql_command(batch_command):
     """
     Executes a batch SQL command.
     """
     engine = init_connection()
-    with engine.begin() as conn:
-        conn.execute(text(batch_command))
-
-def insert_added_rows(added_rows):
+    def execute(job):
+        with connect(engine, begin=True) as conn:
+            cursor = conn.connection.cursor()
+            job.set_cursor(cursor)
+            try:
+                cursor.execute(batch_command)
+            finally:
+                cursor.close()
+    # runs on the shared query pool (shared/query_executor.py), a hanging statement is cancelled after COMMAND_TIMEOUT seconds
+    run_with_timeout(execute, timeout=COMMAND_TIMEOUT, description='Command')
+    # drop the cached results of the tables the command wrote to
+    invalidate(engine, batch_command)
+
+# CRUD operations
+# The changes are queued on a BatchWriter and sent as parameterized statements in one transaction by submitPayload
+# Fabric warehouse has no identity columns, the writer gives the new rows the ids after the highest id in the table (assign_keys)
+def insert_added_rows(writer, added_rows):
     if not added_rows:
         return
-    insert_commands = [f"INSERT INTO {TABLE_SCHEMA}.{TABLE_NAME} (id, name, category) VALUES ({random.randrange(1, 2147483647, 1)},'{row['name']}', '{row['category']}')" for row in added_rows]
-    batch_command = "; ".join(insert_commands)
-    execute_sql_command(batch_command)
-
-def delete_deleted_rows(deleted_rows):
+    writer.insert({'name': row.get('name'), 'category': row.get('category')} for row in added_rows)
+
+# Large numbers of added rows (e.g. pasted from Excel) are staged as a Parquet file in OneLake instead of INSERT statements,
+# the writer loads it in the same transaction as the other changes and deletes it afterwards
+def bulk_insert_added_rows(writer, added_rows):
+    from azure.storage.filedatalake import DataLakeServiceClient
+
+    df = pd.DataFrame.from_records([{'name': row.get('name'), 'category': row.get('category')} for row in added_rows], columns=['name', 'category'])
+    service_client = DataLakeServiceClient("https://onelake.dfs.fabric.microsoft.com", credential=st.session_state['credential'])
+    backend = OneLakeBackend(service_client.get_file_system_client(STAGING_WORKSPACE))
+    try:
+        url, path, _ = stage_parquet(df, backend, STAGING_WORKSPACE, STAGING_FOLDER, TABLE_NAME)
+    except Exception:
+        service_client.close()
+        raise
+
+    def cleanup():
+        try:
+            backend.delete(path)
+        finally:
+            service_client.close()
+    writer.load_parquet(url, df.columns, len(df), cleanup=cleanup)
+
+# deleted_rows and edited_rows refer to the ID values from the database table rather than the index numbers from the DF (see submitPayload)
+# versions holds the version of every changed row when it was loaded, rows changed by someone else since are not written
+def delete_deleted_rows(writer, deleted_rows, versions):
     if not deleted_rows:
         return
-    delete_commands = []
-    
-    for row_index in deleted_rows:
-        # Get the ID value from database table rather than the index number from the DF.
-        productID = df["id"][row_index]
-
-        # Append each delete command to the list
-        delete_commands.append(f"DELETE FROM {TABLE_SCHEMA}.{TABLE_NAME} WHERE id = {productID}")
-    batch_command = "; ".join(delete_commands)
+    writer.delete(deleted_rows, versions)
 
-    execute_sql_command(batch_command)
-
-def update_edited_rows(edited_rows):
+def update_edited_rows(writer, edited_rows, versions):
     if not edited_rows:
         return
-    update_commands = []
-
-    for row_index, row in edited_rows.items():
-        # Get the ID value from database table rather than the index number from the DF.
-        productID = df["id"][row_index]
-        # Construct the SET part of the SQL command dynamically based on edited fields
-        set_parts = [f"{column} = '{value}'" for column, value in row.items()]
-        set_command = ", ".join(set_parts)
-
-        update_commands.append(f"UPDATE {TABLE_SCHEMA}.{TABLE_NAME} SET {set_command} WHERE id = {productID}")
-
-    batch_command = "; ".join(update_commands)
-    print(batch_command)
-    execute_sql_command(batch_command)
+    for productID, row in edited_rows.items():
+        # Only the edited fields are part of the SET clause
+        writer.update(productID, row, versions.get(productID))
 
 ################################################ Page code Starts here ################################################
 
@@ -155,7 +166,7 @@ with st.expander("Jeffrey's Notes"):
                 - Fabric data warehoues and lakehouses are optimized for crunching big analytics workloads with its distributed compute architecture. 
                 It is less ideal to use for transactional workloads such as fetching and updating individual rows. Such use case are better served with a traditional database such as Azure SQL db for the best performance.
                 - From an architectural perspective modifying the data directly in a data warehouse might not be the best practice as audit trails and data governance might be compromised.
-                - I'm using streamlit's caching feature to reduce query latency. If data is not current, you can uncomment the caching decorators (st.cache_resource and st.cache_data).''')
+                - Query results are cached for a few minutes to reduce query latency (shared/query_cache.py). Changes made through this app show up immediately, changes made elsewhere once the cache expires.''')
 if st.button('Login'):
     get_token()
 
@@ -172,56 +183,123 @@ with col2:
 
 st.write('## View table data from Fabric Datawarehouse')
 st.write(f'Shows the current data in the {TABLE_SCHEMA}.{TABLE_NAME} table. Will show an error if table does not exists.')
-df = Select_query(QUERY)
-
-st.table(df)
-
-st.write('## Insert, update, and delete data in Fabric Datawarehouse')
-st.markdown('''
-        :blue-background[Note] Product ID column has been disabled because it is automatic incremental identity column.
-        ''')
-with st.expander("Data Editor Features"):
+# Paginated mode only loads one page of the table at a time, for tables too large to load into every session
+paginated = st.toggle('Paginated editor (for large tables)', key='paginated')
+if st.session_state['credential'] is None:
+    st.error("Please get the token first.")
+    st.stop()
+if paginated:
+    pager = KeysetPager('MyEditorPager', init_connection(), TABLE_SCHEMA, TABLE_NAME, TABLE_COLUMNS, key_column='id', page_size=PAGE_SIZE,
+                        version_sql=VERSION_SQL)
+    df = pager.page()
+    editor_key = pager.editor_key
+else:
+    df = None  # read on the shared query pool at the end of the page
+    editor_key = "MyEditor"
+
+def submitPayload(df):
+    if paginated:
+        # changes of all visited pages, already keyed by ID
+        payloadJson = pager.collect()
+        versions = payloadJson.get('versions', {})
+    else:
+        print(st.session_state["MyEditor"])
+        # Get the ID values from database table rather than the index numbers from the DF.
+        # Only the cells that differ from the loaded rows are written, see normalize_payload in shared/editor_payload.py
+        payloadJson = payload_to_keys(normalize_payload(st.session_state["MyEditor"], df), df, key_column='id')
+        versions = row_versions(payloadJson, df, key_column='id')
+
+    writer = BatchWriter(init_connection(), TABLE_SCHEMA, TABLE_NAME, key_column='id', column_types=COLUMN_TYPES, chunk_size=WRITE_CHUNK_SIZE,
+                         sql_types=COLUMN_SQL_TYPES, set_based_threshold=SET_BASED_THRESHOLD, use_merge=False,
+                         hash_columns=HASH_COLUMNS, lock_rows=False, assign_keys=True, staging_options=WAREHOUSE_STAGING_OPTIONS)
+    if len(payloadJson['added_rows']) >= COPY_THRESHOLD:
+        bulk_insert_added_rows(writer, payloadJson['added_rows'])
+    else:
+        insert_added_rows(writer, payloadJson['added_rows'])
+    delete_deleted_rows(writer, payloadJson['deleted_rows'], versions)
+    update_edited_rows(writer, payloadJson['edited_rows'], versions)
+    if st.session_state.get('write_behind'):
+        # returns right away, the changes are committed together with those of other sessions (shared/write_behind.py)
+        st.session_state['write_submission'] = submit_write(writer)
+    else:
+        # runs on the shared query pool (shared/query_executor.py), a hanging commit is cancelled and rolled back after COMMAND_TIMEOUT seconds
+        st.session_state['write_stats'] = run_with_timeout(lambda job: writer.commit(on_cursor=job.set_cursor),
+                                                           timeout=COMMAND_TIMEOUT, description='Submit')
+
+# Shows the stats and conflicts of a committed submission
+def show_write_stats(stats):
+    st.caption(f"Inserted {stats['inserted']}, deleted {stats['deleted']} and updated {stats['updated']} rows in {stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/sec, {stats['mode']} mode)")
+    if stats['loaded']:
+        st.caption(f"{stats['loaded']} of the added rows were loaded through a Parquet file staged in OneLake.")
+    if stats['conflicts']:
+        # these rows were changed or deleted by someone else after they were loaded, the editor now shows their current values
+        st.warning(f"{len(stats['conflicts'])} rows were not saved because someone else changed them in the meantime. Check their current values and edit them again.")
+        st.dataframe(pd.DataFrame(stats['conflicts']).rename(columns={'key': 'id'}), hide_index=True)
+
+# Shows the loaded rows with the data editor and the submit button
+def show_editor(df):
+    st.table(df.drop(columns=VERSION_COLUMN, errors='ignore'))
+
+    st.write('## Insert, update, and delete data in Fabric Datawarehouse')
     st.markdown('''
-        **Features:**
-        - Toolbar appears when hovering over the table
-        - Quick search for data
-        - Export data as a CSV file
-                
-        **Editing Data:**
-        - Double-click a cell to insert or edit data.
-        - Supports copy/paste from and to Excel.
-                
-        **Deleting a Row:**
-        - Select the row by clicking the leftmost column.
-        - Press the Delete key or click the Trash bin icon on toolbar.
-        ''')
-
-st.write(f'Data editor for table: {TABLE_SCHEMA}.{TABLE_NAME}')
-edited_df = st.data_editor(
-    df, 
-    column_config={
-        "id": "Product ID",
-        "name": "Product Name",
-        "category": "Product Category"
-    },
-    disabled=["id"],
-    hide_index=True,
-    key="MyEditor", 
-    num_rows="dynamic"
-)
-
-# st.write("Here's the value in Session State:")
-# st.write(st.session_state["MyEditor"]) # 👈 Show the value in Session State
-
-def submitPayload():
-    print(st.session_state["MyEditor"])
-    payloadJson = st.session_state["MyEditor"]
-
-    insert_added_rows(payloadJson['added_rows'])
-    delete_deleted_rows(payloadJson['deleted_rows'])
-    update_edited_rows(payloadJson['edited_rows'])
-
-submitted = st.button('Submit', on_click=submitPayload, type="primary")
-
-if submitted:
-    st.write("Payload submitted")
\ No newline at end of file
+            :blue-background[Note] Product ID column has been disabled because it is automatic incremental identity column.
+            ''')
+    with st.expander("Data Editor Features"):
+        st.markdown('''
+            **Features:**
+            - Toolbar appears when hovering over the table
+            - Quick search for data
+            - Export data as a CSV file
+                    
+            **Editing Data:**
+            - Double-click a cell to insert or edit data.
+            - Supports copy/paste from and to Excel.
+                    
+            **Deleting a Row:**
+            - Select the row by clicking the leftmost column.
+            - Press the Delete key or click the Trash bin icon on toolbar.
+            ''')
+
+    st.write(f'Data editor for table: {TABLE_SCHEMA}.{TABLE_NAME}')
+    edited_df = st.data_editor(
+        df, 
+        column_config={
+            "id": "Product ID",
+            "name": "Product Name",
+            "category": "Product Category",
+            VERSION_COLUMN: None
+        },
+        disabled=["id"],
+        hide_index=True,
+        key=editor_key, 
+        num_rows="dynamic"
+    )
+
+    if paginated:
+        col3, col4, col5 = st.columns([1, 1, 3])
+        with col3:
+            st.button('Previous page', on_click=pager.previous_page, disabled=pager.page_number == 1)
+        with col4:
+            st.button('Next page', on_click=pager.next_page, disabled=not pager.has_next)
+        with col5:
+            st.caption(f"Page {pager.page_number}, {pager.pending_count()} pending changes from other pages are submitted together with this page.")
+
+    # st.write("Here's the value in Session State:")
+    # st.write(st.session_state["MyEditor"]) # 👈 Show the value in Session State
+
+    # Write-behind queues the changes and commits them together with the submissions of other sessions, for busy tables
+    write_behind = st.toggle('Write-behind (group commit with other sessions)', key='write_behind')
+    st.button('Submit', on_click=submitPayload, args=[df], type="primary")
+
+    # the stats of a synchronous submit are shown once, by the first run that shows the editor again after it
+    stats = st.session_state.pop('write_stats', None)
+    if stats is not None and not write_behind:
+        st.write("Payload submitted")
+        show_write_stats(stats)
+
+if df is None:
+    # the whole table is read on the shared query pool, the page shows a placeholder (with a Cancel button) until it arrived
+    show_job('editor_select_job', QUERY, Select_query_job, show_editor, init_connection(), QUERY, timeout=QUERY_TIMEOUT)
+else:
+    show_editor(df)
+show_submission('write_submission', show_write_stats)
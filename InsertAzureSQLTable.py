@@ -13,7 +13,13 @@ import time
 import streamlit as st
 import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from shared.connections import get_sql_login_engine, connect
+from shared.query_cache import cached_select, invalidate
+from shared.bulk_insert import bulk_insert, MODES
+from shared.metrics import timed
+from shared.query_executor import run_with_timeout, show_job, QUERY_TIMEOUT
+from shared.arrow_fetch import fetch_arrow
 
 # Connection string
 SERVER = st.secrets["server"]
@@ -25,6 +31,8 @@ DATABASE = '<name-of-database>' #e.g.'sandbox'
 TABLE_SCHEMA = '<name-of-schema>' #e.g. 'dbo'
 TABLE_NAME = '<name-of-table>' #e.g. 'person'
 QUERY = f'SELECT top (100) name, address, type, date from {TABLE_SCHEMA}.{TABLE_NAME};'
+COLUMN_SQL_TYPES = {'name': 'VARCHAR(100)', 'address': 'VARCHAR(100)', 'type': 'VARCHAR(100)', 'date': 'DATE'} # used to create the table type of the tvp insert mode
+COMMAND_TIMEOUT = 300 # seconds the create/drop demo table commands and the inserts may run before they are cancelled
 DROP_TABLE = f"DROP TABLE {TABLE_SCHEMA}.{TABLE_NAME}"
 INIT_TABLE = f"""
 IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = '{TABLE_NAME}' AND schema_id = SCHEMA_ID('{TABLE_SCHEMA}'))
@@ -41,8 +49,8 @@ VALUES
 ('Bob', 'Street 2', 'Type B', '2024-07-23'),
 ('Charlie', 'Street 3', 'Type C', '2024-07-22');"""
 
-# Uses st.cache_resource to only run once.
-#@st.cache_resource
+# The engine is shared by all pages and sessions through the process-wide registry in shared/connections.py,
+# so this only creates it (and logs in) once per server process.
 def init_connection():
     """
     Initializes a connection to the database using the provided credentials.
@@ -50,33 +58,41 @@ def init_connection():
     Returns:
         engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object representing the database connection.
     """
-    # Create connection engine
-    connection_string = f'mssql+pyodbc://{USERNAME}:{PASSWORD}@{SERVER}/{DATABASE}?driver={DRIVER}'
-    engine = create_engine(connection_string)
-    return engine
+    return get_sql_login_engine(SERVER, DATABASE, USERNAME, PASSWORD, DRIVER)
 
 # Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 1 sec (10 min=ttl=600).
-#@st.cache_data(ttl=1)
-def Select_query(query):
-    engine = init_connection()
-    with engine.connect() as connection:
-        result = pd.read_sql_query(query, connection.connection)
-        return result
+# Uses the shared query cache (shared/query_cache.py), results are kept for a few minutes and dropped as soon as this app writes to the table.
+@timed('select_query', page='InsertAzureSQLTable')
+def Select_query_job(job, engine, query):
+    # runs as job on the shared query pool (shared/query_executor.py), so a slow query doesn't freeze the page, and
+    # registers the cursor with the job, so the query is cancelled on the server on timeout or when the user clicks Cancel
+    return cached_select(engine, query, lambda: fetch_arrow(engine, query, on_cursor=job.set_cursor).to_pandas())
     
+@timed('execute_sql_command', page='InsertAzureSQLTable')
 def execute_sql_command(batch_command):
     """
     Executes a batch SQL command.
     """
     engine = init_connection()
-    with engine.begin() as conn:
-        conn.execute(text(batch_command))
+    def execute(job):
+        with connect(engine, begin=True) as conn:
+            cursor = conn.connection.cursor()
+            job.set_cursor(cursor)
+            try:
+                cursor.execute(batch_command)
+            finally:
+                cursor.close()
+    # runs on the shared query pool (shared/query_executor.py), a hanging statement is cancelled after COMMAND_TIMEOUT seconds
+    run_with_timeout(execute, timeout=COMMAND_TIMEOUT, description='Command')
+    # drop the cached results of the tables the command wrote to
+    invalidate(engine, batch_command)
 
 def CRUD_query(query):
     # To delete a row from the table
-    with engine.connect() as connection:
+    with connect(engine) as connection:
         connection.execute(text(query))
         connection.commit()  # Commit the transaction to make sure changes are saved
+    invalidate(engine, query)
 
 # Function to append inputs from form into dataframe
 def submitForm(num_rows):
@@ -86,25 +102,22 @@ def submitForm(num_rows):
     Parameters:
     - num_rows (int): The number of rows to add to the DataFrame.
     """
-    #wipe data from previous entry
-    st.session_state.data = None
-
-    #create new data from entry
-    for r in range(num_rows):
-        row = pd.DataFrame({'name':[st.session_state[f'input_col4{r}']],
-                'address':'add' + str(st.session_state[f'input_col3{r}']),
-                'type':['hardcoded C'],
-                'date': [date.today()]})
-        st.session_state.data = pd.concat([st.session_state.data, row])
-    
-    df = st.session_state.data
-
-    #using sqlalchemy for faster inserts
+    #create new data from entry, building each column in one go rather than concatenating a frame per row
+    df = pd.DataFrame({'name': [st.session_state[f'input_col4{r}'] for r in range(num_rows)],
+            'address': ['add' + str(st.session_state[f'input_col3{r}']) for r in range(num_rows)],
+            'type': ['hardcoded C'] * num_rows,
+            'date': [date.today()] * num_rows})
+    st.session_state.data = df
+
+    #using bulk inserts instead of one insert per row, see shared/bulk_insert.py for the available modes
     #https://stackoverflow.com/questions/63523711/inserting-data-to-sql-server-from-a-python-dataframe-quickly
-    #Consider adding the following options to the to_sql call: if_exists='append', method='multi', chunksize=500 The chunk size will depend on how large or numerous your values are. With this I managed to write 20K rows similar to your data in 7 seconds. – 
 
-    # Write DataFrame to SQL table
-    df.to_sql(TABLE_NAME, con=engine, schema=TABLE_SCHEMA, if_exists='append', index=False)
+    # Write DataFrame to SQL table, on the shared query pool (shared/query_executor.py) so a hanging insert is cancelled after COMMAND_TIMEOUT seconds
+    mode = st.session_state['insert_mode']
+    stats = run_with_timeout(lambda job: bulk_insert(engine, df, TABLE_SCHEMA, TABLE_NAME, mode=mode, sql_types=COLUMN_SQL_TYPES,
+                                                     on_cursor=job.set_cursor),
+                             timeout=COMMAND_TIMEOUT, description='Insert')
+    st.session_state.insert_stats = st.session_state.get('insert_stats', []) + [stats]
 
 # Function to add a row of input widgets
 def GenerateFormRows(row):
@@ -150,10 +163,8 @@ with col2:
 
 st.write('## View table data from Azure SQL Database')
 st.write(f'Shows the current data in the {TABLE_SCHEMA}.{TABLE_NAME} table. Will show an error if table does not exists.')
-df = Select_query(QUERY)
-
-# Print results as table
-st.table(df)
+# Print results as table, a placeholder is shown while the query runs
+show_job('insert_select_job', QUERY, Select_query_job, st.table, engine, QUERY, timeout=QUERY_TIMEOUT)
 
 st.write('## Input form to insert data into Azure SQL Database')
 
@@ -175,6 +186,9 @@ num_rows = st.slider('Number of rows', min_value=1, max_value=10)
 for r in range(num_rows):
     GenerateFormRows(r)
 
+# How the rows are sent to the database, fast_executemany works out of the box, tvp creates a table type on first use
+st.radio('Insert mode', MODES, key='insert_mode', horizontal=True)
+
 # Every form must have a submit button.
 submitted = st.button('Submit', on_click=submitForm, args=([num_rows]), type="primary")
 st.markdown('''
@@ -186,6 +200,8 @@ checkbox_val = st.checkbox("Form checkbox",value=True)
 
 # Show form submitted text
 if submitted:
+    st.write("Insert throughput of the submits in this session:")
+    st.dataframe(pd.DataFrame(st.session_state.insert_stats))
     waittime = 5
     with st.empty():
         for seconds in range(waittime):
@@ -31,6 +31,11 @@ from deltalake import DeltaTable
 from deltalake.writer import write_deltalake
 import numpy as np
 from concurrent.futures import ThreadPoolExecutor
+# the shared helpers live in the repo root, run this page from there: python -m streamlit run OtherStuff/DataEditorFabricLakehouse.py
+from shared.onelake_upload import upload_folder as sync_folder, OneLakeBackend, MAX_WORKERS
+from shared.tokens import STORAGE_SCOPE, get_token_cache
+from shared.delta_cache import load_table, table_info
+from shared.delta_watcher import subscribe, forget_table
 
 # Acquire a credential object
 def get_token():
@@ -71,6 +76,14 @@ FULL_TABLE_PATH = f"{DATA_TABLES_PATH}/{DELTA_TABLE_NAME}"
 #temp folder to store the delta table
 LOCAL_TEMP = f"./temp/{DELTA_TABLE_NAME}"
 
+# Construct the URI for the Delta table
+TABLE_URI = f"abfss://{WORKSPACE_NAME}@{ACCOUNT_NAME}.dfs.fabric.microsoft.com/{FULL_TABLE_PATH}"
+
+#Returns a function giving the storage options for deltalake. The background watcher calls it from its own thread,
+#where st.session_state isn't available, so it holds on to the credential itself
+def storage_options(credential):
+    return lambda: {'token': get_token_cache(credential, STORAGE_SCOPE).get()}
+
 #Retrieves a DataLakeServiceClient object using the specified account name.
 def get_service_client_token_credential(account_name) -> DataLakeServiceClient:
     account_url = f"https://{account_name}.dfs.fabric.microsoft.com"
@@ -108,71 +121,31 @@ def upload_file(file_path, file_system_client, data_files_path, folder_path):
     file_client = file_system_client.get_file_client(azure_path)
     
     with open(file_path, "rb") as data:
-        print(f"Uploading {file_path} to {azure_path}...")  # Optional: print the upload status
         file_client.upload_data(data, overwrite=True)
 
-def upload_folder(folder_path, file_system_client, data_files_path, max_workers=5):
-    #max_workers parameter controls the number of concurrent threads
-    files_to_upload = []
-    
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            files_to_upload.append(file_path)
-
-    #Uses ThreadPoolExecutor to perform concurrent uploads.
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [
-            executor.submit(upload_file, file_path, file_system_client, data_files_path, folder_path)
-            for file_path in files_to_upload
-        ]
-        
-        for future in futures:
-            future.result()  # Wait for all uploads to complete
+#Uploads the folder with shared/onelake_upload.py: files that match the remote copy (size and md5) are skipped,
+#large files are streamed in parallel blocks and the number of parallel uploads adapts to the throughput
+def upload_folder(folder_path, file_system_client, data_files_path, max_workers=MAX_WORKERS):
+    #max_workers parameter caps the number of concurrent uploads
+    stats = sync_folder(folder_path, OneLakeBackend(file_system_client), data_files_path, max_workers=max_workers)
+    st.session_state['upload_stats'] = stats
+    return stats
 
 
 #Check if a table exists in the fabric lakehouse
+#Reads the _delta_log in onelake, so a new table is found as soon as its first commit is uploaded
 def check_table_exists(table_name):
-    result = safe_select_query(f"SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{table_name}'")
-    return not result.empty
-
-def wait_for_table_update(table_name, timeout=60, check_interval=1):
-    """
-    Wait for the table to be updated with a fixed interval and timeout.
-
-    :param table_name: Name of the table to check.
-    :param timeout: Maximum time to wait for the update in seconds.
-    :param check_interval: Interval between checks in seconds.
-    :return: True if the table was updated within the timeout, False otherwise.
-    """
-    original_date = table_last_modified(table_name)
-    start_time = time.time()
-
-    while time.time() - start_time < timeout:
-        time.sleep(check_interval)
-
-        new_date = table_last_modified(table_name)
-        
-        #print(f"Original date: {original_date}, New date: {new_date}")
-        if original_date != new_date:
-            return True
-
-    print(f"Timeout reached: Table {table_name} was not updated within {timeout} seconds.")
-    return False
-
-def table_last_modified(table_name):
-    df = safe_select_query(f"SELECT modify_date FROM sys.tables WHERE name = '{table_name}'")
-
-    #get the modify date of the table as a string
-    return df['modify_date'][0]
+    if st.session_state['credential'] is None:
+        st.error("Please get the token first.")
+        return False
+    return table_info(TABLE_URI, storage_options(st.session_state['credential'])())['exists']
 
-#Wait for a few seconds before refreshing the UI. Mainly to allow the sql endpoint a few seconds to discover the new table we created in onelake
-def waitRefreshUI(waitTime):
-    with st.empty():
-        for seconds in range(waitTime):
-            st.write(f"⏳ Refreshing UI in {waitTime - seconds}!")
-            time.sleep(1)
-        st.write("✔️ Top table refreshed")
+#Starts watching the delta table in onelake for a version newer than the one shown (see shared/delta_watcher.py),
+#e.g. a commit from a Fabric notebook, so the page can offer to reload instead of showing outdated rows
+def watch_newer_version(version):
+    watch = st.session_state.get('table_watch')
+    if watch is None or watch.version != version + 1 or watch.expired:
+        st.session_state['table_watch'] = subscribe(TABLE_URI, storage_options(st.session_state['credential']), version + 1)
 
 # Create a sample delta table in Fabric Lakehouse
 def init_demo_table():
@@ -180,8 +153,6 @@ def init_demo_table():
 
     Sync_DF_to_Onelake(df)
 
-    waitRefreshUI(5)
-
 #internal function to upload materialize a df as a delta table and then push it to onelake
 def Sync_DF_to_Onelake(df):
     with get_service_client_token_credential(ACCOUNT_NAME) as service_client:
@@ -200,6 +171,9 @@ def Sync_DF_to_Onelake(df):
         # Upload the saved files to OneLake 
         upload_folder(LOCAL_TEMP, file_system_client, OneLakeDestination)
 
+        #the upload is complete, the rerun after the callback loads the table at the uploaded version
+        return DeltaTable(LOCAL_TEMP).version()
+
 # Uses st.cache_resource to only run once.
 @st.cache_resource(ttl=5)
 def init_connection():
@@ -307,7 +281,7 @@ def clean_up():
         print(f"Folder '{LOCAL_TEMP}' does not exist.")
     #delete table in onelake
     DeleteDeltaTableInOneLake()
-    waitRefreshUI(1)
+    forget_table(TABLE_URI)
 
 ################################################ Page code Starts here ################################################
 st.write('# Dirty Data Editor for delta table in Fabric Lakehouse/OneLake')
@@ -358,6 +332,24 @@ with col2:
    if cleanBtn:
     st.write("Table deleted")
 
+if 'upload_stats' in st.session_state:
+    stats = st.session_state.pop('upload_stats')
+    st.caption(f"Uploaded {stats['uploaded']} files ({stats['bytes']} bytes), skipped {stats['skipped']} unchanged files in {stats['seconds']:.2f}s")
+
+#Tells when someone else committed a newer version of the table. The fragment reruns every second on its own,
+#only checking the subscription of the background watcher, so the rest of the page stays responsive
+@st.fragment(run_every=1)
+def show_newer_version():
+    watch = st.session_state.get('table_watch')
+    if watch is None:
+        return
+    if watch.reached:
+        st.info(f"Version {watch.seen_version} of the table was committed in OneLake since it was loaded")
+        st.button('Reload', key='reload_table', on_click=st.session_state.pop, args=['table_watch'])
+    elif watch.expired:
+        # keep watching
+        st.session_state['table_watch'] = subscribe(watch.table_uri, storage_options(st.session_state['credential']), watch.version)
+
 #check if user is logged in and got a token
 if 'credential' in st.session_state:
 
@@ -366,7 +358,7 @@ if 'credential' in st.session_state:
 
     #if table exists load it into a df
     if status:
-        df = safe_select_query(QUERY)
+        df, table_version = load_table(TABLE_URI, storage_options(st.session_state['credential'])(), columns=list(DELTA_TABLE_SCHEMA_DEF))
 
         #schema enforcement to ensure the id column is int and not float
         df = df.astype(DELTA_TABLE_SCHEMA_DEF)
@@ -375,6 +367,8 @@ if 'credential' in st.session_state:
         st.write(f'Shows the current data in the {DELTA_TABLE_NAME} table. Will show an error if table does not exists.')
 
         overview = st.dataframe(df)
+        watch_newer_version(table_version)
+        show_newer_version()
 
         st.write('## Data Editor to insert, update, and delete data in Fabric Lakehouse')
         st.markdown('''
@@ -416,21 +410,3 @@ if 'credential' in st.session_state:
         with col22:
             st.write("Changes made from the Data Editor:")
             st.write(st.session_state["MyEditor"]) # 👈 Show the value in Session State
-
-
-        st.caption('If the table doesnt reflect your changes it might be due to the sql endpoint not being updated yet. \n\n Please refresh the page to see the changes or increase the wait time.')
-
-        if submitted:
-            st.write("Payload submitted - ⏳Waiting for changes to be discoverable at SQL Endpoint")
-            with st.empty():
-                status = wait_for_table_update(DELTA_TABLE_NAME)
-                if status:
-                    print("Table changes discovered at SQL Endpoint")
-
-                    df = safe_select_query(QUERY).astype(DELTA_TABLE_SCHEMA_DEF)
-
-                    overview.dataframe(df)
-                else:
-                    st.write("Table changes not discovered at SQL Endpoint")
-
-                st.write("✔️ Top table refreshed")
\ No newline at end of file
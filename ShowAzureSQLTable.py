@@ -40,7 +40,13 @@
 import streamlit as st
 import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from shared.connections import get_sql_login_engine, connect
+from shared.query_cache import cached_select, invalidate
+from shared.row_render import format_rows, render_rows, RENDER_MODES
+from shared.metrics import timed
+from shared.query_executor import run_with_timeout, show_job, QUERY_TIMEOUT
+from shared.arrow_fetch import fetch_arrow
 
 # Connection string
 SERVER = st.secrets["server"]
@@ -52,6 +58,7 @@ DATABASE = '<name-of-database>' #e.g.'sandbox'
 TABLE_SCHEMA = '<name-of-schema>' #e.g. 'dbo'
 TABLE_NAME = '<name-of-table>' #e.g. 'person'
 QUERY = f'SELECT top (100) name, address, type, date from {TABLE_SCHEMA}.{TABLE_NAME};'
+COMMAND_TIMEOUT = 300 # seconds the create/drop demo table commands may run before they are cancelled
 DROP_TABLE = f"DROP TABLE {TABLE_SCHEMA}.{TABLE_NAME}"
 INIT_TABLE = f"""
 IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = '{TABLE_NAME}' AND schema_id = SCHEMA_ID('{TABLE_SCHEMA}'))
@@ -68,29 +75,37 @@ VALUES
 ('Bob', 'Street 2', 'Type B', '2024-07-23'),
 ('Charlie', 'Street 3', 'Type C', '2024-07-22');"""
 
-# Uses st.cache_resource to only run once.
-#@st.cache_resource
+# The engine is shared by all pages and sessions through the process-wide registry in shared/connections.py,
+# so this only creates it (and logs in) once per server process.
 def init_connection():
-    # Create connection engine
-    connection_string = f'mssql+pyodbc://{USERNAME}:{PASSWORD}@{SERVER}/{DATABASE}?driver={DRIVER}'
-    engine = create_engine(connection_string)
-    return engine
+    return get_sql_login_engine(SERVER, DATABASE, USERNAME, PASSWORD, DRIVER)
 
 # Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 1 sec (10 min=ttl=600).
-#@st.cache_data(ttl=1)
-def Select_query(query):
-    engine = init_connection()
-    with engine.connect() as connection:
-        result = pd.read_sql_query(query, connection.connection)
-        return result
+# Uses the shared query cache (shared/query_cache.py), results are kept for a few minutes and dropped as soon as this app writes to the table.
+@timed('select_query', page='ShowAzureSQLTable')
+def Select_query_job(job, engine, query):
+    # runs as job on the shared query pool (shared/query_executor.py), so a slow query doesn't freeze the page, and
+    # registers the cursor with the job, so the query is cancelled on the server on timeout or when the user clicks Cancel
+    return cached_select(engine, query, lambda: fetch_arrow(engine, query, on_cursor=job.set_cursor).to_pandas())
     
+@timed('execute_sql_command', page='ShowAzureSQLTable')
 def execute_sql_command(batch_command):
     """
     Executes a batch SQL command.
     """
-    with engine.begin() as conn:
-        conn.execute(text(batch_command))
+    engine = init_connection()
+    def execute(job):
+        with connect(engine, begin=True) as conn:
+            cursor = conn.connection.cursor()
+            job.set_cursor(cursor)
+            try:
+                cursor.execute(batch_command)
+            finally:
+                cursor.close()
+    # runs on the shared query pool (shared/query_executor.py), a hanging statement is cancelled after COMMAND_TIMEOUT seconds
+    run_with_timeout(execute, timeout=COMMAND_TIMEOUT, description='Command')
+    # drop the cached results of the tables the command wrote to
+    invalidate(engine, batch_command)
 
  # Initialize connection.   
 engine = init_connection()
@@ -111,11 +126,19 @@ with col2:
 st.write('## View table data from Azure SQL Database')
 st.write(f'Shows the current data in the {TABLE_SCHEMA}.{TABLE_NAME} table. Will show an error if table does not exists.')
 st.divider()
-df = Select_query(QUERY)
 
 # Print results.
-for index, row in df.iterrows():
-    st.write(f"name column: {row['name']} | address column: {row['address']}")
+# batched formats all rows in one pass and shows them as one element (see shared/row_render.py), per row writes every row on its own
+render_mode = st.radio('Render mode', RENDER_MODES, horizontal=True)
+def show_rows(df):
+    if render_mode == 'batched':
+        render_rows(format_rows(df, [('name column', 'name'), ('address column', 'address')]))
+    else:
+        for index, row in df.iterrows():
+            st.write(f"name column: {row['name']} | address column: {row['address']}")
+
+# shows a placeholder while the query runs and the rows once they arrived
+show_job('show_azure_select_job', QUERY, Select_query_job, show_rows, engine, QUERY, timeout=QUERY_TIMEOUT)
     
 # create a Excel file with the results
 # df.to_excel("FileExample.xlsx",sheet_name='Results')
\ No newline at end of file
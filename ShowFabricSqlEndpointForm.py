@@ -1,16 +1,21 @@
 import streamlit as st
 import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-import struct
-from itertools import chain, repeat
-import pyodbc
-import urllib
+from sqlalchemy import text
 import random
+from shared.connections import get_fabric_engine
+from shared.arrow_fetch import fetch_arrow, stream_arrow
+from shared.query_cache import cached_select
+from shared.query_executor import show_job, QUERY_TIMEOUT
+from shared.fan_out import fan_out
+from shared.metrics import timed
+import time
+from contextlib import closing
 
 # Acquire a credential object
 def get_token():
+    # imported here so the page only loads azure.identity when logging in
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
     # credential = DefaultAzureCredential() #will automatically use the available credential
     credential = InteractiveBrowserCredential() #forces for interactive login as DefaultAzureCredential would use the available credential associated with the hosting of the app instead of the
     st.session_state['credential'] = credential
@@ -21,57 +26,52 @@ if 'credential' not in st.session_state:
 if 'token' not in st.session_state:
     st.session_state['token'] = None
 
-# Uses st.cache_resource to only run once.
-# The default lifetime of the token is 1 hour
-#@st.cache_resource(ttl=3600)
+# The engines are shared process-wide through shared/connections.py, one per sql endpoint and database.
+# The default lifetime of the token is 1 hour, every new connection gets a fresh one from the background refreshed token cache.
 def init_connection(sql_endpoint, database):
     """
     Initializes a connection to the database using the provided credentials.
-    Only runs once and caches the result unless the sql_endpoint or database changes.
+    Only creates the engine once per sql_endpoint and database, switching back and forth reuses the existing pools.
 
     Returns:
         engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object representing the database connection.
     """
-
-    if ('CustomEngine' not in st.session_state or 
-        'sqlDB' not in st.session_state or 
-        'sqlEndpoint' not in st.session_state or 
-        st.session_state['sqlEndpoint'] != sql_endpoint or 
-        st.session_state['sqlDB'] != database):
-            # Do not use a global variable in streamlit. Streamlit always rerun the code from top to bottom when there is a change in the user interface. 
-            # Instead use the built-in dictionary-like session_state
-            # Create connection engine
-            connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server={sql_endpoint},1433;Database={database};Encrypt=Yes;TrustServerCertificate=No"
-
-            # prepare the access token
-            #https://debruyn.dev/2023/connect-to-fabric-lakehouses-warehouses-from-python-code/#:~:text=1%20sql_endpoint%20%3D%20%22%22%20%23%20copy%20and%20paste,%3D%20f%22Driver%3D%7B%7BODBC%20Driver%2018%20for%20SQL%20Server%7D%7D%3BServer%3D%20%7Bsql_endpoint%7D%2C1433%3BDatabase%3Df%7Bdatabase%7D%3BEncrypt%3DYes%3BTrustServerCertificate%3DNo%22
-            token_object = st.session_state['credential'].get_token("https://database.windows.net//.default") # Retrieve an access token valid to connect to SQL databases
-            token_as_bytes = bytes(token_object.token, "UTF-8") # Convert the token to a UTF-8 byte string
-            encoded_bytes = bytes(chain.from_iterable(zip(token_as_bytes, repeat(0)))) # Encode the bytes to a Windows byte string
-            token_bytes = struct.pack("<i", len(encoded_bytes)) + encoded_bytes # Package the token into a bytes object
-            attrs_before = {1256: token_bytes}  # Attribute pointing to SQL_COPT_SS_ACCESS_TOKEN to pass access token to the driver
-
-            params = urllib.parse.quote_plus(connection_string)
-            engine = create_engine("mssql+pyodbc:///?odbc_connect={0}".format(params), connect_args={'attrs_before': attrs_before}, echo=False)
-
-            st.session_state['CustomEngine'] = engine
-            st.session_state['sqlEndpoint'] = sql_endpoint
-            st.session_state['sqlDB'] = database
-
-    return st.session_state['CustomEngine']
+    return get_fabric_engine(sql_endpoint, database, st.session_state['credential'], echo=False)
 
 # Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 1 sec (10 min=ttl=600).
-# @st.cache_data(ttl=10)
-def Select_query_exp(server, database, query):
-    if st.session_state['credential'] is None:
-        st.error("Please get the token first.")
-        return pd.DataFrame()
-    else:
-        engine = init_connection(server, database)
-        with engine.connect() as connection:
-            result = pd.read_sql_query(query, connection.connection)
-            return result
+# Uses the shared query cache (shared/query_cache.py), statements other than selects are never cached and invalidate the tables they write to.
+# The pyarrow.Table is fetched in column batches, st.dataframe renders it without converting it to pandas.
+# Runs as job on the shared query pool (shared/query_executor.py), so a slow endpoint doesn't freeze the page.
+# Registers the cursor with the job, so the query is cancelled on the endpoint on timeout or when the user clicks Cancel.
+@timed('select_query', page='ShowFabricSqlEndpointForm')
+def Select_query_exp_job(job, engine, query):
+    return cached_select(engine, query, lambda: fetch_arrow(engine, query, on_cursor=job.set_cursor))
+
+# Runs the query and yields the rows in batches as they arrive, see stream_arrow in shared/arrow_fetch.py
+def Stream_query_exp(server, database, query):
+    engine = init_connection(server, database)
+    return stream_arrow(engine, query)
+
+# Shows the combined result of a fan-out query and how every database did
+def show_fan_out_result(result):
+    combined, summary = result
+    st.dataframe(combined)
+    st.write('Per database:')
+    st.dataframe(pd.DataFrame(summary), hide_index=True)
+    for failed in (s for s in summary if s['error']):
+        st.error(f"{failed['source']}: {failed['error']}")
+
+# Shows the streamed batches collected so far with the time to first row
+def show_stream_result(status, table):
+    import pyarrow as pa  # only needed once a query was streamed
+    batches = st.session_state['stream_batches']
+    if not batches:
+        status.caption("No rows returned yet." if not st.session_state['stream_done'] else "Query returned no rows.")
+        return
+    result = pa.concat_tables(batches, promote_options='permissive')
+    state = "done" if st.session_state['stream_done'] else "running" if st.session_state['stream_running'] else "stopped early"
+    status.caption(f"{result.num_rows} rows ({state}), first rows after {st.session_state['stream_first_row']:.2f}s, {st.session_state['stream_elapsed']:.2f}s in total")
+    table.dataframe(result)
 
 ################################################ Page code Starts here ################################################
 
@@ -82,7 +82,7 @@ with st.expander("Jeffrey's Notes"):
                 - Fabric data warehoues and lakehouses are optimized for crunching big analytics workloads with its distributed compute architecture. 
                 It is less ideal to use for transactional workloads such as fetching and updating individual rows. Such use case are better served with a traditional database such as Azure SQL db for the best performance.
                 - From an architectural perspective modifying the data directly in a data warehouse might not be the best practice as audit trails and data governance might be compromised.
-                - I'm using streamlit's caching feature to reduce query latency. If data is not current, you can uncomment the caching decorators (st.cache_resource and st.cache_data).''')
+                - Query results are cached for a few minutes to reduce query latency (shared/query_cache.py). Changes made through this app show up immediately, changes made elsewhere once the cache expires.''')
 
 if st.button('Login'):
     get_token()
@@ -93,6 +93,46 @@ database = st.text_input('Database (e.g. name of the Fabric Warehouse item)', ke
 # table = st.text_input('Table Name', key='TABLE_NAME', value='Address')
 query = st.text_input('Query (Fabric is case sensitive)', key='QUERY', value=f'select top (1000) * from sys.tables;')
 
-df = Select_query_exp(server, database, query)
-st.dataframe(df)
+# Fan-out runs the query on several databases behind the same endpoint at once (e.g. sys.tables of every warehouse and lakehouse)
+# and combines the results with a source column, see shared/fan_out.py
+fan_out_mode = st.toggle('Run on several databases', key='FAN_OUT')
+if fan_out_mode:
+    databases_text = st.text_area('Databases (one per line)', key='DATABASES', value=database)
+
+# Streaming shows the rows while they arrive and lets you stop a long scan early, instead of waiting for the full result
+stream = st.toggle('Stream results (single database)', key='STREAM')
+if st.session_state['credential'] is None:
+    st.error("Please get the token first.")
+elif fan_out_mode:
+    databases = list(dict.fromkeys(d.strip() for d in databases_text.splitlines() if d.strip()))
+    engines = {db: init_connection(server, db) for db in databases}
+    show_job('fan_out_job', (server, tuple(databases), query), fan_out, show_fan_out_result, engines, query,
+             timeout=QUERY_TIMEOUT, description=f"Query on {len(databases)} databases")
+elif not stream:
+    # shows a placeholder while the query runs and the table once it arrived, typing another query cancels the running one
+    show_job('explorer_job', (server, database, query), Select_query_exp_job, st.dataframe,
+             init_connection(server, database), query, timeout=QUERY_TIMEOUT)
+else:
+    if 'stream_batches' not in st.session_state:
+        st.session_state.update(stream_batches=[], stream_done=False, stream_running=False, stream_first_row=0.0, stream_start=0.0, stream_elapsed=0.0)
+    col1, col2 = st.columns(2)
+    with col1:
+        run = st.button('Run query', type="primary")
+    with col2:
+        # clicking any widget reruns the page, which interrupts the running query and keeps the rows received so far
+        st.button('Stop')
+    status = st.empty()
+    table = st.empty()
+    if run:
+        st.session_state.update(stream_batches=[], stream_done=False, stream_running=True, stream_start=time.perf_counter())
+        with closing(Stream_query_exp(server, database, query)) as batches:
+            for batch in batches:
+                if not st.session_state['stream_batches']:
+                    st.session_state['stream_first_row'] = time.perf_counter() - st.session_state['stream_start']
+                st.session_state['stream_batches'].append(batch)
+                st.session_state['stream_elapsed'] = time.perf_counter() - st.session_state['stream_start']
+                show_stream_result(status, table)
+        st.session_state.update(stream_done=True, stream_running=False, stream_elapsed=time.perf_counter() - st.session_state['stream_start'])
+    st.session_state['stream_running'] = False
+    show_stream_result(status, table)
 
@@ -1,4 +1,9 @@
+import os
 import streamlit as st
+import pandas as pd
+# runs every page through run_page to report its first run (see shared/startup.py)
+from shared.startup import run_page, warm_up, startup_report
+from shared.metrics import snapshot, prometheus_text, reset as reset_metrics
 #Icons
 #https://mui.com/material-ui/material-icons/
 
@@ -13,12 +18,41 @@ ShowFabricSqlEndpointForm = st.Page("ShowFabricSqlEndpointForm.py", title="Explo
 
 pg = st.navigation({
     "Azure SQL DB" : [ShowSqlTbl, InsertSqlTable, DataEditAzureSql],
-    "Microsoft Fabric" : [ShowTblFabSqlEpt, DataEditFabWH, DataEditFabLH]
+    "Microsoft Fabric" : [ShowTblFabSqlEpt, ShowFabricSqlEndpointForm, DataEditFabWH, DataEditFabLH]
     })
 st.set_page_config(page_title="Streamlit CRUD UI - Azure SQL - Microsoft Fabric", page_icon=":material/edit:")
-pg.run()
+
+# Optionally import the heavy modules (deltalake, azure, pyodbc...) in the background at server start, so the first page doesn't wait for them
+if os.environ.get("APP_WARM_UP") == "1":
+    warm_up()
+
+# The sidebar reports are rendered before the page runs, as nothing renders after a page calls st.stop().
+# They show the state up to the previous run.
+# How long the first run of every page took, and how much of it waited for queries and I/O
+with st.sidebar.expander("Startup report"):
+    pages, warmed_up = startup_report()
+    if pages:
+        st.dataframe(pd.DataFrame(pages).set_index('page'))
+    if warmed_up:
+        st.write("Warm-up imports: " + ", ".join(f"{m} {'...' if s is None else f'{s:.2f}s'}" for m, s in warmed_up.items()))
+
+# Latency, rows and bytes of the queries and I/O of all sessions since server start (or the last reset), see shared/metrics.py
+with st.sidebar.expander("Metrics"):
+    timers, counters = snapshot()
+    if timers:
+        st.dataframe(pd.DataFrame(timers).set_index('name'))
+    if counters:
+        st.dataframe(pd.DataFrame(counters).set_index('name'))
+    st.download_button("Export (Prometheus)", prometheus_text(), file_name="metrics.prom", mime="text/plain")
+    st.button("Reset metrics", on_click=reset_metrics)
+
+run_page(pg)
 
 
 # To run our demo
 #pip install -r requirements.txt
-# python -m streamlit run main.py
\ No newline at end of file
+# python -m streamlit run main.py
+# or, to import the heavy modules in the background at server start:
+# APP_WARM_UP=1 python -m streamlit run main.py
+# or, to print the import time of every module:
+# python -X importtime -m streamlit run main.py
\ No newline at end of file
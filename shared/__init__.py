@@ -0,0 +1,3 @@
+# Helpers shared by the streamlit pages in the project root.
+# Modules in here are imported once per streamlit server process, so any state they keep (engines, caches, executors)
+# is shared by every page and every user session, unlike st.session_state which is per browser tab.
@@ -0,0 +1,121 @@
+# Columnar query results as a pyarrow.Table.
+# pd.read_sql_query lets pyodbc materialise every row as a python tuple before pandas rebuilds the columns from them,
+# which dominates CPU and memory on wide results. Here the rows are fetched in batches and each batch is turned into
+# arrow arrays straight away, so only one batch of python objects is alive at a time. st.dataframe renders a
+# pyarrow.Table directly, call .to_pandas() on it only where a DataFrame is really needed.
+# pyarrow is imported by the functions using it, so importing this module doesn't load it (see shared/startup.py).
+
+import datetime
+import decimal
+
+from shared.connections import connect
+from shared.startup import waiting
+
+BATCH_SIZE = 10000  # rows fetched and converted at a time
+FIRST_BATCH_SIZE = 100  # rows in the first batch when streaming, so the first rows show up as soon as possible
+
+
+def _arrow_type(description):
+    # maps the python type pyodbc reports in cursor.description to an arrow type, None lets arrow infer it
+    import pyarrow as pa
+
+    name, type_code, display_size, internal_size, precision, scale, null_ok = description
+    if type_code is bool:
+        return pa.bool_()
+    if type_code is int:
+        return pa.int64()
+    if type_code is float:
+        return pa.float64()
+    if type_code is str:
+        return pa.string()
+    if type_code is decimal.Decimal and precision:
+        return pa.decimal128(precision, scale or 0)
+    if type_code is datetime.datetime:
+        return pa.timestamp('us')
+    if type_code is datetime.date:
+        return pa.date32()
+    if type_code is datetime.time:
+        return pa.time64('us')
+    if type_code in (bytes, bytearray):
+        return pa.binary()
+    return None
+
+
+def iter_arrow_batches(cursor, batch_size=BATCH_SIZE, first_batch_size=None):
+    """
+    Yields the result of an executed cursor as pyarrow.Tables of at most batch_size rows.
+    With first_batch_size the batches start at that size and double until they reach batch_size.
+    """
+    import pyarrow as pa
+
+    names = [d[0] for d in cursor.description]
+    types = [_arrow_type(d) for d in cursor.description]
+    size = first_batch_size or batch_size
+    while True:
+        with waiting():  # booked on the page run when streaming on the script thread
+            rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        columns = zip(*rows)
+        yield pa.Table.from_arrays([pa.array(column, type=t) for column, t in zip(columns, types)], names=names)
+        size = min(size * 2, batch_size)
+
+
+def fetch_arrow(engine, query, batch_size=BATCH_SIZE, on_cursor=None):
+    """
+    Runs a query and returns the result as a pyarrow.Table built in column batches.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine to query, e.g. from shared.connections.
+    - query (str): The query to run.
+    - batch_size (int): Number of rows fetched and converted at a time.
+    - on_cursor (callable): Called with the cursor before the query runs, e.g. Job.set_cursor of shared/query_executor.py to be able to cancel it.
+
+    Returns:
+        pyarrow.Table: The query result.
+    """
+    import pyarrow as pa
+
+    with connect(engine) as connection:
+        cursor = connection.connection.cursor()
+        if on_cursor is not None:
+            on_cursor(cursor)
+        try:
+            cursor.execute(query)
+            if cursor.description is None:
+                return pa.table({})  # statement without a result set
+            batches = list(iter_arrow_batches(cursor, batch_size))
+            if not batches:
+                return pa.Table.from_arrays([pa.array([], type=_arrow_type(d) or pa.null()) for d in cursor.description],
+                                            names=[d[0] for d in cursor.description])
+            # columns arrow had to infer can differ per batch (e.g. all NULL in one of them), permissive unifies them
+            return pa.concat_tables(batches, promote_options='permissive')
+        finally:
+            cursor.close()
+
+
+def stream_arrow(engine, query, batch_size=BATCH_SIZE, first_batch_size=FIRST_BATCH_SIZE):
+    """
+    Runs a query and yields the result as pyarrow.Tables while the rows arrive, starting with a small batch.
+    The connection is held until the generator is exhausted or closed. Closing it early (e.g. with contextlib.closing
+    when streamlit interrupts the script run) cancels the query on the server instead of reading the remaining rows.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine to query, e.g. from shared.connections.
+    - query (str): The query to run.
+    - batch_size (int): Maximum number of rows per batch.
+    - first_batch_size (int): Number of rows in the first batch, the following batches double in size.
+    """
+    with connect(engine) as connection:
+        cursor = connection.connection.cursor()
+        finished = False
+        try:
+            with waiting():
+                cursor.execute(query)
+            if cursor.description is not None:
+                yield from iter_arrow_batches(cursor, batch_size, first_batch_size)
+            finished = True
+        finally:
+            if not finished and hasattr(cursor, 'cancel'):
+                cursor.cancel()  # pyodbc: stop the statement on the server
+            cursor.close()
@@ -0,0 +1,122 @@
+# Bulk insert of a pandas DataFrame into a SQL Server table.
+# df.to_sql with the default method sends one INSERT per row. The modes here send the rows in large chunks instead:
+# - fast_executemany: pyodbc binds a whole chunk of rows as parameter arrays and sends them in one round trip
+# - tvp: the rows are passed as one table-valued parameter and inserted with INSERT ... SELECT (needs a table type)
+# - multi: pandas' multi-row INSERT ... VALUES, for drivers without fast_executemany. Every value is a parameter and
+#   SQL Server allows at most 2100 parameters per statement, so the chunk size is derived from the number of columns.
+# https://stackoverflow.com/questions/63523711/inserting-data-to-sql-server-from-a-python-dataframe-quickly
+
+import functools
+import time
+
+from shared.connections import connect
+from shared.query_cache import invalidate
+from shared.sql_writer import quote_name
+
+MAX_PARAMETERS = 2100           # SQL Server limit of parameters per statement
+MAX_VALUES_ROWS = 1000          # SQL Server limit of rows in one VALUES clause
+FAST_EXECUTEMANY_CHUNK = 10000  # rows per parameter array, bounds the memory pyodbc allocates for it
+TVP_CHUNK = 50000               # rows per table-valued parameter
+MODES = ('fast_executemany', 'tvp', 'multi')
+
+
+def auto_chunksize(mode, num_columns):
+    """
+    Returns the number of rows to send per statement for the given mode and number of columns.
+    """
+    if mode == 'multi':
+        # keep one parameter spare, pandas/pyodbc may bind one extra for the statement itself,
+        # and a VALUES clause takes at most 1000 rows however few columns there are
+        return max(1, min(MAX_VALUES_ROWS, (MAX_PARAMETERS - 1) // max(1, num_columns)))
+    if mode == 'tvp':
+        return TVP_CHUNK
+    return FAST_EXECUTEMANY_CHUNK
+
+
+def _fast_executemany(pd_table, conn, keys, data_iter, on_cursor=None):
+    # to_sql insert method using pyodbc's fast_executemany on the connection to_sql is writing with
+    cursor = conn.connection.cursor()
+    if on_cursor is not None:
+        on_cursor(cursor)
+    if hasattr(cursor, 'fast_executemany'):
+        cursor.fast_executemany = True
+    try:
+        columns = ", ".join(quote_name(k) for k in keys)
+        placeholders = ", ".join("?" for _ in keys)
+        sql = f"INSERT INTO {quote_name(pd_table.schema or 'dbo')}.{quote_name(pd_table.name)} ({columns}) VALUES ({placeholders})"
+        data = list(data_iter)
+        cursor.executemany(sql, data)
+        return len(data)
+    finally:
+        cursor.close()
+
+
+def table_type_ddl(schema, type_name, sql_types):
+    """
+    Returns the statement creating the table type used by the tvp mode, if it doesn't exist yet.
+    """
+    columns = ", ".join(f"{quote_name(c)} {t}" for c, t in sql_types.items())
+    return (f"IF TYPE_ID('{schema}.{type_name}') IS NULL "
+            f"EXEC('CREATE TYPE {quote_name(schema)}.{quote_name(type_name)} AS TABLE ({columns})')")
+
+
+def _insert_tvp(conn, df, schema, table, type_name, chunksize, on_cursor=None):
+    cursor = conn.connection.cursor()
+    if on_cursor is not None:
+        on_cursor(cursor)
+    try:
+        columns = ", ".join(quote_name(c) for c in df.columns)
+        sql = f"INSERT INTO {quote_name(schema)}.{quote_name(table)} ({columns}) SELECT {columns} FROM ?"
+        # plain python values, NaN/NaT become NULL
+        values = df.astype(object).where(df.notna(), None)
+        rows = list(values.itertuples(index=False, name=None))
+        for i in range(0, len(rows), chunksize):
+            # outside of a stored procedure pyodbc needs the table type name and schema in front of the rows
+            cursor.execute(sql, [[type_name, schema] + rows[i:i + chunksize]])
+    finally:
+        cursor.close()
+
+
+def bulk_insert(engine, df, schema, table, mode='fast_executemany', chunksize=None, sql_types=None, type_name=None, on_cursor=None):
+    """
+    Appends a DataFrame to a table in one transaction.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine to write with, e.g. from shared.connections.
+    - df (pandas.DataFrame): The rows to insert, the column names must match the table.
+    - schema (str): The schema of the table.
+    - table (str): The name of the table.
+    - mode (str): 'fast_executemany', 'tvp' or 'multi', see the top of this file.
+    - chunksize (int): Rows per statement, picked from the mode and number of columns when not given.
+    - sql_types (dict): SQL type per column, only for the tvp mode to create the table type if it doesn't exist.
+    - type_name (str): Name of the table type for the tvp mode, defaults to <table>_tvp.
+    - on_cursor (callable): Called with the cursor the rows are sent on, e.g. Job.set_cursor of shared/query_executor.py
+      to be able to cancel the insert. The multi mode inserts through pandas without a cursor of its own and can't be cancelled.
+
+    Returns:
+        dict: The mode, rows inserted, chunk size used, seconds taken and rows per second.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}, got {mode!r}")
+    chunksize = chunksize or auto_chunksize(mode, len(df.columns))
+
+    start = time.perf_counter()
+    if len(df):
+        with connect(engine, begin=True) as conn:
+            if mode == 'tvp':
+                type_name = type_name or f"{table}_tvp"
+                if sql_types:
+                    conn.exec_driver_sql(table_type_ddl(schema, type_name, sql_types))
+                _insert_tvp(conn, df, schema, table, type_name, chunksize, on_cursor)
+            else:
+                method = functools.partial(_fast_executemany, on_cursor=on_cursor) if mode == 'fast_executemany' else 'multi'
+                df.to_sql(table, con=conn, schema=schema, if_exists='append', index=False, method=method, chunksize=chunksize)
+        invalidate(engine, tables=[f"{schema}.{table}"])
+    seconds = time.perf_counter() - start
+    return {
+        'mode': mode,
+        'rows': len(df),
+        'chunksize': chunksize,
+        'seconds': seconds,
+        'rows_per_sec': len(df) / seconds if seconds > 0 else 0.0,
+    }
@@ -0,0 +1,212 @@
+# Process-wide registry of pooled SQLAlchemy engines.
+# Streamlit reruns a page from top to bottom on every interaction, so creating the engine inside the page means a new
+# ODBC login and TLS handshake on every click. Engines created here live for the lifetime of the server process and are
+# keyed by server, database and identity, so all pages (and all users logging in with the same identity) reuse the
+# same warm connection pool. Pages asking for other engine options (echo, pool sizes) get an engine of their own.
+
+import threading
+import weakref
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+
+from shared.tokens import SQL_SCOPE, SQL_COPT_SS_ACCESS_TOKEN, get_token_cache, pack_token, token_identity
+
+# Pool defaults. With 50+ concurrent users most page runs only hold a connection for the duration of a single query,
+# so a small pool with some overflow serves them without opening hundreds of connections.
+POOL_SIZE = 5               # connections kept open per engine
+MAX_OVERFLOW = 10           # extra connections allowed during bursts, closed again when returned
+POOL_TIMEOUT = 30           # seconds to wait for a free connection before giving up
+POOL_RECYCLE = 1800         # seconds before an idle connection is replaced (Azure SQL drops idle connections after ~30 min)
+SESSION_CHECKOUT_LIMIT = 2  # connections a single streamlit session may hold of one engine at the same time
+
+_engines = {}  # (server, database, identity, echo, pool options) -> engine
+_engine_keys = {}  # engine -> (server, database, identity) it is registered under
+_fabric_credentials = {}  # (server, database, identity) -> credentials of the sessions logged in as identity, see fabric_connection_creator
+_engines_lock = threading.Lock()
+
+# one semaphore per streamlit session and engine, released automatically once nothing references it anymore
+_session_slots = weakref.WeakValueDictionary()
+_session_slots_lock = threading.Lock()
+_bound_session = threading.local()  # session the current thread works for, see session_scope
+
+
+def engine_key(server, database, identity):
+    """
+    Builds the key an engine is registered under. Server and database names are case insensitive in SQL Server.
+    """
+    return (server.lower(), database.lower(), identity)
+
+
+def get_engine(server, database, identity, url=None, creator=None, echo=False, **pool_options):
+    """
+    Returns the shared engine for server/database/identity, creating it on first use.
+
+    Parameters:
+    - server (str): The server or sql endpoint the engine connects to.
+    - database (str): The database the engine connects to.
+    - identity (str): The login/user the connections are opened as. Connections are never shared across identities.
+    - url (str or sqlalchemy.engine.URL): The connection url used to create the engine.
+    - creator (callable): Optional function returning a new DBAPI connection, used instead of the url to open connections.
+    - echo (bool): Log all statements issued by the engine.
+    - pool_options: Overrides for pool_size, max_overflow, pool_timeout and pool_recycle.
+    Callers asking for the same server, database and identity with other echo or pool_options get a separate engine.
+    The creator is only used when the engine is created.
+
+    Returns:
+        engine (sqlalchemy.engine.Engine): The pooled engine.
+    """
+    key = engine_key(server, database, identity) + (bool(echo), tuple(sorted(pool_options.items())))
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        # another session might have created it while we waited for the lock
+        if key not in _engines:
+            options = {
+                'pool_size': POOL_SIZE,
+                'max_overflow': MAX_OVERFLOW,
+                'pool_timeout': POOL_TIMEOUT,
+                'pool_recycle': POOL_RECYCLE,
+            }
+            options.update(pool_options)
+            if creator is not None:
+                options['creator'] = creator
+                url = url or "mssql+pyodbc://"
+            engine = create_engine(
+                url,
+                echo=echo,
+                pool_pre_ping=True,  # validate connections on checkout so a dropped connection never reaches a query
+                pool_use_lifo=True,  # reuse the most recent connection so surplus idle ones age out and get recycled
+                **options
+            )
+            _engines[key] = engine
+            _engine_keys[engine] = key[:3]
+        return _engines[key]
+
+
+def registry_key(engine):
+    """
+    Returns the (server, database, identity) key an engine from get_engine is registered under.
+    """
+    return _engine_keys[engine]
+
+
+def get_sql_login_engine(server, database, username, password, driver, echo=False):
+    """
+    Returns the shared engine for an Azure SQL Database using SQL authentication (the details from .streamlit/secrets.toml).
+    """
+    url = URL.create(
+        "mssql+pyodbc",
+        username=username,
+        password=password,
+        host=server,
+        database=database,
+        query={'driver': driver},
+    )
+    return get_engine(server, database, username, url=url, echo=echo)
+
+
+def fabric_connection_creator(connection_string, credentials):
+    """
+    Returns a function that opens a new pyodbc connection with a fresh access token from the token cache of one of the
+    credentials. Used as the engine's creator, so connections opened after the first token expired still get a valid token.
+    credentials is a weakref.WeakSet of the credentials of the sessions logged in as the engine's identity, so the
+    engine doesn't keep the credential of the session that created it alive after that session ended.
+    """
+    def creator():
+        import pyodbc
+        logged_in = list(credentials)
+        if not logged_in:
+            raise RuntimeError("No session is logged in as this identity anymore, please login again.")
+        attrs_before = {SQL_COPT_SS_ACCESS_TOKEN: pack_token(get_token_cache(logged_in[0], SQL_SCOPE).get())}
+        return pyodbc.connect(connection_string, attrs_before=attrs_before)
+
+    return creator
+
+
+def get_fabric_engine(sql_endpoint, database, credential, echo=False):
+    """
+    Returns the shared engine for a Fabric sql endpoint (warehouse or lakehouse) authenticated with an Entra credential.
+
+    Parameters:
+    - sql_endpoint (str): The sql endpoint of the workspace, e.g. xxx.datawarehouse.fabric.microsoft.com
+    - database (str): The warehouse or lakehouse name.
+    - credential: An azure.identity credential, e.g. InteractiveBrowserCredential.
+    - echo (bool): Log all statements issued by the engine.
+
+    Returns:
+        engine (sqlalchemy.engine.Engine): The pooled engine.
+    """
+    # cached token, so this does not call the credential on every rerun
+    # a token that can't be decoded is kept apart per credential object, which stays the same across token refreshes
+    identity = token_identity(get_token_cache(credential, SQL_SCOPE).get(), fallback=f"credential-{id(credential)}")
+    connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server={sql_endpoint},1433;Database={database};Encrypt=Yes;TrustServerCertificate=No"
+    with _engines_lock:
+        credentials = _fabric_credentials.setdefault(engine_key(sql_endpoint, database, identity), weakref.WeakSet())
+        credentials.add(credential)
+    return get_engine(sql_endpoint, database, identity, creator=fabric_connection_creator(connection_string, credentials), echo=echo)
+
+
+def current_session_id():
+    """
+    Returns the id of the streamlit session the calling thread works for: the session bound with session_scope, or else
+    the session of the script run. None for background threads (e.g. the write-behind queue) and plain python.
+    """
+    session_id = getattr(_bound_session, 'id', None)
+    if session_id is not None:
+        return session_id
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+    except ImportError:
+        ctx = None
+    return ctx.session_id if ctx is not None else None
+
+
+@contextmanager
+def session_scope(session_id):
+    """
+    Counts the connections the calling thread checks out against session_id, for work a session hands to another
+    thread (e.g. the jobs of shared/query_executor.py), which has no script run to take the session from.
+    """
+    previous = getattr(_bound_session, 'id', None)
+    _bound_session.id = session_id
+    try:
+        yield
+    finally:
+        _bound_session.id = previous
+
+
+def _session_slot(session_id, engine):
+    with _session_slots_lock:
+        slot = _session_slots.get((session_id, id(engine)))
+        if slot is None:
+            slot = threading.BoundedSemaphore(SESSION_CHECKOUT_LIMIT)
+            _session_slots[(session_id, id(engine))] = slot
+        return slot
+
+
+@contextmanager
+def connect(engine, begin=False):
+    """
+    Checks out a connection from a shared engine while enforcing the per session checkout limit,
+    so a single session can't drain the pool that is shared with all other users. The limit applies per engine, as
+    every engine has a pool of its own, and also to the threads a session's work runs on (see session_scope).
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): An engine returned by get_engine.
+    - begin (bool): Wrap the connection in a transaction that is committed on success and rolled back on error.
+    """
+    session_id = current_session_id()
+    slot = _session_slot(session_id, engine) if session_id is not None else None
+    if slot is not None and not slot.acquire(timeout=POOL_TIMEOUT):
+        raise TimeoutError(f"Session already holds {SESSION_CHECKOUT_LIMIT} connections of this engine, timed out waiting for one to be returned.")
+    try:
+        with (engine.begin() if begin else engine.connect()) as connection:
+            yield connection
+    finally:
+        if slot is not None:
+            slot.release()
@@ -0,0 +1,168 @@
+# Process-wide cache of Delta tables loaded into pandas, keyed by table URI, identity and Delta version.
+# The DeltaTable of each table is kept open, so on a rerun only the log entries committed since the last load are read
+# (update_incremental) to find the current version. As long as the version is unchanged the loaded frame is served from
+# memory and no Parquet file is downloaded. Any commit to the table, from this app or elsewhere, gives a new version and
+# with it a fresh load. Columns and filters are passed down to the Parquet scan, so a load only reads the columns asked
+# for and skips the files whose partition values or statistics can't match the filters.
+# table_info answers whether a table exists and its version, schema and file count from the _delta_log in storage,
+# so pages don't need a sql endpoint (and its delayed metadata sync) to check a table.
+# https://delta-io.github.io/delta-rs/usage/querying-delta-tables/
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from shared import metrics
+from shared.tokens import token_identity
+
+MAX_ENTRIES = 32  # least recently used frames are dropped beyond this
+INFO_TTL = 10  # seconds table_info is served from the cache
+
+_tables = {}  # (table uri, identity) -> {'table': DeltaTable, 'token': token it was opened with, 'lock'}
+_frames = OrderedDict()  # (table uri, identity, version, columns, filters) -> pandas.DataFrame
+_info = {}  # (table uri, identity) -> (info, expires)
+_lock = threading.Lock()
+_log = logging.getLogger(__name__)
+stats = {'hits': 0, 'misses': 0, 'reopens': 0}
+
+
+def _freeze(value):
+    # filters are lists of tuples (or lists of lists of tuples), make them usable as part of a dict key
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _open(table_uri, storage_options):
+    token = storage_options.get('token')
+    # tokens that aren't JWTs share one entry per table, it is reopened whenever it is used with another token
+    key = (table_uri, token_identity(token, fallback='opaque-token') if token else None)
+    with _lock:
+        entry = _tables.setdefault(key, {'table': None, 'token': None, 'lock': threading.Lock()})
+    return key, entry
+
+
+def _current(entry, table_uri, storage_options):
+    # caller holds entry['lock']; returns the DeltaTable at the latest version
+    from deltalake import DeltaTable
+    from deltalake.exceptions import TableNotFoundError
+
+    token = storage_options.get('token')
+    if entry['table'] is not None and entry['token'] == token:
+        try:
+            entry['table'].update_incremental()
+            return entry['table']
+        except (TableNotFoundError, OSError) as e:
+            # the table was deleted (and maybe recreated) or storage wasn't reachable, open it again
+            metrics.count('delta_cache_refresh_errors', error=type(e).__name__)
+        except Exception:
+            # anything else (e.g. a corrupt log or an unsupported protocol) would fail again on a reopen, don't hide it
+            _log.exception("Reading the new log entries of the Delta table %s failed", table_uri)
+            raise
+
+    # first load, or the token was refreshed: the storage options of an open DeltaTable can't be changed
+    stats['reopens'] += 1
+    metrics.count('delta_cache_reopens')
+    entry['table'] = DeltaTable(table_uri, storage_options=storage_options)
+    entry['token'] = token
+    return entry['table']
+
+
+def table_version(table_uri, storage_options):
+    """
+    Returns the current version of a Delta table, only reading the log entries added since the last call.
+    """
+    _, entry = _open(table_uri, storage_options)
+    with entry['lock']:
+        return _current(entry, table_uri, storage_options).version()
+
+
+def table_info(table_uri, storage_options, ttl=INFO_TTL):
+    """
+    Returns the metadata of a Delta table read from its _delta_log, cached for a few seconds.
+
+    Parameters:
+    - table_uri (str): The URI of the Delta table.
+    - storage_options (dict): The storage options for deltalake, e.g. the token.
+    - ttl (int): Seconds the result may be served from the cache.
+
+    Returns:
+        dict: 'exists', and for an existing table its 'version', 'schema' (column name -> type) and 'files' (number of data files).
+    """
+    from deltalake import DeltaTable
+
+    key, entry = _open(table_uri, storage_options)
+    with _lock:
+        cached = _info.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return dict(cached[0])
+
+    if not DeltaTable.is_deltatable(table_uri, storage_options=storage_options):
+        info = {'exists': False}
+    else:
+        with entry['lock']:
+            dt = _current(entry, table_uri, storage_options)
+            info = {
+                'exists': True,
+                'version': dt.version(),
+                # primitive types by name (e.g. long, string), nested types by their description
+                'schema': {field.name: getattr(field.type, 'type', str(field.type)) for field in dt.schema().fields},
+                'files': len(dt.file_uris()),
+            }
+    with _lock:
+        _info[key] = (info, time.monotonic() + ttl)
+    return dict(info)
+
+
+def load_table(table_uri, storage_options, columns=None, filters=None):
+    """
+    Returns a Delta table as pandas DataFrame, from the cache if the table is still at the version it was loaded at.
+
+    Parameters:
+    - table_uri (str): The URI of the Delta table.
+    - storage_options (dict): The storage options for deltalake, e.g. the token.
+    - columns (list): The columns to load, all when not given.
+    - filters (list): Filters in disjunctive normal form, e.g. [('category', '=', 'car')], pushed down to the Parquet scan.
+
+    Returns:
+        (pandas.DataFrame, int): A copy of the loaded rows and the version they were read at.
+    """
+    key, entry = _open(table_uri, storage_options)
+    with entry['lock']:
+        dt = _current(entry, table_uri, storage_options)
+        version = dt.version()
+        frame_key = key + (version, _freeze(columns), _freeze(filters))
+        with _lock:
+            frame = _frames.get(frame_key)
+            if frame is not None:
+                _frames.move_to_end(frame_key)
+                stats['hits'] += 1
+                metrics.count('delta_cache_hits')
+                return frame.copy(), version
+            stats['misses'] += 1
+            metrics.count('delta_cache_misses')
+
+        with metrics.timer('delta_to_pandas') as timing:
+            frame = dt.to_pandas(columns=columns, filters=filters)
+            timing.rows, timing.bytes = metrics.result_size(frame)
+        with _lock:
+            # frames of older versions of the same load are never served again
+            for old in [k for k in _frames if k[:2] == key and k[3:] == frame_key[3:]]:
+                del _frames[old]
+            _frames[frame_key] = frame
+            while len(_frames) > MAX_ENTRIES:
+                _frames.popitem(last=False)
+        return frame.copy(), version
+
+
+def forget_table(table_uri):
+    """
+    Drops the open DeltaTable, the loaded frames and the metadata of a table, e.g. after it was deleted or recreated with new versions.
+    """
+    with _lock:
+        for key in [k for k in _tables if k[0] == table_uri]:
+            del _tables[key]
+            _info.pop(key, None)
+        for key in [k for k in _frames if k[0] == table_uri]:
+            del _frames[key]
@@ -0,0 +1,141 @@
+# Background watcher telling pages when a Delta table reached a version, instead of sleeping in the script thread.
+# A page subscribes to "table reached version N" after a write and checks the subscription on its reruns; one daemon
+# thread per process probes the _delta_log of the tables with pending subscriptions (only the log entries added since
+# the last probe are read, see shared/delta_cache.py). The probe interval starts short and doubles while the version
+# doesn't change, with random jitter so sessions waiting on the same tables don't probe in lockstep. A table is only
+# probed while someone waits for it.
+# A subscription is only reached by a probe made after it was created, never by a version recorded earlier, and every
+# probe records the version it read, also a lower one or none (the table was dropped and recreated or deleted).
+
+import random
+import threading
+import time
+
+from shared import delta_cache
+from shared.delta_cache import table_version
+
+MIN_INTERVAL = 0.5  # seconds between the first probes after a subscription
+MAX_INTERVAL = 30  # upper bound of the backoff
+JITTER = 0.2  # +/- fraction of the interval
+TIMEOUT = 300  # seconds a subscription waits before it is given up
+
+_watched = {}  # table uri -> {'storage_options', 'version', 'interval', 'due', 'subscriptions'}
+_condition = threading.Condition()
+_thread = None
+
+
+class Subscription:
+    """
+    Waits for a table to reach a version, created by subscribe().
+    """
+
+    def __init__(self, table_uri, version, timeout=TIMEOUT):
+        self.table_uri = table_uri
+        self.version = version
+        self.seen_version = None
+        self.created = time.monotonic()
+        self.expires = self.created + timeout
+        self._event = threading.Event()
+
+    @property
+    def reached(self):
+        return self._event.is_set()
+
+    @property
+    def expired(self):
+        return not self.reached and time.monotonic() > self.expires
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the version is reached or the timeout passed, returns whether it was reached.
+        """
+        return self._event.wait(timeout)
+
+    def _reach(self, version):
+        self.seen_version = version
+        self._event.set()
+
+
+def subscribe(table_uri, storage_options, version, timeout=TIMEOUT):
+    """
+    Starts watching a table until it reaches a version.
+
+    Parameters:
+    - table_uri (str): The URI of the Delta table.
+    - storage_options (callable): Returns the current storage options for deltalake. It is called from the watcher
+      thread, so it can't use st.session_state (pass e.g. a function of the credential instead).
+    - version (int): The version to wait for, e.g. the version of a commit made by this session.
+    - timeout (int): Seconds after which the subscription is given up.
+
+    Returns:
+        Subscription: Check .reached on a rerun (or .wait() outside of the script thread).
+    """
+    global _thread
+    subscription = Subscription(table_uri, version, timeout)
+    with _condition:
+        table = _watched.setdefault(table_uri, {'version': None, 'interval': MIN_INTERVAL, 'due': 0, 'subscriptions': []})
+        table['storage_options'] = storage_options
+        # probed right away rather than reached from the recorded version, which may be from before a drop and recreate
+        table['subscriptions'].append(subscription)
+        table['interval'] = MIN_INTERVAL
+        table['due'] = time.monotonic()
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="delta-watcher", daemon=True)
+            _thread.start()
+        _condition.notify()
+    return subscription
+
+
+def forget_table(table_uri):
+    """
+    Forgets the recorded version and the cached DeltaTable of a table (see shared/delta_cache.py), e.g. after it was
+    deleted or recreated, so the next probe reads its log from the start. Pending subscriptions keep waiting.
+    """
+    with _condition:
+        table = _watched.get(table_uri)
+        if table is not None:
+            table['version'] = None
+            table['interval'] = MIN_INTERVAL
+            table['due'] = time.monotonic()
+            _condition.notify()
+    delta_cache.forget_table(table_uri)
+
+
+def _run():
+    while True:
+        with _condition:
+            pending = [(uri, table) for uri, table in _watched.items() if table['subscriptions']]
+            if not pending:
+                _condition.wait()
+                continue
+            uri, table = min(pending, key=lambda item: item[1]['due'])
+            delay = table['due'] - time.monotonic()
+            if delay > 0:
+                _condition.wait(delay)  # woken early by a new subscription
+                continue
+            storage_options = table['storage_options']
+
+        from deltalake.exceptions import TableNotFoundError
+
+        probed = time.monotonic()
+        probe_ok = True
+        try:
+            version = table_version(uri, storage_options())
+        except TableNotFoundError:
+            version = None  # the table doesn't exist (yet)
+        except Exception:
+            probe_ok = False  # e.g. storage wasn't reachable, keep the recorded version and try again later
+
+        with _condition:
+            changed = probe_ok and version != table['version']
+            if changed:
+                table['version'] = version
+            for subscription in list(table['subscriptions']):
+                if probe_ok and version is not None and version >= subscription.version and subscription.created <= probed:
+                    subscription._reach(version)
+                    table['subscriptions'].remove(subscription)
+                elif subscription.expired:
+                    table['subscriptions'].remove(subscription)
+            # a commit often comes with more commits shortly after it, so probe fast again after a change
+            table['interval'] = MIN_INTERVAL if changed else min(MAX_INTERVAL, table['interval'] * 2)
+            table['due'] = time.monotonic() + table['interval'] * random.uniform(1 - JITTER, 1 + JITTER)
@@ -0,0 +1,142 @@
+# Applies the changes of a data editor to a Delta table as one Delta MERGE, instead of overwriting the whole table.
+# The deleted, edited and added rows are stacked into one merge source with an operation column (__op D/U/I) and
+# matched to the table on the key column:
+# - deleted rows: WHEN MATCHED AND __op = 'D' THEN DELETE
+# - edited rows: WHEN MATCHED AND __op = 'U' THEN UPDATE, setting only the edited columns of each row: when rows were
+#   edited in different columns, a boolean __set_<column> per column in the source tells the merge which columns to
+#   take from the source and which to keep (like the staging table of shared/sql_writer.py)
+# - added rows: WHEN NOT MATCHED AND __op = 'I' THEN INSERT
+# The merge only rewrites the Parquet files holding affected rows and writes the new rows to new files, so the bytes
+# uploaded to OneLake and the commit time grow with the size of the change instead of the size of the table. All
+# changes of a submit are one Delta commit: they are applied together or not at all.
+# Added rows without a key get theirs here, after the highest key of the table version the merge reads. If another
+# session commits to the table before the merge, the merge fails with a CommitFailedError instead of committing
+# duplicate keys, so a retry assigns them again against the new version.
+# https://delta-io.github.io/delta-rs/usage/writing/
+
+import time
+
+from shared.metrics import timer
+from shared.staging_frame import new_keys
+
+OPERATION = "__op"  # source column with the operation of each row: D(elete), U(pdate) or I(nsert)
+SET_FLAG = "__set_{}"  # source column telling the merge whether a row's column was edited
+
+
+def _source_part(df, fields, operation, flags):
+    # the rows of one operation as merge source, with all columns of the table (NULL where df hasn't got them)
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    arrays = [table.column(f.name).cast(f.type) if f.name in table.column_names else pa.nulls(table.num_rows, f.type)
+              for f in fields]
+    arrays.append(pa.array([operation] * table.num_rows, type=pa.string()))
+    arrays.extend(pa.array(values, type=pa.bool_()) for values in flags.values())
+    return pa.Table.from_arrays(arrays, names=[f.name for f in fields] + [OPERATION] + [SET_FLAG.format(c) for c in flags])
+
+
+def assign_keys(dt, added_rows, key_column):
+    # fills the empty keys of added_rows after the highest key of the table version dt is at and of the added rows
+    import pyarrow.compute as pc
+
+    missing = added_rows[key_column].isna()
+    if not missing.any():
+        return added_rows
+    highest = pc.max(dt.to_pyarrow_table(columns=[key_column]).column(key_column)).as_py()
+    keys = ([] if highest is None else [highest]) + list(added_rows.loc[~missing, key_column])
+    added_rows = added_rows.copy()
+    added_rows.loc[missing, key_column] = new_keys(keys, int(missing.sum()))
+    return added_rows
+
+
+def apply_changes(table_uri, storage_options, deleted_keys=(), edited_rows=None, added_rows=None, key_column='id', edited_columns=None):
+    """
+    Applies deleted, edited and added rows to a Delta table with one MERGE, so in one Delta commit.
+
+    Parameters:
+    - table_uri (str): The URI of the Delta table.
+    - storage_options (dict): The storage options for deltalake, e.g. the token.
+    - deleted_keys (list): Key values of the rows to delete.
+    - edited_rows (pandas.DataFrame): The full new values of the edited rows, matched to the table on key_column.
+    - added_rows (pandas.DataFrame): The rows to insert, rows with an empty key get a new one (see assign_keys).
+    - key_column (str): The primary key column of the table.
+    - edited_columns (list or dict): The columns the merge sets on the edited rows, all columns when None. A dict
+      key value -> list of columns sets only the columns edited in each row, so a row keeps the values of the columns
+      it wasn't edited in, even if someone else changed them since it was loaded.
+
+    Returns:
+        dict: Rows deleted, updated and appended, the table version after the changes and the seconds taken.
+    """
+    # deltalake and pyarrow are imported on the first write, not when a page imports this module
+    import pandas as pd
+    import pyarrow as pa
+    from deltalake import DeltaTable
+
+    start = time.perf_counter()
+    stats = {'deleted': 0, 'updated': 0, 'appended': 0}
+    dt = DeltaTable(table_uri, storage_options=storage_options)
+    schema = pa.schema(dt.schema().to_arrow())
+    # deleted rows only carry their key, so every column of the source is nullable
+    fields = [pa.field(f.name, f.type, nullable=True) for f in schema]
+    others = [f.name for f in schema if f.name != key_column]
+
+    deleted_keys = list(deleted_keys)
+    if edited_rows is not None and len(edited_rows):
+        # rows that are deleted as well only get the delete
+        edited_rows = edited_rows[~edited_rows[key_column].isin(deleted_keys)]
+    per_row = isinstance(edited_columns, dict)
+    if per_row and edited_rows is not None:
+        edited_rows = edited_rows[edited_rows[key_column].map(lambda key: bool(edited_columns.get(key)))]
+        row_columns = [set(edited_columns[key]) - {key_column} for key in edited_rows[key_column]]
+        columns = list(dict.fromkeys(c for key in edited_rows[key_column] for c in edited_columns[key] if c != key_column))
+        # every row edited in the same columns: a plain update of those columns
+        per_row = any(cs != row_columns[0] for cs in row_columns)
+    else:
+        columns = others if edited_columns is None else [c for c in edited_columns if c != key_column]
+    if edited_rows is None or not columns:
+        edited_rows = None
+
+    flag_columns = columns if per_row else []
+    parts = []
+    if deleted_keys:
+        parts.append(_source_part(pd.DataFrame({key_column: deleted_keys}), fields, 'D', {c: [False] * len(deleted_keys) for c in flag_columns}))
+    if edited_rows is not None and len(edited_rows):
+        parts.append(_source_part(edited_rows, fields, 'U', {c: [c in cs for cs in row_columns] for c in flag_columns}))
+    if added_rows is not None and len(added_rows):
+        added_rows = assign_keys(dt, added_rows, key_column)
+        parts.append(_source_part(added_rows, fields, 'I', {c: [False] * len(added_rows) for c in flag_columns}))
+    if not parts:
+        stats['version'] = dt.version()
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+    source = pa.concat_tables(parts)
+    merger = dt.merge(source=source,
+                      predicate=f"target.{key_column} = source.{key_column}",
+                      source_alias='source',
+                      target_alias='target')
+    if deleted_keys:
+        merger = merger.when_matched_delete(predicate=f"source.{OPERATION} = 'D'")
+    if edited_rows is not None and len(edited_rows):
+        if per_row:
+            updates = {column: f"CASE WHEN source.{SET_FLAG.format(column)} THEN source.{column} ELSE target.{column} END"
+                       for column in columns}
+        else:
+            updates = {column: f"source.{column}" for column in columns}
+        merger = merger.when_matched_update(updates=updates, predicate=f"source.{OPERATION} = 'U'")
+    if added_rows is not None and len(added_rows):
+        merger = merger.when_not_matched_insert(updates={f.name: f"source.{f.name}" for f in schema},
+                                                predicate=f"source.{OPERATION} = 'I'")
+    with timer('delta_write', operation='merge') as timing:
+        metrics = merger.execute()
+        timing.rows, timing.bytes = source.num_rows, source.nbytes
+    stats['deleted'] = metrics.get('num_target_rows_deleted', 0)
+    stats['updated'] = metrics.get('num_target_rows_updated', 0)
+    stats['appended'] = metrics.get('num_target_rows_inserted', 0)
+    if added_rows is not None and stats['appended'] < len(added_rows):
+        # an added row whose key the table already has matched instead of being inserted
+        stats['skipped'] = len(added_rows) - stats['appended']
+
+    stats['version'] = dt.version()
+    stats['seconds'] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,138 @@
+# Keyset pagination for the data editor pages, so large tables can be edited without loading them into every session.
+# Pages are fetched with WHERE key > last key of the previous page ORDER BY key, which stays fast however deep you page
+# (unlike OFFSET). The editor only ever shows one page; when you move to another page its changes are translated to
+# primary keys and kept in session state, and they are shown again when you come back to that page.
+
+import pandas as pd
+import streamlit as st
+
+from shared.connections import connect
+from shared.editor_payload import empty_payload, normalize_payload, payload_to_keys, merge_payloads, count_changes, row_versions
+from shared.sql_writer import quote_name, to_db_value, VERSION_COLUMN
+
+PAGE_SIZE = 100
+
+
+class KeysetPager:
+    """
+    Pages through a table by its primary key and keeps the data editor changes of all visited pages.
+    All state lives in st.session_state under keys starting with name, so the pager can be recreated on every rerun.
+
+    Parameters:
+    - name (str): Prefix for the session state keys, unique per page.
+    - engine (sqlalchemy.engine.Engine): The engine to read the pages with.
+    - schema (str): The schema of the table.
+    - table (str): The name of the table.
+    - columns (list): The columns to show in the editor, must include key_column.
+    - key_column (str): The primary key column the pages are ordered and addressed by.
+    - page_size (int): Number of rows per page.
+    - version_sql (str): Optional SQL expression of the row version (a rowversion column or row_hash_sql of
+      shared/sql_writer.py), fetched as VERSION_COLUMN for optimistic updates and deletes.
+    """
+
+    def __init__(self, name, engine, schema, table, columns, key_column='id', page_size=PAGE_SIZE, version_sql=None):
+        self.name = name
+        self.engine = engine
+        self.table = f"{quote_name(schema)}.{quote_name(table)}"
+        self.columns = columns
+        self.key_column = key_column
+        self.page_size = page_size
+        self.version_sql = version_sql
+        state = st.session_state
+        if f'{name}_page_starts' not in state:
+            state[f'{name}_page_starts'] = [None]  # key after which each visited page starts, None for the first page
+            state[f'{name}_visit'] = 0  # bumped on every page change, gives the editor of every page visit its own key
+            state[f'{name}_pending'] = empty_payload()  # key based changes of the pages visited before
+            state[f'{name}_shown'] = None  # the dataframe shown in the editor, to translate row positions to keys
+            state[f'{name}_has_next'] = False
+
+    @property
+    def editor_key(self):
+        return f"{self.name}_editor_{st.session_state[f'{self.name}_visit']}"
+
+    @property
+    def page_number(self):
+        return len(st.session_state[f'{self.name}_page_starts'])
+
+    @property
+    def has_next(self):
+        return st.session_state[f'{self.name}_has_next']
+
+    def _fetch(self, after_key):
+        columns = ", ".join(quote_name(c) for c in self.columns)
+        if self.version_sql is not None:
+            columns += f", {self.version_sql} AS {quote_name(VERSION_COLUMN)}"
+        key = quote_name(self.key_column)
+        # one row more than the page size tells whether there is a next page
+        if after_key is None:
+            sql, params = f"SELECT TOP ({self.page_size + 1}) {columns} FROM {self.table} ORDER BY {key}", None
+        else:
+            sql, params = f"SELECT TOP ({self.page_size + 1}) {columns} FROM {self.table} WHERE {key} > ? ORDER BY {key}", [after_key]
+        with connect(self.engine) as connection:
+            return pd.read_sql_query(sql, connection.connection, params=params)
+
+    def page(self):
+        """
+        Fetches the current page with the pending changes of earlier visits applied.
+
+        Returns:
+            pandas.DataFrame: The rows to show in the data editor.
+        """
+        state = st.session_state
+        df = self._fetch(state[f'{self.name}_page_starts'][-1])
+        state[f'{self.name}_has_next'] = len(df) > self.page_size
+        df = df.head(self.page_size)
+        # a plain python value, the page starts are bound as query parameters (pyodbc rejects numpy.int64)
+        state[f'{self.name}_last_key'] = to_db_value(df[self.key_column].iloc[-1]) if len(df) else None
+
+        pending = state[f'{self.name}_pending']
+        df = df[~df[self.key_column].isin(pending['deleted_rows'])].reset_index(drop=True)
+        for key, changes in pending['edited_rows'].items():
+            match = df[self.key_column] == key
+            if match.any():
+                for column, value in changes.items():
+                    df.loc[match, column] = value
+        state[f'{self.name}_shown'] = df
+        return df
+
+    def _freeze_current(self):
+        # moves the changes made in the editor of the current page visit into the pending changes
+        state = st.session_state
+        payload = state.get(self.editor_key)
+        shown = state[f'{self.name}_shown']
+        if payload and shown is not None:
+            changes = payload_to_keys(normalize_payload(payload, shown), shown, self.key_column)
+            pending = merge_payloads(state[f'{self.name}_pending'], changes)
+            # the version of the first visit counts, a later visit may already show another user's change
+            versions = pending.setdefault('versions', {})
+            for key, version in row_versions(changes, shown, self.key_column).items():
+                versions.setdefault(key, version)
+        state[f'{self.name}_visit'] += 1
+
+    def next_page(self):
+        """
+        Moves to the next page, to be used as on_click callback.
+        """
+        self._freeze_current()
+        st.session_state[f'{self.name}_page_starts'].append(st.session_state[f'{self.name}_last_key'])
+
+    def previous_page(self):
+        """
+        Moves to the previous page, to be used as on_click callback.
+        """
+        self._freeze_current()
+        if len(st.session_state[f'{self.name}_page_starts']) > 1:
+            st.session_state[f'{self.name}_page_starts'].pop()
+
+    def pending_count(self):
+        return count_changes(st.session_state[f'{self.name}_pending'])
+
+    def collect(self):
+        """
+        Returns the changes of all visited pages (including the current one) keyed by primary key and clears them.
+        With version_sql the versions of the changed rows are under 'versions' (key -> version).
+        """
+        self._freeze_current()
+        pending = st.session_state[f'{self.name}_pending']
+        st.session_state[f'{self.name}_pending'] = empty_payload()
+        return pending
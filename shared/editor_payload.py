@@ -0,0 +1,116 @@
+# Helpers for the payload st.data_editor keeps in session state: {'added_rows': [...], 'edited_rows': {...}, 'deleted_rows': [...]}
+# edited_rows and deleted_rows refer to rows by their position in the dataframe shown in the editor. The helpers here
+# translate them to primary key values, so the changes stay valid independent of which rows the editor was showing.
+# normalize_payload reduces a payload to the changes that really change something, compared to the rows the editor
+# was showing, so a cell set back to its original value or a row edited and then deleted doesn't cause a write.
+
+import datetime
+
+import pandas as pd
+
+from shared.sql_writer import to_db_value, VERSION_COLUMN
+
+
+def empty_payload():
+    return {'added_rows': [], 'edited_rows': {}, 'deleted_rows': []}
+
+
+def _same_value(old, new):
+    old, new = to_db_value(old), to_db_value(new)
+    if old is None or new is None:
+        return old is None and new is None
+    if isinstance(old, datetime.time) and isinstance(new, str):
+        return old.isoformat() == new  # the editor returns times and dates as ISO strings
+    if isinstance(old, datetime.date) and isinstance(new, str):
+        try:
+            return pd.Timestamp(old) == pd.Timestamp(new)
+        except (TypeError, ValueError):
+            return False
+    try:
+        return bool(old == new)
+    except (TypeError, ValueError):
+        return False
+
+
+def normalize_payload(payload, df):
+    """
+    Reduces an editor payload to the minimal column level changes compared to the dataframe shown in the editor:
+    - edited cells that hold the value the row had when it was loaded are dropped, and rows left without changes
+    - edits of rows that are deleted as well are dropped
+    - added rows without any value (added and left empty) are dropped
+    Rows added and then edited need nothing here, the editor keeps their final values in added_rows.
+
+    Parameters:
+    - payload (dict): The value of the data editor in session state (row positions).
+    - df (pandas.DataFrame): The dataframe that was shown in the data editor.
+
+    Returns:
+        dict: A new payload with the same row positions.
+    """
+    deleted = list(dict.fromkeys(int(row_index) for row_index in payload['deleted_rows']))
+    deleted_set = set(deleted)
+    edited = {}
+    for row_index, changes in payload['edited_rows'].items():
+        row_index = int(row_index)
+        if row_index in deleted_set:
+            continue
+        row = df.iloc[row_index]
+        changes = {column: value for column, value in changes.items()
+                   if column not in row.index or not _same_value(row[column], value)}
+        if changes:
+            edited[row_index] = changes
+    added = [dict(row) for row in payload['added_rows'] if any(to_db_value(value) is not None for value in row.values())]
+    return {'added_rows': added, 'edited_rows': edited, 'deleted_rows': deleted}
+
+
+def payload_to_keys(payload, df, key_column='id'):
+    """
+    Translates the row positions in an editor payload to the primary key values of those rows.
+
+    Parameters:
+    - payload (dict): The value of the data editor in session state.
+    - df (pandas.DataFrame): The dataframe that was shown in the data editor.
+    - key_column (str): The primary key column of the dataframe.
+
+    Returns:
+        dict: The same payload, with edited_rows keyed by and deleted_rows listing primary key values.
+    """
+    keys = df[key_column]
+    return {
+        'added_rows': list(payload['added_rows']),
+        'edited_rows': {to_db_value(keys.iloc[int(row_index)]): dict(changes) for row_index, changes in payload['edited_rows'].items()},
+        'deleted_rows': [to_db_value(keys.iloc[int(row_index)]) for row_index in payload['deleted_rows']],
+    }
+
+
+def row_versions(payload, df, key_column='id', version_column=VERSION_COLUMN):
+    """
+    Returns the version the edited and deleted rows of a key based payload had when df was loaded, for the optimistic
+    updates and deletes of BatchWriter (shared/sql_writer.py). Empty when df has no version column.
+
+    Returns:
+        dict: key -> version.
+    """
+    if version_column not in df.columns:
+        return {}
+    keys = set(payload['edited_rows']) | set(payload['deleted_rows'])
+    rows = df[df[key_column].isin(list(keys))]
+    return {to_db_value(key): version for key, version in zip(rows[key_column], rows[version_column])}
+
+
+def merge_payloads(pending, payload):
+    """
+    Merges a key based payload into the pending changes, later edits of the same row win.
+    """
+    for key, changes in payload['edited_rows'].items():
+        pending['edited_rows'].setdefault(key, {}).update(changes)
+    for key in payload['deleted_rows']:
+        pending['edited_rows'].pop(key, None)
+        if key not in pending['deleted_rows']:
+            pending['deleted_rows'].append(key)
+    pending['added_rows'].extend(payload['added_rows'])
+    return pending
+
+
+def count_changes(payload):
+    return len(payload['added_rows']) + len(payload['edited_rows']) + len(payload['deleted_rows'])
@@ -0,0 +1,82 @@
+# Runs the same query on several databases at once and combines the results, e.g. row counts or sys.tables of every
+# warehouse and lakehouse behind one Fabric sql endpoint. Each database is queried on its own pooled engine in
+# parallel, the results are stacked into one pyarrow.Table with a source column, and every database reports its rows,
+# time and error separately, so one failing database doesn't lose the results of the others.
+# The per-database queries run on one process-wide pool of MAX_PARALLEL threads, so concurrent fan-outs of all sessions
+# together query at most MAX_PARALLEL databases at a time. It is a separate pool from shared/query_executor.py: the
+# fan-out itself runs as a job there and waits for its queries, which could deadlock if they queued behind it.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.arrow_fetch import fetch_arrow
+from shared.connections import current_session_id, session_scope
+from shared.query_cache import cached_select
+
+MAX_PARALLEL = 8  # databases queried at the same time, by all fan-outs together
+SOURCE_COLUMN = 'source'
+
+_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL, thread_name_prefix='fan-out')
+
+
+def _query_one(source, job, engine, query, session_id):
+    start = time.perf_counter()
+    if job.done():
+        # the fan-out timed out or was cancelled while this query waited for a thread
+        return None, {SOURCE_COLUMN: source, 'rows': 0, 'seconds': 0.0, 'error': 'not run, the query was cancelled'}
+    on_cursor = job.set_cursor
+    try:
+        with session_scope(session_id):  # counts against the connection limit of the session that ran the fan-out
+            table = cached_select(engine, query, lambda: fetch_arrow(engine, query, on_cursor=on_cursor))
+        return table, {SOURCE_COLUMN: source, 'rows': table.num_rows, 'seconds': time.perf_counter() - start, 'error': None}
+    except Exception as e:
+        return None, {SOURCE_COLUMN: source, 'rows': 0, 'seconds': time.perf_counter() - start, 'error': str(e)}
+
+
+def combine_results(tables):
+    """
+    Stacks the results of several sources into one pyarrow.Table with the source in the first column.
+
+    Parameters:
+    - tables (dict): source -> pyarrow.Table.
+    """
+    import pyarrow as pa  # imported on first use, so the pages importing this module don't load it
+
+    tables = {source: table.add_column(0, SOURCE_COLUMN, pa.array([source] * table.num_rows, type=pa.string()))
+              for source, table in tables.items()}
+    if not tables:
+        return pa.table({SOURCE_COLUMN: pa.array([], type=pa.string())})
+    try:
+        # columns missing in some sources become NULL, types are unified where arrow can (e.g. int32 and int64)
+        return pa.concat_tables(tables.values(), promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # the same column has incompatible types in different sources, fall back to text for the mismatching columns
+        columns = {}
+        for table in tables.values():
+            for field in table.schema:
+                columns.setdefault(field.name, set()).add(field.type)
+        text_columns = {name for name, types in columns.items() if len(types - {pa.null()}) > 1}
+        tables = [table.cast(pa.schema([pa.field(f.name, pa.string() if f.name in text_columns else f.type) for f in table.schema]))
+                  for table in tables.values()]
+        return pa.concat_tables(tables, promote_options='permissive')
+
+
+def fan_out(job, engines, query):
+    """
+    Runs a query on several databases in parallel, as job on the shared query pool (shared/query_executor.py).
+    Every statement's cursor is registered with the job, so cancelling the job cancels the query on all databases,
+    and the queries still waiting for a thread of the fan-out pool don't run.
+
+    Parameters:
+    - job (Job): The job this runs as.
+    - engines (dict): source name (e.g. database) -> engine to query.
+    - query (str): The query to run on every engine.
+
+    Returns:
+        (pyarrow.Table, list): The combined result with a source column, and per source its rows, seconds and error.
+    """
+    session_id = current_session_id()
+    futures = {source: _executor.submit(_query_one, source, job, engine, query, session_id) for source, engine in engines.items()}
+    results = {source: future.result() for source, future in futures.items()}
+    combined = combine_results({source: table for source, (table, _) in results.items() if table is not None})
+    return combined, [summary for _, summary in results.values()]
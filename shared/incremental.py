@@ -0,0 +1,216 @@
+# Incremental refresh of a table that is shown in full on a page.
+# The last loaded frame of each table is kept process-wide together with the version it was synced at. On the next
+# refresh only the rows changed since then are read and applied to the frame, so a refresh costs in proportion to
+# the churn of the table instead of its size. Two ways of finding the changed rows are supported:
+# - change_tracking: SQL Server change tracking, needs CHANGE_TRACKING on the database and table and a primary key
+#   https://learn.microsoft.com/sql/relational-databases/track-changes/about-change-tracking-sql-server
+# - rowversion: a rowversion column on the table. Deletes can't be seen in the changed rows, they are found by reading
+#   the key column of the whole table on every refresh. That read is still proportional to the size of the table (an
+#   index scan of the key only), so for large tables with few changes prefer change tracking.
+# The frames can carry a row version per row (a rowversion column or a hash of the columns, see version_sql), which is
+# read with every changed row, so the editor's optimistic concurrency checks also work on incrementally refreshed rows.
+# At most MAX_SNAPSHOTS frames are kept, the least recently refreshed are dropped beyond that.
+# A table that is dropped, recreated or altered must be loaded in full again, see forget_changed_tables.
+
+import re
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from shared.connections import connect, registry_key
+from shared.query_cache import referenced_tables
+from shared.sql_writer import quote_name, VERSION_COLUMN
+
+MODES = ('change_tracking', 'rowversion')
+MAX_SNAPSHOTS = 16  # kept frames, least recently refreshed are dropped beyond this
+
+_snapshots = OrderedDict()  # (server, database, identity, schema, table, columns, mode, version_sql) -> {'frame', 'version', 'lock'}
+_snapshots_lock = threading.Lock()
+_DDL = re.compile(r'\b(?:create|alter|drop|truncate)\s+table\b', re.IGNORECASE)
+
+
+def _database_ddl(retention_days):
+    return f"""IF NOT EXISTS (SELECT * FROM sys.change_tracking_databases WHERE database_id = DB_ID())
+ALTER DATABASE CURRENT SET CHANGE_TRACKING = ON (CHANGE_RETENTION = {retention_days} DAYS, AUTO_CLEANUP = ON);"""
+
+
+def _primary_key_ddl(schema, table, key_column):
+    return f"ALTER TABLE {quote_name(schema)}.{quote_name(table)} ADD CONSTRAINT {quote_name(f'PK_{table}')} PRIMARY KEY ({quote_name(key_column)});"
+
+
+def _table_ddl(schema, table):
+    return f"""IF NOT EXISTS (SELECT * FROM sys.change_tracking_tables WHERE object_id = OBJECT_ID('{schema}.{table}'))
+ALTER TABLE {quote_name(schema)}.{quote_name(table)} ENABLE CHANGE_TRACKING;"""
+
+
+def change_tracking_ddl(schema, table, key_column='id', retention_days=2):
+    """
+    Returns the statements enabling change tracking for a table, to show them. The table needs a primary key, the
+    statement adding one on key_column is included as a comment. The ALTER DATABASE can't run inside a user
+    transaction, run them with enable_change_tracking.
+    """
+    return (f"-- change tracking needs a primary key, if the table has none:\n-- {_primary_key_ddl(schema, table, key_column)}\n"
+            f"{_database_ddl(retention_days)}\nGO\n{_table_ddl(schema, table)}")
+
+
+def enable_change_tracking(engine, schema, table, key_column='id', retention_days=2):
+    """
+    Enables change tracking for the database and the table: the ALTER DATABASE runs in autocommit mode (it isn't
+    allowed in a transaction, error 226), then the table's change tracking.
+
+    Raises ValueError when the table has no primary key, which change tracking needs. Adding one changes the table's
+    storage and constraints, so it is left to the owner of the table (the message has the statement for key_column).
+    """
+    with connect(engine) as connection:
+        has_key = _scalar(connection, "SELECT OBJECTPROPERTY(OBJECT_ID(?), 'TableHasPrimaryKey')", [f"{schema}.{table}"])
+        if has_key is None:
+            raise ValueError(f"Table {schema}.{table} doesn't exist.")
+        if not has_key:
+            raise ValueError(f"Change tracking needs a primary key and {schema}.{table} has none. "
+                             f"Add one first, e.g. {_primary_key_ddl(schema, table, key_column)}")
+        connection.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql(_database_ddl(retention_days))
+    with connect(engine, begin=True) as connection:
+        connection.exec_driver_sql(_table_ddl(schema, table))
+    forget_table(engine, schema, table)
+
+
+def _scalar(connection, sql, params=()):
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _read(connection, sql, params=None):
+    return pd.read_sql_query(sql, connection.connection, params=params)
+
+
+def _full_load(connection, table, column_list, key, mode, rowversion_column):
+    if mode == 'change_tracking':
+        # version first: changes committed while the table is read are picked up (again) by the next refresh
+        version = _scalar(connection, "SELECT CHANGE_TRACKING_CURRENT_VERSION()")
+        if version is None:
+            raise ValueError("Change tracking is not enabled on this database.")
+        return _read(connection, f"SELECT {column_list} FROM {table} AS t ORDER BY t.{key}"), version
+    version = _scalar(connection, "SELECT MIN_ACTIVE_ROWVERSION()")
+    frame = _read(connection, f"SELECT {column_list} FROM {table} AS t WHERE t.{quote_name(rowversion_column)} < ? ORDER BY t.{key}", [version])
+    return frame, version
+
+
+def _changes(connection, schema, table, column_list, columns, key, key_column, version, mode, rowversion_column):
+    """
+    Returns (upserted rows, deleted keys, new version), or None when the version is too old and a full load is needed.
+    The rowversion mode returns all keys still in the table instead of the deleted keys, which reads the whole key column.
+    column_list selects the columns from the table aliased as t, columns are their names in the result.
+    """
+    if mode == 'change_tracking':
+        min_valid = _scalar(connection, "SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID(?))", [f"{schema}.{table}"])
+        if min_valid is None or version < min_valid:
+            return None  # changes were cleaned up since the last sync
+        new_version = _scalar(connection, "SELECT CHANGE_TRACKING_CURRENT_VERSION()")
+        changes = _read(connection,
+                        f"SELECT ct.{key} AS [__key], {column_list} FROM CHANGETABLE(CHANGES {quote_name(schema)}.{quote_name(table)}, ?) AS ct "
+                        f"LEFT JOIN {quote_name(schema)}.{quote_name(table)} AS t ON t.{key} = ct.{key}", [version])
+        # deleted rows (and rows deleted after they were changed) find no match in the table
+        gone = changes[key_column].isna()
+        return changes.loc[~gone, columns], list(changes.loc[gone, '__key']), new_version
+
+    new_version = _scalar(connection, "SELECT MIN_ACTIVE_ROWVERSION()")
+    rv = quote_name(rowversion_column)
+    upserts = _read(connection, f"SELECT {column_list} FROM {quote_name(schema)}.{quote_name(table)} AS t WHERE t.{rv} >= ? AND t.{rv} < ?",
+                    [version, new_version])
+    keys = _read(connection, f"SELECT {key} FROM {quote_name(schema)}.{quote_name(table)}")[key_column]
+    return upserts, keys, new_version
+
+
+def _apply(frame, upserts, deleted_keys, key_column):
+    if not len(upserts) and not len(deleted_keys):
+        return frame
+    frame = frame[~frame[key_column].isin(deleted_keys) & ~frame[key_column].isin(upserts[key_column])]
+    if len(upserts):
+        try:
+            upserts = upserts.astype(frame.dtypes.to_dict())  # the left join can turn int columns into float
+        except (TypeError, ValueError):
+            pass
+        frame = pd.concat([frame, upserts], ignore_index=True)
+    return frame.sort_values(key_column).reset_index(drop=True)
+
+
+def refresh_table(engine, schema, table, columns, key_column='id', mode='change_tracking', rowversion_column=None, version_sql=None):
+    """
+    Returns the full table, reading only the rows changed since the last refresh of it in this server process.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine to read with, must come from shared.connections.
+    - schema (str): The schema of the table.
+    - table (str): The name of the table.
+    - columns (list): The columns to load, must include key_column.
+    - key_column (str): The primary key column.
+    - mode (str): 'change_tracking' or 'rowversion', see the top of this file.
+    - rowversion_column (str): The rowversion column, only for the rowversion mode.
+    - version_sql (str): SQL expression of the row version over the table aliased as t (e.g. row_hash_sql(columns, 't')
+      of shared/sql_writer.py), read with every row as VERSION_COLUMN for the optimistic concurrency of the writer.
+
+    Returns:
+        (pandas.DataFrame, dict): A copy of the table ordered by key, and how it was refreshed: 'full' or 'incremental' plus the rows changed.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}, got {mode!r}")
+    if mode == 'rowversion' and not rowversion_column:
+        raise ValueError("rowversion_column is required for the rowversion mode.")
+
+    snapshot_key = registry_key(engine) + (schema.lower(), table.lower(), tuple(columns), mode, version_sql)
+    with _snapshots_lock:
+        snapshot = _snapshots.setdefault(snapshot_key, {'frame': None, 'version': None, 'lock': threading.Lock()})
+        _snapshots.move_to_end(snapshot_key)
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)  # a refresh still running on it finishes on its own copy
+
+    full_table = f"{quote_name(schema)}.{quote_name(table)}"
+    column_list = ", ".join(f"t.{quote_name(c)}" for c in columns)
+    if version_sql:
+        column_list += f", {version_sql} AS {quote_name(VERSION_COLUMN)}"
+        columns = list(columns) + [VERSION_COLUMN]
+    key = quote_name(key_column)
+    # one session refreshes at a time, the others wait and get the result instead of reading the same changes
+    with snapshot['lock'], connect(engine) as connection:
+        changes = None
+        if snapshot['frame'] is not None:
+            changes = _changes(connection, schema, table, column_list, columns, key, key_column, snapshot['version'], mode, rowversion_column)
+        if changes is None:
+            snapshot['frame'], snapshot['version'] = _full_load(connection, full_table, column_list, key, mode, rowversion_column)
+            info = {'refresh': 'full', 'rows': len(snapshot['frame'])}
+        else:
+            upserts, deleted, snapshot['version'] = changes
+            if mode == 'rowversion':
+                # the rowversion mode returns all keys still in the table, the deleted ones are those missing from it
+                frame = snapshot['frame']
+                deleted = list(frame.loc[~frame[key_column].isin(deleted), key_column])
+            snapshot['frame'] = _apply(snapshot['frame'], upserts, deleted, key_column)
+            info = {'refresh': 'incremental', 'upserted': len(upserts), 'deleted': len(deleted)}
+        return snapshot['frame'].copy(), info
+
+
+def forget_table(engine, schema, table):
+    """
+    Drops the kept frames of a table, e.g. after it was dropped and recreated, so the next refresh loads it in full.
+    """
+    server, database, identity = registry_key(engine)
+    with _snapshots_lock:
+        for key in [k for k in _snapshots if k[:2] == (server, database) and k[3:5] == (schema.lower(), table.lower())]:
+            del _snapshots[key]
+
+
+def forget_changed_tables(engine, sql):
+    """
+    Drops the kept frames of the tables a batch creates, alters, drops or truncates. Call it after running such a batch,
+    the kept versions don't apply to the new table.
+    """
+    if not _DDL.search(sql):
+        return
+    for name in referenced_tables(sql):
+        schema, table = name.split('.', 1)
+        forget_table(engine, schema, table)
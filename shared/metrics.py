@@ -0,0 +1,173 @@
+# Process-wide timers and counters for the queries and I/O of all pages, to find where the time goes under real load.
+# - timed(name) decorates a function, timer(name) wraps a block: both record the latency in a histogram and the rows
+#   and bytes of the result (DataFrame, pyarrow.Table or anything with a length), and count the calls that raised.
+# - count(name) bumps a counter, e.g. cache hits and misses or retries.
+# The sidebar of main.py shows snapshot() and offers prometheus_text() for download, in the Prometheus text format:
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# Recording is a dict update under a lock, cheap enough to stay on in production.
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # histogram upper bounds in seconds
+PREFIX = 'streamlit_app'
+
+_lock = threading.Lock()
+_timers = {}  # (name, labels) -> {'count', 'sum', 'max', 'buckets', 'rows', 'bytes', 'errors'}
+_counters = {}  # (name, labels) -> value
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def result_size(result):
+    """
+    Returns the rows and bytes of a query result, (None, None) for results without a size.
+    """
+    if hasattr(result, 'num_rows') and hasattr(result, 'nbytes'):  # pyarrow.Table
+        return result.num_rows, result.nbytes
+    if hasattr(result, 'memory_usage'):  # pandas.DataFrame
+        return len(result), int(result.memory_usage(index=False).sum())
+    if isinstance(result, (list, tuple, dict)):
+        return len(result), None
+    return None, None
+
+
+def observe(name, seconds, rows=None, nbytes=None, error=False, **labels):
+    """
+    Records one timed call of name.
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        entry = _timers.get(key)
+        if entry is None:
+            entry = _timers[key] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS), 'rows': 0, 'bytes': 0, 'errors': 0}
+        entry['count'] += 1
+        entry['sum'] += seconds
+        entry['max'] = max(entry['max'], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry['buckets'][i] += 1
+                break
+        entry['rows'] += rows or 0
+        entry['bytes'] += nbytes or 0
+        entry['errors'] += 1 if error else 0
+
+
+def count(name, value=1, **labels):
+    """
+    Adds value to the counter name, e.g. count('query_cache_hits').
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class _Timing:
+    # what a timer block reports besides its duration, set by the block if it knows them
+    rows = None
+    bytes = None
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Times a block, e.g. with timer('delta_write', operation='append') as t: ...; t.rows = len(df)
+    """
+    timing = _Timing()
+    start = time.perf_counter()
+    error = False
+    try:
+        yield timing
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, timing.rows, timing.bytes, error, **labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator recording the latency of every call of a function and the rows and bytes of its result.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels) as timing:
+                result = fn(*args, **kwargs)
+                timing.rows, timing.bytes = result_size(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def _percentile(entry, fraction):
+    # upper bound of the bucket holding the given fraction of the calls
+    target = entry['count'] * fraction
+    seen = 0
+    for bound, n in zip(BUCKETS, entry['buckets']):
+        seen += n
+        if seen >= target:
+            return bound
+    return entry['max']
+
+
+def snapshot():
+    """
+    Returns one dict per timer (calls, errors, mean/p50/p95/max seconds, rows, bytes) and one per counter.
+    """
+    with _lock:
+        timers = [{'name': name, 'labels': ", ".join(f"{k}={v}" for k, v in labels), 'calls': e['count'], 'errors': e['errors'],
+                   'mean_s': e['sum'] / e['count'], 'p50_s': _percentile(e, 0.5), 'p95_s': _percentile(e, 0.95),
+                   'max_s': e['max'], 'rows': e['rows'], 'bytes': e['bytes']}
+                  for (name, labels), e in sorted(_timers.items())]
+        counters = [{'name': name, 'labels': ", ".join(f"{k}={v}" for k, v in labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.items())]
+    return timers, counters
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def prometheus_text():
+    """
+    Returns all timers (as histograms plus rows, bytes and errors counters) and counters in the Prometheus text format.
+    """
+    with _lock:
+        timers = sorted((k, dict(e, buckets=list(e['buckets']))) for k, e in _timers.items())
+        counters = sorted(_counters.items())
+    lines = []
+    for metric in dict.fromkeys(name for (name, _), _ in timers):
+        base = f"{PREFIX}_{metric}"
+        lines += [f"# TYPE {base}_seconds histogram"]
+        for (name, labels), e in timers:
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, n in zip(BUCKETS, e['buckets']):
+                cumulative += n
+                lines.append(f"{base}_seconds_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{base}_seconds_bucket{_format_labels(labels, [('le', '+Inf')])} {e['count']}")
+            lines.append(f"{base}_seconds_sum{_format_labels(labels)} {e['sum']}")
+            lines.append(f"{base}_seconds_count{_format_labels(labels)} {e['count']}")
+        for field in ('rows', 'bytes', 'errors'):
+            lines.append(f"# TYPE {base}_{field}_total counter")
+            lines += [f"{base}_{field}_total{_format_labels(labels)} {e[field]}" for (name, labels), e in timers if name == metric]
+    for metric in dict.fromkeys(name for (name, _), _ in counters):
+        lines.append(f"# TYPE {PREFIX}_{metric}_total counter")
+        lines += [f"{PREFIX}_{metric}_total{_format_labels(labels)} {value}" for (name, labels), value in counters if name == metric]
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
@@ -0,0 +1,252 @@
+# Uploads a local folder (e.g. a Delta table written locally) to OneLake, only sending what changed.
+# - Files whose size and MD5 hash match the remote copy are skipped, so syncing a Delta table again only sends the new
+#   data and log files. The hash is stored as Content-MD5 of the remote file when it is uploaded.
+# - Large files are streamed in blocks that are appended in parallel and committed with one flush, so memory stays at
+#   about one block per running upload whatever the file size.
+# - The number of parallel uploads adapts to the measured throughput: it grows while throughput improves and shrinks
+#   when it drops or uploads fail.
+# The remote side is a backend object: OneLakeBackend wraps an azure-storage-file-datalake FileSystemClient and
+# LocalBackend writes to a local folder, to try and benchmark the uploader offline:
+#   python -m shared.onelake_upload <folder>
+# https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-directory-file-acl-python
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 8 * 1024 * 1024  # bytes per appended block, files up to this size are sent in one request
+MAX_WORKERS = 16  # upper bound of parallel uploads
+START_WORKERS = 4  # parallel uploads to start with
+ADAPT_EVERY = 8  # completed uploads between concurrency adjustments
+
+
+def file_md5(path, block_size=BLOCK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.digest()
+
+
+class LocalBackend:
+    """
+    Backend writing to a folder on the local filesystem, for offline tests and benchmarks.
+
+    Parameters:
+    - root (str): The folder standing in for the OneLake file system.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, path):
+        return os.path.join(self.root, *path.split('/'))
+
+    def properties(self, path):
+        full_path = self._path(path)
+        if not os.path.isfile(full_path):
+            return None
+        return {'size': os.path.getsize(full_path), 'md5': file_md5(full_path)}
+
+    def upload(self, path, data, md5):
+        self.create(path)
+        with open(self._path(path), 'wb') as f:
+            f.write(data)
+
+    def create(self, path):
+        with self._lock:
+            os.makedirs(os.path.dirname(self._path(path)), exist_ok=True)
+        open(self._path(path), 'wb').close()
+
+    def append(self, path, data, offset):
+        with open(self._path(path), 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def flush(self, path, length, md5):
+        with open(self._path(path), 'r+b') as f:
+            f.truncate(length)
+
+    def delete(self, path):
+        os.remove(self._path(path))
+
+
+class OneLakeBackend:
+    """
+    Backend writing to OneLake (or any ADLS Gen2 file system).
+
+    Parameters:
+    - file_system_client (azure.storage.filedatalake.FileSystemClient): The file system (workspace) to write to.
+    """
+
+    def __init__(self, file_system_client):
+        self.file_system_client = file_system_client
+
+    def properties(self, path):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            properties = self.file_system_client.get_file_client(path).get_file_properties()
+        except ResourceNotFoundError:
+            return None
+        md5 = properties.content_settings.content_md5
+        return {'size': properties.size, 'md5': bytes(md5) if md5 else None}
+
+    def upload(self, path, data, md5):
+        from azure.storage.filedatalake import ContentSettings
+        self.file_system_client.get_file_client(path).upload_data(data, overwrite=True, content_settings=ContentSettings(content_md5=md5))
+
+    def create(self, path):
+        self.file_system_client.get_file_client(path).create_file()
+
+    def append(self, path, data, offset):
+        # appends at distinct offsets may run in parallel, the data only becomes visible with the flush
+        self.file_system_client.get_file_client(path).append_data(data, offset=offset, length=len(data))
+
+    def flush(self, path, length, md5):
+        from azure.storage.filedatalake import ContentSettings
+        self.file_system_client.get_file_client(path).flush_data(length, content_settings=ContentSettings(content_md5=md5))
+
+    def delete(self, path):
+        self.file_system_client.get_file_client(path).delete_file()
+
+
+class _AdaptiveLimit:
+    # limits the number of running uploads, adjusting the limit to the throughput of the last ADAPT_EVERY uploads
+    def __init__(self, start, maximum):
+        self.limit = start
+        self.maximum = maximum
+        self.peak = max(start, 1)
+        self._active = 0
+        self._bytes = 0
+        self._done = 0
+        self._window_start = time.perf_counter()
+        self._best = 0.0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._condition:
+            self._active -= 1
+            if exc_type is not None:
+                self.limit = max(1, self.limit // 2)  # back off on failures (e.g. throttling)
+            self._condition.notify()
+
+    def record(self, num_bytes):
+        with self._condition:
+            self._bytes += num_bytes
+            self._done += 1
+            if self._done < ADAPT_EVERY:
+                return
+            throughput = self._bytes / max(time.perf_counter() - self._window_start, 1e-6)
+            if throughput > self._best * 1.1:
+                self.limit = min(self.maximum, self.limit + 1)
+            elif throughput < self._best * 0.8:
+                self.limit = max(1, self.limit - 1)
+            self._best = max(self._best * 0.9, throughput)  # let the best decay, conditions on the network change
+            self.peak = max(self.peak, self.limit)
+            self._bytes = self._done = 0
+            self._window_start = time.perf_counter()
+            self._condition.notify_all()
+
+
+def _unchanged(backend, local_path, remote_path, size):
+    remote = backend.properties(remote_path)
+    # only hash when the size matches, the hash of a file with another size can't match
+    return remote is not None and remote['size'] == size and remote['md5'] == file_md5(local_path)
+
+
+def _upload_small(backend, limit, local_path, remote_path, size):
+    with limit:
+        with open(local_path, 'rb') as f:
+            data = f.read()
+        backend.upload(remote_path, data, hashlib.md5(data).digest())
+    limit.record(size)
+
+
+def _upload_block(backend, limit, local_path, remote_path, offset, length, file_state):
+    with limit:
+        with open(local_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        backend.append(remote_path, data, offset)
+    limit.record(length)
+    with file_state['lock']:
+        file_state['pending'] -= 1
+        last = file_state['pending'] == 0
+    if last:
+        # the last block to finish commits the file
+        backend.flush(remote_path, file_state['size'], file_md5(local_path))
+
+
+def upload_folder(folder_path, backend, destination, max_workers=MAX_WORKERS, block_size=BLOCK_SIZE, skip_unchanged=True):
+    """
+    Uploads all files of a local folder to a destination folder of a backend, skipping files that didn't change.
+
+    Parameters:
+    - folder_path (str): The local folder to upload.
+    - backend (OneLakeBackend or LocalBackend): Where to upload to.
+    - destination (str): The remote folder, e.g. <lakehouse>.Lakehouse/Tables/<table>.
+    - max_workers (int): Upper bound of parallel uploads.
+    - block_size (int): Bytes per block, larger files are streamed in blocks.
+    - skip_unchanged (bool): Skip files whose size and MD5 hash match the remote copy.
+
+    Returns:
+        dict: Files found, uploaded and skipped, bytes sent, seconds taken and the highest concurrency reached.
+    """
+    start = time.perf_counter()
+    files = []
+    for root, dirs, names in os.walk(folder_path):
+        for name in names:
+            local_path = os.path.join(root, name)
+            relative_path = os.path.relpath(local_path, folder_path).replace("\\", "/")
+            files.append((local_path, f"{destination.rstrip('/')}/{relative_path}", os.path.getsize(local_path)))
+    stats = {'files': len(files), 'uploaded': 0, 'skipped': 0, 'bytes': 0}
+    limit = _AdaptiveLimit(min(START_WORKERS, max_workers), max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if skip_unchanged:
+            # the remote properties are checked in parallel as well, one request per file
+            unchanged = list(executor.map(lambda file: _unchanged(backend, *file), files))
+            stats['skipped'] = sum(unchanged)
+            files = [file for file, skip in zip(files, unchanged) if not skip]
+
+        futures = []
+        for local_path, remote_path, size in files:
+            stats['uploaded'] += 1
+            stats['bytes'] += size
+            if size <= block_size:
+                futures.append(executor.submit(_upload_small, backend, limit, local_path, remote_path, size))
+                continue
+            backend.create(remote_path)
+            offsets = range(0, size, block_size)
+            file_state = {'size': size, 'pending': len(offsets), 'lock': threading.Lock()}
+            for offset in offsets:
+                futures.append(executor.submit(_upload_block, backend, limit, local_path, remote_path,
+                                               offset, min(block_size, size - offset), file_state))
+        for future in futures:
+            future.result()  # raises the first failed upload
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['max_concurrency'] = limit.peak
+    return stats
+
+
+if __name__ == '__main__':
+    # offline benchmark: syncs a folder to a temporary local backend twice, the second sync should skip every file
+    import sys
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as target:
+        backend = LocalBackend(target)
+        for attempt in ('first sync', 'second sync'):
+            result = upload_folder(sys.argv[1], backend, 'Tables/benchmark')
+            print(f"{attempt}: {result['uploaded']} uploaded, {result['skipped']} skipped, "
+                  f"{result['bytes'] / 1e6:.1f} MB in {result['seconds']:.2f}s, up to {result['max_concurrency']} parallel uploads")
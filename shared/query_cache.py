@@ -0,0 +1,153 @@
+# Process-wide cache of query results that is invalidated by the writes made through this app.
+# Each entry is keyed by server, database, identity and the normalized query, and remembers which tables the query
+# reads. Writes (execute_sql_command, the data editor and form submits) invalidate exactly the entries reading the
+# tables they wrote to, for every identity, so results can be cached for minutes while users still see their own
+# writes immediately. Changes made outside of this app show up once the entries expire.
+# Every table has a generation that invalidate() increments. cached_select reads the generations of the tables of a
+# query before running it and doesn't store the result if one changed meanwhile, as the result may be from before the
+# write and would otherwise be served until it expires.
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from shared import metrics
+from shared.connections import registry_key
+
+CACHE_TTL = 300  # seconds a result is served from the cache
+MAX_ENTRIES = 256  # least recently used entries are dropped beyond this
+
+_entries = OrderedDict()  # cache key -> (result, tables, expires)
+_tables = {}  # (server, database, table) -> set of cache keys reading from it
+_generations = {}  # (server, database, table) -> number of invalidations, table None for those of the whole database
+_lock = threading.Lock()
+
+_NAME = r'(?:\[[^\]]+\]|"[^"]+"|[\w#@$]+)'
+_TABLE_REFERENCE = re.compile(
+    rf'\b(?:from|join|into|update|table|merge)\s+({_NAME}(?:\s*\.\s*{_NAME}){{0,2}})', re.IGNORECASE)
+_READ_ONLY = re.compile(r'^\s*(?:select|with)\b', re.IGNORECASE)
+_WRITE_KEYWORDS = re.compile(r'\b(?:insert|update|delete|merge|into|create|alter|drop|truncate|exec|execute)\b', re.IGNORECASE)
+
+
+def normalize_query(query):
+    """
+    Collapses whitespace and a trailing semicolon, so formatting differences share one cache entry.
+    The case is kept as Fabric sql endpoints are case sensitive.
+    """
+    return " ".join(query.split()).rstrip(";").strip()
+
+
+def referenced_tables(sql):
+    """
+    Returns the tables a statement references as lower case 'schema.table' names (dbo when no schema is given).
+    """
+    tables = set()
+    for reference in _TABLE_REFERENCE.findall(sql):
+        parts = [p.strip().strip('[]"').lower() for p in reference.split('.')]
+        if parts[-1] in ('select', 'set', 'values'):
+            continue
+        tables.add(f"{parts[-2] if len(parts) > 1 else 'dbo'}.{parts[-1]}")
+    return tables
+
+
+def is_read_only(sql):
+    return bool(_READ_ONLY.match(sql)) and not _WRITE_KEYWORDS.search(sql)
+
+
+def cached_select(engine, query, fetch, ttl=CACHE_TTL):
+    """
+    Returns the result of a query from the cache, running fetch() to get it when it isn't cached or has expired.
+    Statements that aren't plain selects are never cached, they invalidate the tables they write to instead.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine the query runs on, must come from shared.connections.
+    - query (str): The query, used for the cache key and to find the tables it reads.
+    - fetch (callable): Function without arguments that runs the query and returns the result.
+    - ttl (int): Seconds the result may be served from the cache.
+
+    Returns:
+        The result of fetch(), a copy of it when it came from the cache and can be modified (e.g. a DataFrame).
+    """
+    if not is_read_only(query):
+        result = fetch()
+        invalidate(engine, query)
+        return result
+
+    server, database, identity = registry_key(engine)
+    key = (server, database, identity, normalize_query(query))
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[2] > time.monotonic():
+            _entries.move_to_end(key)
+            metrics.count('query_cache_hits')
+            return _copy(entry[0])
+        metrics.count('query_cache_misses')
+        tables = referenced_tables(query)
+        generation = _generation(server, database, tables)
+
+    result = fetch()
+    with _lock:
+        if _generation(server, database, tables) != generation:
+            # a write invalidated the tables while the query ran, the result may not include it
+            metrics.count('query_cache_stale_results')
+            return result
+        _entries[key] = (result, tables, time.monotonic() + ttl)
+        _entries.move_to_end(key)
+        for table in tables:
+            _tables.setdefault((server, database, table), set()).add(key)
+        while len(_entries) > MAX_ENTRIES:
+            _drop(next(iter(_entries)))
+    return _copy(result)
+
+
+def invalidate(engine, sql=None, tables=None):
+    """
+    Drops the cached results of all identities that read from the tables a write touched.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine the write ran on.
+    - sql (str): The write statement(s), the tables are taken from it. If none can be found all results of the database are dropped.
+    - tables (list): The 'schema.table' names written to, instead of sql.
+    """
+    server, database, _ = registry_key(engine)
+    tables = {t.lower() for t in tables} if tables is not None else referenced_tables(sql or "")
+    metrics.count('query_cache_invalidations')
+    with _lock:
+        for table in tables or [None]:
+            _generations[(server, database, table)] = _generations.get((server, database, table), 0) + 1
+        if not tables:
+            keys = [k for k in _entries if k[0] == server and k[1] == database]
+        else:
+            keys = set().union(*(_tables.get((server, database, t), set()) for t in tables))
+        for key in keys:
+            _drop(key)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _tables.clear()
+
+
+def _generation(server, database, tables):
+    # caller holds _lock
+    return tuple(_generations.get((server, database, table), 0) for table in [None, *sorted(tables)])
+
+
+def _drop(key):
+    # caller holds _lock
+    entry = _entries.pop(key, None)
+    if entry is None:
+        return
+    for table in entry[1]:
+        keys = _tables.get((key[0], key[1], table))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _tables[(key[0], key[1], table)]
+
+
+def _copy(result):
+    copy = getattr(result, 'copy', None)
+    return copy() if callable(copy) else result
@@ -0,0 +1,212 @@
+# Thread pool shared by all pages and sessions to run database and OneLake I/O off the script thread.
+# A page submits its query as a job and shows a placeholder while it runs; a fragment polls the job and reruns the page
+# once it finished, so a slow Fabric endpoint no longer freezes the page and widgets stay usable meanwhile.
+# - The pool has MAX_WORKERS threads and accepts at most MAX_PENDING jobs (queued or running) at a time, so a burst of
+#   slow queries can't tie up every server thread or grow an unbounded queue.
+# - Every job has a timeout, counted from submit so time spent queued behind other jobs counts too. A job still queued
+#   at its timeout never starts. Jobs that registered their pyodbc cursor (set_cursor) are cancelled on the server with
+#   cursor.cancel() when the timeout passes or the user clicks Cancel; others are reported as timed out while their
+#   thread finishes.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait
+
+import streamlit as st
+
+from shared.connections import current_session_id, session_scope
+from shared.startup import waiting
+
+MAX_WORKERS = 8  # threads running jobs
+MAX_PENDING = 32  # jobs queued or running, submit raises beyond this
+QUERY_TIMEOUT = 120  # default seconds a job may run
+FAST_WAIT = 0.2  # seconds show_job waits for a new job before showing the placeholder (cached results return in time)
+POLL_INTERVAL = 0.5  # seconds between checks of a running job
+CANCEL_GRACE = 10  # seconds run_with_timeout waits for a timed out job to stop before reporting it as still running
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='query')
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+
+
+class Job:
+    """
+    A function running on the shared pool, created by submit().
+    """
+
+    def __init__(self, description, timeout, session_id=None):
+        self.description = description
+        self.timeout = timeout
+        self.session_id = session_id  # session that submitted the job, its connections count against that session's limit
+        self.future = None
+        self.submitted = None
+        self.started = None
+        self.finished = None
+        self.timed_out = False
+        self.cancelled = False
+        self._cursors = []
+        self._lock = threading.Lock()
+
+    def set_cursor(self, cursor):
+        """
+        Registers a cursor the job runs a statement on, so cancel() can stop the statement on the server.
+        A job running several statements at once (e.g. shared/fan_out.py) registers all their cursors.
+        """
+        with self._lock:
+            self._cursors.append(cursor)
+            cancelled = self.cancelled
+        if cancelled and hasattr(cursor, 'cancel'):
+            cursor.cancel()
+
+    def cancel(self):
+        """
+        Cancels the job: a queued job doesn't start, a running job has its statements cancelled (if it registered their cursors).
+        """
+        with self._lock:
+            self.cancelled = True
+            cursors = list(self._cursors)
+        if self.future.cancel():
+            return
+        for cursor in cursors:
+            if hasattr(cursor, 'cancel'):
+                cursor.cancel()  # pyodbc: SQLCancel, the running execute/fetch raises an error in the job's thread
+
+    def done(self):
+        # a timed out or cancelled job is done for the page, even while a statement without cursor still finishes in its thread
+        return self.future.done() or self.timed_out or self.cancelled
+
+    @property
+    def seconds(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def result(self, timeout=None):
+        """
+        Returns the result of the job, raises TimeoutError if it timed out and CancelledError if it was cancelled.
+        """
+        if not self.future.done() and (self.timed_out or self.cancelled):
+            raise (TimeoutError(f"{self.description} timed out after {self.timeout}s") if self.timed_out
+                   else CancelledError(f"{self.description} was cancelled"))
+        try:
+            result = self.future.result(timeout)
+        except Exception:
+            if self.timed_out:
+                raise TimeoutError(f"{self.description} timed out after {self.timeout}s") from None
+            if self.cancelled:
+                raise CancelledError(f"{self.description} was cancelled") from None
+            raise
+        if self.timed_out:
+            raise TimeoutError(f"{self.description} timed out after {self.timeout}s")
+        return result
+
+    def _time_out(self):
+        if not self.future.done():
+            self.timed_out = True
+            self.cancel()
+
+    def _run(self, fn, args, kwargs):
+        self.started = time.perf_counter()
+        try:
+            with session_scope(self.session_id):
+                return fn(self, *args, **kwargs)
+        finally:
+            self.finished = time.perf_counter()
+
+
+def submit(fn, *args, timeout=QUERY_TIMEOUT, description='Query', **kwargs):
+    """
+    Runs fn(job, *args, **kwargs) on the shared pool. fn gets its Job to register its cursor with job.set_cursor.
+
+    Returns:
+        Job: The submitted job.
+    """
+    if not _slots.acquire(blocking=False):
+        raise RuntimeError("Too many queries are running, please try again in a moment.")
+    job = Job(description, timeout, session_id=current_session_id())
+    job.submitted = time.perf_counter()
+    timer = threading.Timer(timeout, job._time_out)  # started before the job is queued, so queue time counts
+    timer.daemon = True
+    try:
+        job.future = _executor.submit(job._run, fn, args, kwargs)
+    except BaseException:
+        _slots.release()
+        raise
+    job.future.add_done_callback(lambda future: (timer.cancel(), _slots.release()))
+    timer.start()
+    return job
+
+
+def run_with_timeout(fn, *args, timeout=QUERY_TIMEOUT, description='Query', **kwargs):
+    """
+    Runs fn(job, *args, **kwargs) on the shared pool and waits for its result, for code that needs the result right away
+    (e.g. on_click callbacks).
+
+    Raises TimeoutError when it didn't finish within timeout seconds of being submitted, and only once it can no longer
+    change anything: it was still queued (and now never starts), or its cancelled statement stopped. A job that
+    finished anyway while being cancelled returns its result, so a commit is never reported as failed after it
+    committed. A job that ignores the cancel for CANCEL_GRACE seconds raises a TimeoutError saying it may still complete.
+    """
+    job = submit(fn, *args, timeout=timeout, description=description, **kwargs)
+    with waiting():
+        wait([job.future], timeout=timeout)
+        if not job.future.done():
+            job._time_out()  # the job's own timer may not have fired yet
+            wait([job.future], timeout=CANCEL_GRACE)
+    if not job.future.done():
+        raise TimeoutError(f"{description} timed out after {timeout}s and is still running, it may still complete")
+    if job.future.cancelled():
+        raise TimeoutError(f"{description} timed out after {timeout}s before it started")
+    if job.future.exception() is None:
+        return job.future.result()
+    return job.result()
+
+
+def show_job(key, work, fn, render, *args, timeout=QUERY_TIMEOUT, description='Query', **kwargs):
+    """
+    Shows the result of fn(job, *args, **kwargs) with render(result), running it on the shared pool without blocking the page.
+
+    The job is kept in st.session_state[key] with work, a value identifying what it computes (e.g. the query). A rerun
+    for the same work shows the running job (with a Cancel button) instead of submitting it again; the rerun after it
+    finished shows its result, later reruns submit it again (which is cheap for cached queries).
+    """
+    entry = st.session_state.get(key)
+    if entry is not None and entry['work'] == work and not entry['shown']:
+        job = entry['job']
+    else:
+        if entry is not None and not entry['job'].future.done():
+            entry['job'].cancel()  # the page moved on to other work
+        try:
+            job = submit(fn, *args, timeout=timeout, description=description, **kwargs)
+        except RuntimeError as e:
+            st.warning(str(e))
+            return
+        entry = st.session_state[key] = {'work': work, 'job': job, 'shown': False}
+        with waiting():
+            wait([job.future], timeout=FAST_WAIT)
+
+    if not job.done():
+        _placeholder(key, job)
+        return
+    entry['shown'] = True
+    try:
+        result = job.result()
+    except (TimeoutError, CancelledError) as e:
+        st.warning(str(e))
+        return
+    except Exception as e:
+        st.error(f"{description} failed: {e}")
+        return
+    render(result)
+    st.caption(f"{description} took {job.seconds:.2f}s")
+
+
+@st.fragment(run_every=POLL_INTERVAL)
+def _placeholder(key, job):
+    # reruns on its own until the job is done, then reruns the whole page to show the result
+    if job.done():
+        st.rerun()
+    if job.started is None:
+        st.info(f"⏳ {job.description} waiting for a free connection (times out after {job.timeout}s)")
+    else:
+        st.info(f"⏳ {job.description} running for {job.seconds:.1f}s (times out after {job.timeout}s)")
+    st.button('Cancel', key=f"{key}_cancel", on_click=job.cancel)
@@ -0,0 +1,68 @@
+# Renders query results as text lines in one element instead of one st.write per row.
+# Every st.write is its own element, sent to the browser as its own message, so a per-row loop gets slower with every
+# row. Here all lines are formatted in one vectorized pass over the columns and sent as a single markdown block. Above
+# VIRTUALIZE_THRESHOLD lines they go into a st.dataframe instead, which only draws the rows scrolled into view.
+# Benchmark of a rerun at 100, 10k and 100k rows per render mode (runs the pages headless with streamlit's AppTest):
+#   python -m shared.row_render
+
+import pandas as pd
+import streamlit as st
+
+VIRTUALIZE_THRESHOLD = 2000  # lines shown as one markdown block up to this, as a virtualized list above it
+LIST_HEIGHT = 400  # pixels of the virtualized list
+RENDER_MODES = ('batched', 'per row')
+
+
+def format_rows(df, fields):
+    """
+    Formats every row of df as one line, column by column.
+
+    Parameters:
+    - df (pandas.DataFrame): The rows to format.
+    - fields (list): (label, column) pairs, rendered as '<label>: <value>' separated by ' | '.
+
+    Returns:
+        pandas.Series: One string per row.
+    """
+    lines = pd.Series([""] * len(df), index=df.index, dtype=object)
+    for i, (label, column) in enumerate(fields):
+        separator = "" if i == 0 else " | "
+        lines = lines + f"{separator}{label}: " + df[column].astype(str)
+    return lines
+
+
+def render_rows(lines, threshold=VIRTUALIZE_THRESHOLD):
+    """
+    Shows formatted lines as a single element: a markdown block, or a virtualized list above threshold lines.
+    """
+    if len(lines) <= threshold:
+        # two trailing spaces make a line break within the markdown block
+        st.markdown("  \n".join(lines))
+    else:
+        st.dataframe(pd.DataFrame({'row': list(lines)}), hide_index=True, height=LIST_HEIGHT)
+
+
+def _benchmark_page(rows, mode):
+    # page used by the benchmark, AppTest runs it from its source so it imports what it needs itself
+    import pandas as pd
+    import streamlit as st
+    from shared.row_render import format_rows, render_rows
+
+    df = pd.DataFrame({'name': [f"name {i}" for i in range(rows)], 'address': [f"street {i}" for i in range(rows)]})
+    if mode == 'batched':
+        render_rows(format_rows(df, [('name column', 'name'), ('address column', 'address')]))
+    else:
+        for index, row in df.iterrows():
+            st.write(f"name column: {row['name']} | address column: {row['address']}")
+
+
+if __name__ == '__main__':
+    import time
+    from streamlit.testing.v1 import AppTest
+
+    for rows in (100, 10_000, 100_000):
+        for mode in RENDER_MODES:
+            app = AppTest.from_function(_benchmark_page, args=(rows, mode), default_timeout=3600)
+            start = time.perf_counter()
+            app.run()
+            print(f"{rows:>7} rows, {mode:<8}: {time.perf_counter() - start:7.2f}s")
@@ -0,0 +1,482 @@
+# Parameterized batch writer for the data editor pages.
+# Instead of joining string formatted INSERT/UPDATE/DELETE statements into one text batch, the changes are collected
+# per statement shape and sent with executemany (fast_executemany when the driver is pyodbc) in chunks, all inside a
+# single transaction. Values are bound with their proper types, so SQL Server can reuse the plan of each statement.
+# Large submissions are instead bulk loaded into a temp staging table and applied with one MERGE (or one set-based
+# DELETE/UPDATE/INSERT where MERGE isn't available, e.g. Fabric Warehouse), which avoids singleton DML altogether.
+# Optimistic concurrency: when the rows were loaded with a version (a rowversion column, or a hash of the row computed
+# by the database, see row_hash_sql), updates and deletes only apply to rows still at that version. Rows another user
+# changed or deleted in the meantime are skipped and reported as conflicts, so several editors can submit at the same
+# time without holding locks or transactions open while the users are editing. Small submissions read the current
+# versions of their rows with one SELECT and compare them here, large ones compare them in the staging table.
+# Tables without identity column (Fabric Warehouse) can have the ids of new rows assigned in the write transaction
+# (assign_keys), and take large numbers of new rows from a Parquet file staged in OneLake (load_parquet).
+
+import time
+
+from shared.connections import connect
+from shared.query_cache import invalidate
+
+CHUNK_SIZE = 1000  # rows sent per executemany call
+VERSION_CHECK_CHUNK = 1000  # keys per SELECT of the current row versions, SQL Server allows 2100 parameters per statement
+SET_BASED_THRESHOLD = 500  # changed rows from which commit() switches from per-row statements to the staging table
+STAGING_TABLE = "#editor_changes"  # session scoped temp table, created and dropped inside the write transaction
+VERSION_COLUMN = "__row_version"  # name of the version column in loaded frames and the staging table
+WAREHOUSE_STAGING_OPTIONS = "WITH (DISTRIBUTION = ROUND_ROBIN)"  # Fabric Warehouse only creates temp tables with this distribution
+
+
+def quote_name(name):
+    """
+    Quotes a schema, table or column name for SQL Server, e.g. product -> [product].
+    """
+    return "[" + str(name).replace("]", "]]") + "]"
+
+
+def to_db_value(value, cast=None):
+    """
+    Converts a value from the data editor / a dataframe into a plain python value the driver can bind.
+    NaN/NA become NULL and numpy scalars are unwrapped (pyodbc can't bind e.g. numpy.int64).
+    """
+    if value is None:
+        return None
+    try:
+        if value != value:  # NaN, NaT and pd.NA are not equal to themselves
+            return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(value, 'item'):
+        value = value.item()
+    return cast(value) if cast is not None else value
+
+
+DATE_TYPES = ('DATE', 'TIME', 'DATETIME', 'DATETIME2', 'DATETIMEOFFSET', 'SMALLDATETIME')
+
+
+def row_hash_sql(columns, alias=None, sql_types=None):
+    """
+    Returns a SQL expression hashing the given columns of a row (SHA2_256 over the columns as text, joined with CONCAT_WS
+    and NULL spelled out, so a NULL differs from an empty string). Only plain expressions are used, as Fabric Warehouse
+    and sql endpoints don't allow FOR JSON in a subquery. Date and time columns (by their type in sql_types) are
+    converted with style 126, the default style would drop the seconds. Select it as VERSION_COLUMN with the rows that
+    are edited, the writer compares it with the same expression when the changes are submitted.
+    """
+    prefix = f"{alias}." if alias else ""
+    sql_types = sql_types or {}
+
+    def as_text(column):
+        style = ", 126" if sql_types.get(column, '').split('(')[0].strip().upper() in DATE_TYPES else ""
+        return f"ISNULL(CONVERT(nvarchar(max), {prefix}{quote_name(column)}{style}), N'<null>')"
+
+    parts = [as_text(c) for c in columns]
+    text = parts[0] if len(parts) == 1 else f"CONCAT_WS(N'|', {', '.join(parts)})"
+    return f"HASHBYTES('SHA2_256', {text})"
+
+
+class BatchWriter:
+    """
+    Collects inserts, deletes and updates for one table and writes them in a single transaction.
+
+    Parameters:
+    - engine (sqlalchemy.engine.Engine): The engine to write with, e.g. from shared.connections.
+    - schema (str): The schema of the table.
+    - table (str): The name of the table.
+    - key_column (str): The primary key column used to address rows for updates and deletes.
+    - column_types (dict): Optional python type per column (e.g. {'id': int, 'name': str}) the values are cast to before binding.
+    - chunk_size (int): Number of rows sent per executemany call.
+    - sql_types (dict): SQL type per column (e.g. {'id': 'INT', 'name': 'VARCHAR(100)'}), required for the set-based mode.
+    - set_based_threshold (int): Number of changed rows from which commit() uses the set-based mode. None disables it.
+    - use_merge (bool): Apply the staged changes with a single MERGE instead of a DELETE, UPDATE and INSERT statement.
+    - rowversion_column (str): The rowversion column of the table, updates and deletes given a version are only applied
+      to rows still at that version.
+    - hash_columns (list): For tables without rowversion column, the columns whose hash (row_hash_sql) is the version.
+    - lock_rows (bool): Lock the checked rows (UPDLOCK) until the commit. Fabric Warehouse has no lock hints; its snapshot
+      isolation fails the whole transaction instead when another transaction changed the table meanwhile.
+    - assign_keys (bool): For tables without identity column, inserted rows get the keys after the highest key of the
+      table, read by the insert statement itself inside the write transaction. Keys given with the rows are ignored.
+      With lock_rows the highest key is read with UPDLOCK, HOLDLOCK, so concurrent writers wait for each other.
+      Without it (Fabric Warehouse) the transaction first claims the keys, see key_claim_statement.
+    - staging_options (str): Appended to the CREATE TABLE of the staging table, WAREHOUSE_STAGING_OPTIONS for Fabric Warehouse.
+    """
+
+    def __init__(self, engine, schema, table, key_column='id', column_types=None, chunk_size=CHUNK_SIZE,
+                 sql_types=None, set_based_threshold=SET_BASED_THRESHOLD, use_merge=True,
+                 rowversion_column=None, hash_columns=None, lock_rows=True, assign_keys=False, staging_options=""):
+        self.engine = engine
+        self.table = f"{quote_name(schema)}.{quote_name(table)}"
+        self.table_name = f"{schema}.{table}"
+        self.key_column = key_column
+        self.column_types = column_types or {}
+        self.chunk_size = chunk_size
+        self.sql_types = sql_types or {}
+        self.set_based_threshold = set_based_threshold if sql_types else None
+        self.use_merge = use_merge
+        self.rowversion_column = rowversion_column
+        self.hash_columns = hash_columns
+        self.lock_rows = lock_rows
+        self.assign_keys = assign_keys
+        self.staging_options = staging_options
+        self.inserts = []
+        self.loads = []  # staged Parquet files, see load_parquet
+        self.deletes = []
+        self.updates = {}
+        self.versions = {}  # key -> version the row had when it was loaded
+
+    def _value(self, column, value):
+        return to_db_value(value, self.column_types.get(column))
+
+    def insert(self, rows):
+        """
+        Queues new rows (list of dicts column -> value) for insert.
+        """
+        self.inserts.extend(rows)
+
+    def load_parquet(self, url, columns, rows, cleanup=None):
+        """
+        Queues the insert of the rows of a Parquet file staged in OneLake (see shared/warehouse_load.py), loaded with
+        INSERT ... SELECT FROM OPENROWSET in the write transaction. cleanup is called once the commit finished (or failed),
+        e.g. to delete the staged file.
+        """
+        self.loads.append({'url': url, 'columns': list(columns), 'rows': rows, 'cleanup': cleanup})
+
+    def cleanup(self):
+        """
+        Runs and forgets the cleanup callbacks of the queued Parquet files.
+        """
+        loads, self.loads = self.loads, []
+        for load in loads:
+            if load['cleanup'] is not None:
+                load['cleanup']()
+
+    @property
+    def rows(self):
+        """
+        Number of queued rows to insert, delete or update.
+        """
+        return len(self.inserts) + sum(load['rows'] for load in self.loads) + len(self.deletes) + len(self.updates)
+
+    def delete(self, keys, versions=None):
+        """
+        Queues the rows with the given key values for delete.
+        versions (dict key -> version) makes the deletes optimistic, see row_versions in shared/editor_payload.py.
+        """
+        keys = list(keys)
+        self.deletes.extend(keys)
+        self._remember_versions(keys, versions)
+
+    def update(self, key, changes, version=None):
+        """
+        Queues an update of the given columns (dict column -> new value) for the row with the given key value.
+        With version the update is only applied if the row still has that version.
+        """
+        self.updates.setdefault(key, {}).update(changes)
+        self._remember_versions([key], None if version is None else {key: version})
+
+    def _remember_versions(self, keys, versions):
+        if not versions or not self.optimistic:
+            return
+        for key in keys:
+            version = to_db_value(versions.get(key))
+            if version is not None:
+                self.versions.setdefault(key, version)  # the version the row was first loaded at
+
+    @property
+    def optimistic(self):
+        return self.rowversion_column is not None or bool(self.hash_columns)
+
+    def version_sql(self, alias):
+        """
+        Returns the SQL expression of the current version of a row of the table.
+        """
+        if self.rowversion_column is not None:
+            return f"{alias}.{quote_name(self.rowversion_column)}"
+        return row_hash_sql(self.hash_columns, alias, self.sql_types)
+
+    def insert_select(self, columns, source, where=""):
+        """
+        Returns an INSERT ... SELECT of the given columns from source (a table or rowset with alias s). With assign_keys
+        the key column is filled with the keys after the highest key of the table.
+        """
+        key = quote_name(self.key_column)
+        columns = [c for c in columns if not (self.assign_keys and c == self.key_column)]
+        target = [quote_name(c) for c in columns]
+        select = [f"s.{quote_name(c)}" for c in columns]
+        if self.assign_keys:
+            hint = " WITH (UPDLOCK, HOLDLOCK)" if self.lock_rows else ""
+            target.insert(0, key)
+            select.insert(0, f"(SELECT ISNULL(MAX({key}), 0) FROM {self.table}{hint}) + ROW_NUMBER() OVER (ORDER BY (SELECT NULL))")
+        return f"INSERT INTO {self.table} ({', '.join(target)}) SELECT {', '.join(select)} FROM {source}{where}"
+
+    def key_claim_statement(self):
+        """
+        Returns the statement claiming the key range of assign_keys without lock hints: it rewrites the row with the
+        highest key unchanged. Fabric Warehouse detects write conflicts per table under snapshot isolation, so of two
+        transactions inserting at the same time (which would read the same highest key) the second one fails and is
+        rolled back instead of committing duplicate keys. An empty table has no row to claim.
+        """
+        key = quote_name(self.key_column)
+        return f"UPDATE {self.table} SET {key} = {key} WHERE {key} = (SELECT MAX({key}) FROM {self.table})"
+
+    def load_statement(self, load):
+        """
+        Returns the statement inserting the rows of a staged Parquet file, see load_parquet.
+        """
+        url = load['url'].replace("'", "''")
+        return self.insert_select(load['columns'], f"OPENROWSET(BULK '{url}', FORMAT = 'PARQUET') AS s")
+
+    def statements(self, skip=()):
+        """
+        Groups the queued changes into parameterized statements.
+
+        Parameters:
+        - skip (set): Key values (as bound) of rows whose delete or update is left out, e.g. the conflicts of check_versions.
+
+        Returns:
+            list of (sql, list of parameter tuples), in the order they are executed: inserts, deletes, updates.
+        """
+        statements = []
+
+        # rows pasted from different sources can have different columns, one statement per column set
+        inserts = {}
+        for row in self.inserts:
+            columns = tuple(row.keys())
+            inserts.setdefault(columns, []).append(tuple(self._value(c, row[c]) for c in columns))
+        for columns, params in inserts.items():
+            column_list = ", ".join(quote_name(c) for c in columns)
+            placeholders = ", ".join("?" for _ in columns)
+            statements.append((f"INSERT INTO {self.table} ({column_list}) VALUES ({placeholders})", params))
+
+        params = [(self._value(self.key_column, key),) for key in self.deletes if self._value(self.key_column, key) not in skip]
+        if params:
+            statements.append((f"DELETE FROM {self.table} WHERE {quote_name(self.key_column)} = ?", params))
+
+        # one statement per set of edited columns, so every statement only touches the columns that were changed
+        # rows that are deleted as well are not updated first
+        deleted = {self._value(self.key_column, key) for key in self.deletes}
+        updates = {}
+        for key, changes in self.updates.items():
+            if self._value(self.key_column, key) in skip or self._value(self.key_column, key) in deleted:
+                continue
+            columns = tuple(changes.keys())
+            params = tuple(self._value(c, changes[c]) for c in columns) + (self._value(self.key_column, key),)
+            updates.setdefault(columns, []).append(params)
+        for columns, params in updates.items():
+            set_command = ", ".join(f"{quote_name(c)} = ?" for c in columns)
+            statements.append((f"UPDATE {self.table} SET {set_command} WHERE {quote_name(self.key_column)} = ?", params))
+
+        return statements
+
+    def set_based_statements(self):
+        """
+        Builds the statements of the set-based mode: all queued changes are loaded into one staging table,
+        with an operation column (I/U/D) and a flag per updatable column telling whether the update changed it.
+
+        Returns:
+            (create staging table sql, load staging table sql, list of parameter tuples, list of apply statements, drop staging table sql)
+        """
+        key = self.key_column
+        insert_columns = list(dict.fromkeys(c for row in self.inserts for c in row))
+        update_columns = list(dict.fromkeys(c for changes in self.updates.values() for c in changes if c != key))
+        columns = list(dict.fromkeys([key] + insert_columns + update_columns))
+        missing = [c for c in columns if c not in self.sql_types]
+        if missing:
+            raise ValueError(f"sql_types is missing the columns {missing}, needed to create the staging table.")
+
+        # the version each updated or deleted row was loaded at, NULL applies the change unconditionally
+        versioned = (lambda value: (self.versions.get(value),)) if self.optimistic else (lambda value: ())
+        params = []
+        for row in self.inserts:
+            params.append(('I',) + tuple(self._value(c, row.get(c)) for c in columns) + (0,) * len(update_columns) + versioned(None))
+        for value in self.deletes:
+            params.append(('D',) + tuple(self._value(key, value) if c == key else None for c in columns) + (0,) * len(update_columns)
+                          + versioned(value))
+        deleted = {self._value(key, value) for value in self.deletes}
+        for value, changes in self.updates.items():
+            if self._value(key, value) in deleted:
+                continue  # MERGE doesn't allow a target row to match more than one staged row, the delete wins anyway
+            params.append(('U',) + tuple(self._value(key, value) if c == key else self._value(c, changes.get(c)) for c in columns)
+                          + tuple(1 if c in changes else 0 for c in update_columns) + versioned(value))
+
+        flags = {c: quote_name(f"__set_{c}") for c in update_columns}
+        version = [quote_name(VERSION_COLUMN)] if self.optimistic else []
+        staging_columns = [quote_name('__op')] + [quote_name(c) for c in columns] + list(flags.values()) + version
+        create = (f"CREATE TABLE {STAGING_TABLE} ({quote_name('__op')} CHAR(1) NOT NULL, "
+                  + ", ".join(f"{quote_name(c)} {self.sql_types[c]} NULL" for c in columns)
+                  + "".join(f", {flag} BIT NOT NULL" for flag in flags.values())
+                  + "".join(f", {column} VARBINARY(32) NULL" for column in version) + ")"
+                  + (f" {self.staging_options}" if self.staging_options else ""))
+        load = f"INSERT INTO {STAGING_TABLE} ({', '.join(staging_columns)}) VALUES ({', '.join('?' for _ in staging_columns)})"
+        drop = f"DROP TABLE {STAGING_TABLE}"
+
+        on = f"t.{quote_name(key)} = s.{quote_name(key)}"
+        # unchanged columns keep their value, the flag tells a column set to NULL apart from a column that wasn't edited
+        set_command = ", ".join(f"{quote_name(c)} = CASE WHEN s.{flag} = 1 THEN s.{quote_name(c)} ELSE t.{quote_name(c)} END"
+                                for c, flag in flags.items())
+        insert_list = ", ".join(quote_name(c) for c in insert_columns)
+
+        # MERGE can't number the inserted rows, with assign_keys they are inserted by a separate statement
+        insert = self.insert_select(insert_columns, f"{STAGING_TABLE} AS s", " WHERE s.[__op] = 'I'") if insert_columns else None
+        if self.use_merge:
+            merge = f"MERGE {self.table} AS t USING {STAGING_TABLE} AS s ON {on} AND s.[__op] IN ('U', 'D') WHEN MATCHED AND s.[__op] = 'D' THEN DELETE"
+            if update_columns:
+                merge += f" WHEN MATCHED AND s.[__op] = 'U' THEN UPDATE SET {set_command}"
+            if insert_columns and not self.assign_keys:
+                merge += (f" WHEN NOT MATCHED BY TARGET AND s.[__op] = 'I' THEN INSERT ({insert_list}) "
+                          f"VALUES ({', '.join('s.' + quote_name(c) for c in insert_columns)})")
+            apply = [merge + ";"]
+            if insert_columns and self.assign_keys:
+                apply.append(insert)
+        else:
+            apply = []
+            if self.deletes:
+                apply.append(f"DELETE t FROM {self.table} AS t INNER JOIN {STAGING_TABLE} AS s ON {on} WHERE s.[__op] = 'D'")
+            if update_columns:
+                apply.append(f"UPDATE t SET {set_command} FROM {self.table} AS t INNER JOIN {STAGING_TABLE} AS s ON {on} WHERE s.[__op] = 'U'")
+            if insert_columns:
+                apply.append(insert)
+        return create, load, params, apply, drop
+
+    def conflict_statements(self):
+        """
+        Builds the statements of the optimistic check, run on the loaded staging table before the changes are applied:
+        one returning the staged updates and deletes whose row was changed or deleted since it was loaded, and one
+        removing them from the staging table so they are not applied.
+
+        Returns:
+            (select conflicts sql, delete conflicts sql)
+        """
+        key = quote_name(self.key_column)
+        hint = " WITH (UPDLOCK, ROWLOCK)" if self.lock_rows else ""
+        conflict = (f"s.[__op] IN ('U', 'D') AND s.{quote_name(VERSION_COLUMN)} IS NOT NULL "
+                    f"AND (t.{key} IS NULL OR {self.version_sql('t')} <> s.{quote_name(VERSION_COLUMN)})")
+        join = f"{STAGING_TABLE} AS s LEFT JOIN {self.table} AS t{hint} ON t.{key} = s.{key}"
+        select = f"SELECT s.{key}, s.[__op], CASE WHEN t.{key} IS NULL THEN 1 ELSE 0 END FROM {join} WHERE {conflict}"
+        delete = f"DELETE s FROM {join} WHERE {conflict}"
+        return select, delete
+
+    def version_check_statement(self, count):
+        """
+        Returns the SELECT of the current version of count rows by key, for the optimistic check of the per-row mode.
+        """
+        key = quote_name(self.key_column)
+        hint = " WITH (UPDLOCK, ROWLOCK)" if self.lock_rows else ""
+        return f"SELECT t.{key}, {self.version_sql('t')} FROM {self.table} AS t{hint} WHERE t.{key} IN ({', '.join('?' for _ in range(count))})"
+
+    def check_versions(self, cursor, stats):
+        """
+        Reads the current version of the rows queued for update or delete with a version, and returns the conflicts:
+        the rows that were changed or deleted since they were loaded. With lock_rows the rows stay locked until the
+        commit; Fabric Warehouse instead fails the transaction if another one changes the table before the commit.
+        """
+        keys = {self._value(self.key_column, key): version for key, version in self.versions.items()}
+        current = {}
+        values = list(keys)
+        for i in range(0, len(values), VERSION_CHECK_CHUNK):
+            chunk = values[i:i + VERSION_CHECK_CHUNK]
+            cursor.execute(self.version_check_statement(len(chunk)), chunk)
+            current.update((key, to_db_value(version)) for key, version in cursor.fetchall())
+            stats['statements'] += 1
+        deleted = {self._value(self.key_column, key) for key in self.deletes}
+        return [{'key': key, 'operation': 'delete' if key in deleted else 'update',
+                 'reason': 'deleted by someone else' if key not in current else 'changed by someone else'}
+                for key, version in keys.items() if current.get(key) != version]
+
+    def _executemany(self, cursor, sql, params, stats):
+        stats['statements'] += 1
+        for i in range(0, len(params), self.chunk_size):
+            cursor.executemany(sql, params[i:i + self.chunk_size])
+            stats['chunks'] += 1
+
+    def commit(self, mode='auto', on_cursor=None):
+        """
+        Writes all queued changes in one transaction and clears the queue.
+
+        Parameters:
+        - mode (str): 'rows' for parameterized per-row statements, 'set' for the staging table, or 'auto' to pick 'set'
+          once the number of changed rows reaches set_based_threshold. Inserts with assign_keys always use 'set'.
+        - on_cursor (callable): Called with the cursor before the statements run, e.g. Job.set_cursor of
+          shared/query_executor.py to be able to cancel the commit (the transaction is rolled back).
+
+        Returns:
+            dict: Rows inserted/deleted/updated, the mode used, the number of statements and chunks sent, seconds taken,
+            rows per second and the conflicts (list of dicts with key, operation and reason) that were not applied.
+        """
+        rows = self.rows
+        if mode == 'auto':
+            mode = 'set' if self.set_based_threshold is not None and rows >= self.set_based_threshold else 'rows'
+        if self.assign_keys and self.inserts:
+            if not self.sql_types:
+                raise ValueError("sql_types is required for assign_keys.")
+            mode = 'set'
+        staged = len(self.inserts) + len(self.deletes) + len(self.updates)
+        deleted = {self._value(self.key_column, key) for key in self.deletes}
+        stats = {
+            'inserted': len(self.inserts) + sum(load['rows'] for load in self.loads),
+            'loaded': sum(load['rows'] for load in self.loads),
+            'deleted': len(self.deletes),
+            'updated': sum(1 for key in self.updates if self._value(self.key_column, key) not in deleted),  # the delete wins
+            'mode': mode,
+            'statements': 0,
+            'chunks': 0,
+            'conflicts': [],
+        }
+        start = time.perf_counter()
+        try:
+            if rows:
+                with connect(self.engine, begin=True) as conn:
+                    cursor = conn.connection.cursor()
+                    if hasattr(cursor, 'fast_executemany'):
+                        cursor.fast_executemany = True  # pyodbc sends all parameter rows of a chunk in one round trip
+                    if on_cursor is not None:
+                        on_cursor(cursor)
+                    try:
+                        if self.assign_keys and not self.lock_rows and (self.inserts or self.loads):
+                            cursor.execute(self.key_claim_statement())
+                            stats['statements'] += 1
+                        if staged and mode == 'set':
+                            create, load, params, apply, drop = self.set_based_statements()
+                            cursor.execute(create)
+                            self._executemany(cursor, load, params, stats)
+                            if self.versions:
+                                stats['conflicts'] = self._remove_conflicts(cursor, stats)
+                            for sql in apply:
+                                cursor.execute(sql)
+                                stats['statements'] += 1
+                            cursor.execute(drop)
+                        elif staged:
+                            skip = set()
+                            if self.versions:
+                                stats['conflicts'] = self.check_versions(cursor, stats)
+                                skip = {c['key'] for c in stats['conflicts']}
+                                stats['deleted'] -= sum(1 for c in stats['conflicts'] if c['operation'] == 'delete')
+                                stats['updated'] -= sum(1 for c in stats['conflicts'] if c['operation'] == 'update')
+                            for sql, params in self.statements(skip):
+                                self._executemany(cursor, sql, params, stats)
+                        # the staged files are loaded in the same transaction, a failure rolls back all changes
+                        for load in self.loads:
+                            cursor.execute(self.load_statement(load))
+                            stats['statements'] += 1
+                    finally:
+                        cursor.close()
+                # cached reads of this table are stale now, for every user
+                invalidate(self.engine, tables=[self.table_name])
+        finally:
+            self.cleanup()
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_sec'] = rows / stats['seconds'] if stats['seconds'] > 0 else 0.0
+
+        self.inserts, self.deletes, self.updates, self.versions = [], [], {}, {}
+        return stats
+
+    def _remove_conflicts(self, cursor, stats):
+        select, delete = self.conflict_statements()
+        cursor.execute(select)
+        conflicts = [{'key': key, 'operation': 'delete' if op == 'D' else 'update',
+                      'reason': 'deleted by someone else' if gone else 'changed by someone else'}
+                     for key, op, gone in cursor.fetchall()]
+        stats['statements'] += 1
+        if conflicts:
+            cursor.execute(delete)
+            stats['statements'] += 1
+            stats['deleted'] -= sum(1 for c in conflicts if c['operation'] == 'delete')
+            stats['updated'] -= sum(1 for c in conflicts if c['operation'] == 'update')
+        return conflicts
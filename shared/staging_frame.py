@@ -0,0 +1,61 @@
+# Vectorized versions of the staging dataframe steps of the lakehouse editor, which stay fast with tens of thousands
+# of rows pasted into the data editor: all added rows become one frame in a single step, and edits are applied with
+# one indexed assignment per column instead of one write per cell. The ids of added rows are assigned in bulk after the
+# highest existing id; the editor leaves them empty here and lets shared/delta_writer.py assign them against the table
+# version its merge commits on, as ids taken from the loaded rows can collide with rows another session added since.
+
+import numpy as np
+import pandas as pd
+
+
+def new_keys(existing_keys, count):
+    """
+    Returns count new integer keys above all existing keys.
+    """
+    existing = pd.to_numeric(pd.Series(existing_keys, dtype=object), errors='coerce').dropna()
+    start = int(existing.max()) + 1 if len(existing) else 1
+    return np.arange(start, start + count, dtype='int64')
+
+
+def added_rows_frame(added_rows, dtypes, key_column='id', existing_keys=None):
+    """
+    Builds one frame of the rows added in the data editor.
+
+    Parameters:
+    - added_rows (list): The added_rows of the data editor payload, dicts of column -> value.
+    - dtypes (dict): Column -> dtype of the table, the frame gets these columns and is cast to them once.
+    - key_column (str): The key column, rows without a key get a new one.
+    - existing_keys (iterable): The keys already in the table, new keys are assigned above them. When None, rows
+      without a key keep an empty (NULL) key for the writer to assign.
+
+    Returns:
+        pandas.DataFrame: The added rows.
+    """
+    frame = pd.DataFrame.from_records(list(added_rows), columns=list(dtypes))
+    missing = frame[key_column].isna()
+    if missing.any() and existing_keys is None:
+        # a nullable integer key, so the rows without one keep a NULL
+        return frame.astype({**dtypes, key_column: 'Int64'})
+    if missing.any():
+        keys = list(existing_keys) + list(frame.loc[~missing, key_column])
+        frame[key_column] = frame[key_column].astype(object)
+        frame.loc[missing, key_column] = new_keys(keys, int(missing.sum()))
+    return frame.astype(dtypes)
+
+
+def apply_edits(df, edited_rows):
+    """
+    Applies the edited_rows of a data editor payload (row position -> {column: value}) to df in place, column by column.
+    """
+    if not edited_rows:
+        return df
+    positions = {}  # column -> (row positions, values)
+    for row_index, changes in edited_rows.items():
+        for column, value in changes.items():
+            rows, values = positions.setdefault(column, ([], []))
+            rows.append(int(row_index))
+            values.append(value)
+    for column, (rows, values) in positions.items():
+        column_position = df.columns.get_loc(column)
+        df.iloc[rows, column_position] = values
+    return df
@@ -0,0 +1,106 @@
+# Measures the cold start of the app: how long the first run of every page took, how much of it the script waited for
+# queries and OneLake I/O on the shared pool (shared/query_executor.py reports its waits with waiting()), and which
+# packages were first loaded during it. Import times aren't measured here, python -X importtime -m streamlit run main.py
+# prints them per module; the warm-up below times the heavy modules it imports.
+# Heavy modules are imported in the functions that use them (like pyodbc in shared/connections.py), so a page only pays
+# for them on the code path that needs them. warm_up() imports them in a background thread at server start instead,
+# so the first user doesn't pay for them at all; main.py enables it with the APP_WARM_UP=1 environment variable.
+
+import contextlib
+import importlib
+import sys
+import threading
+import time
+
+WARM_UP_MODULES = ('pandas', 'sqlalchemy', 'pyodbc', 'pyarrow', 'deltalake', 'azure.identity', 'azure.storage.filedatalake')
+
+_process_start = time.perf_counter()
+_local = threading.local()  # the seconds the page run on this thread waited
+_lock = threading.Lock()
+_pages = {}  # page title -> {'first_run', 'waiting', 'script', 'modules', 'since_start', 'runs', 'last_run'}
+_warm_up = {}  # module -> seconds, None while it is imported
+_warm_up_thread = None
+
+
+@contextlib.contextmanager
+def waiting():
+    """
+    Books the time spent in the block as waiting of the page run on this thread, e.g. for a job on the shared pool.
+    Does nothing outside of a page run (e.g. on a worker thread).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if getattr(_local, 'waiting', None) is not None:
+            _local.waiting += time.perf_counter() - start
+
+
+def run_page(page):
+    """
+    Runs a page from st.navigation and records how long it took on its first run, split in the time it waited for
+    queries and I/O and the time the script itself ran (imports included).
+    """
+    _local.waiting = 0.0
+    packages = {name.split('.')[0] for name in list(sys.modules)}
+    start = time.perf_counter()
+    try:
+        page.run()
+    finally:
+        seconds = time.perf_counter() - start
+        waited, _local.waiting = _local.waiting, None
+        with _lock:
+            entry = _pages.get(page.title)
+            if entry is None:
+                # packages loaded while the page ran, possibly by another session running at the same time
+                loaded = {name.split('.')[0] for name in list(sys.modules)} - packages
+                entry = _pages[page.title] = {
+                    'first_run': seconds,
+                    'waiting': waited,
+                    'script': seconds - waited,
+                    'modules': sorted(name for name in loaded if not name.startswith('_')),
+                    'since_start': start - _process_start,
+                    'runs': 0,
+                }
+            entry['runs'] += 1
+            entry['last_run'] = seconds
+
+
+def warm_up(modules=WARM_UP_MODULES):
+    """
+    Imports modules in a background thread, once per process.
+    """
+    global _warm_up_thread
+    with _lock:
+        if _warm_up_thread is not None:
+            return
+        _warm_up.update({module: None for module in modules})
+
+        def run():
+            for module in modules:
+                start = time.perf_counter()
+                try:
+                    importlib.import_module(module)
+                except ImportError:
+                    with _lock:
+                        _warm_up.pop(module, None)  # optional dependency that isn't installed
+                    continue
+                with _lock:
+                    _warm_up[module] = time.perf_counter() - start
+
+        _warm_up_thread = threading.Thread(target=run, name="warm-up", daemon=True)
+        _warm_up_thread.start()
+
+
+def startup_report():
+    """
+    Returns the first run of every page and the warm-up imports.
+
+    Returns:
+        (list, dict): One dict per page with its first run, waiting and script seconds, the packages first loaded
+        during it, the seconds since server start it first ran, number of runs and the last run; and module -> seconds
+        of the warm-up (None while still importing).
+    """
+    with _lock:
+        pages = [{'page': title, **entry, 'modules': ", ".join(entry['modules'])} for title, entry in _pages.items()]
+        return pages, dict(_warm_up)
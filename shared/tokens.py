@@ -0,0 +1,124 @@
+# Cached Microsoft Entra access tokens that refresh themselves in the background before they expire.
+# The Fabric pages used to fetch one token when the engine was created and pack it into attrs_before, which meant every
+# pooled connection opened after ~1 hour failed. The token caches here are handed to the connection creator instead, so
+# each new physical connection gets a valid token without the page ever waiting on a credential call.
+
+import base64
+import json
+import struct
+import threading
+import time
+import weakref
+from itertools import chain, repeat
+
+from shared import metrics
+
+SQL_SCOPE = "https://database.windows.net//.default"  # access token valid to connect to SQL databases (incl. Fabric sql endpoints)
+STORAGE_SCOPE = "https://storage.azure.com/.default"  # access token valid to read/write OneLake
+SQL_COPT_SS_ACCESS_TOKEN = 1256  # ODBC connection attribute used to pass an access token to the driver
+
+REFRESH_MARGIN = 300  # seconds before expiry the background refresh kicks in
+RETRY_DELAY = 30      # seconds to wait before retrying a failed background refresh
+
+# credential object -> {scope: RefreshingToken}. Entries disappear together with the credential (e.g. when a session ends).
+_token_caches = weakref.WeakKeyDictionary()
+_token_caches_lock = threading.Lock()
+
+
+class RefreshingToken:
+    """
+    Caches the access token of a credential for one scope and refreshes it ahead of expiry on a background timer.
+    The timer only keeps running while the token is being used, so tokens of idle sessions are left to expire.
+    """
+
+    def __init__(self, credential, scope):
+        self._credential = weakref.ref(credential)
+        self._scope = scope
+        self._token = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._used_since_refresh = False
+
+    def get(self):
+        """
+        Returns the current access token string. Only blocks on the credential when there is no valid token yet.
+        """
+        self._used_since_refresh = True
+        token = self._token
+        if token is None or token.expires_on - time.time() < 60:
+            with self._lock:
+                # another thread might have refreshed it while we waited for the lock
+                if self._token is None or self._token.expires_on - time.time() < 60:
+                    self._refresh()
+        return self._token.token
+
+    def expires_on(self):
+        return self._token.expires_on if self._token is not None else None
+
+    def _refresh(self):
+        credential = self._credential()
+        if credential is None:
+            raise RuntimeError("The credential for this token is no longer available, please login again.")
+        with metrics.timer('token_fetch', scope=self._scope):
+            self._token = credential.get_token(self._scope)
+        self._used_since_refresh = False
+        self._schedule(max(self._token.expires_on - time.time() - REFRESH_MARGIN, RETRY_DELAY))
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        if not self._used_since_refresh or self._credential() is None:
+            # nobody asked for the token since the last refresh, or the session that logged in is gone:
+            # stop refreshing until someone asks for it again
+            self._timer = None
+            return
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as e:
+            # shows up in the metrics of the sidebar (shared/metrics.py), the refresh is retried after RETRY_DELAY seconds
+            metrics.count('token_refresh_retries', scope=self._scope, error=type(e).__name__)
+            self._schedule(RETRY_DELAY)
+
+
+def get_token_cache(credential, scope=SQL_SCOPE):
+    """
+    Returns the shared RefreshingToken for a credential and scope, creating it on first use.
+    """
+    with _token_caches_lock:
+        scopes = _token_caches.setdefault(credential, {})
+        if scope not in scopes:
+            scopes[scope] = RefreshingToken(credential, scope)
+        return scopes[scope]
+
+
+def pack_token(token):
+    """
+    Packs an access token the way the ODBC driver expects it for SQL_COPT_SS_ACCESS_TOKEN.
+    https://debruyn.dev/2023/connect-to-fabric-lakehouses-warehouses-from-python-code/
+    """
+    token_as_bytes = bytes(token, "UTF-8") # Convert the token to a UTF-8 byte string
+    encoded_bytes = bytes(chain.from_iterable(zip(token_as_bytes, repeat(0)))) # Encode the bytes to a Windows byte string
+    return struct.pack("<i", len(encoded_bytes)) + encoded_bytes # Package the token into a bytes object
+
+
+def token_identity(token, fallback=None):
+    """
+    Returns the user (object id or user principal name) an access token was issued to, used to keep engines apart per identity.
+    The token is only decoded, not validated, it is never used for authorization decisions.
+    fallback is returned for tokens that aren't JWTs, it should be stable across token refreshes (e.g. per credential),
+    as every distinct identity gets its own engine.
+    """
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return claims.get('oid') or claims.get('upn') or claims.get('unique_name') or claims['sub']
+    except (IndexError, KeyError, ValueError):
+        if fallback is not None:
+            return fallback
+        raise ValueError("The access token is not a JWT, pass a fallback identity.") from None
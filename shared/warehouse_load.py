@@ -0,0 +1,49 @@
+# Bulk load of new rows into a Fabric Warehouse table through OneLake.
+# Fabric Warehouse is built for set-based loads; INSERT ... VALUES costs a distributed transaction per statement, so
+# pasting tens of thousands of rows into the editor took minutes. Here the rows are written as one Parquet file to a
+# staging folder in the Files area of a lakehouse, and the BatchWriter (shared/sql_writer.py, load_parquet) inserts
+# them with INSERT ... SELECT FROM OPENROWSET in the same transaction as the other changes of the submission, after
+# which the file is deleted. New rows get the ids after the highest id in the table, assigned by that statement; of two
+# submissions inserting at the same time one fails and is rolled back (BatchWriter.key_claim_statement).
+# COPY INTO isn't used: it can only copy the columns of the file, so the ids would have to be picked (and the highest
+# id read) before the write transaction, and sessions submitting at the same time would get the same ids.
+# https://learn.microsoft.com/sql/t-sql/functions/openrowset-bulk-transact-sql
+
+import hashlib
+import io
+import uuid
+
+COPY_THRESHOLD = 1000  # added rows from which the editor loads them through OneLake instead of INSERT statements
+ONELAKE_URL = "https://onelake.dfs.fabric.microsoft.com"
+
+
+def to_parquet(df):
+    """
+    Returns a DataFrame as Parquet file content.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue()
+
+
+def stage_parquet(df, backend, workspace, staging_folder, name):
+    """
+    Writes a DataFrame as one Parquet file to a staging folder in OneLake, for BatchWriter.load_parquet.
+
+    Parameters:
+    - df (pandas.DataFrame): The rows to stage, the column names must match the table.
+    - backend (OneLakeBackend): The workspace to stage the file in, see shared/onelake_upload.py.
+    - workspace (str): The name of that workspace, for the url the warehouse reads the file from.
+    - staging_folder (str): Folder in the workspace to stage the file in, e.g. 'MyLakehouse.Lakehouse/Files/staging'.
+    - name (str): Prefix of the file name, e.g. the table name.
+
+    Returns:
+        (url the warehouse reads the file from, path of the file in the workspace for backend.delete, bytes staged)
+    """
+    path = f"{staging_folder.strip('/')}/{name}-{uuid.uuid4().hex}.parquet"
+    data = to_parquet(df)
+    backend.upload(path, data, hashlib.md5(data).digest())
+    return f"{ONELAKE_URL}/{workspace}/{path}", path, len(data)
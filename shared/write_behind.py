@@ -0,0 +1,223 @@
+# Optional write-behind queue for the data editor submissions (group commit).
+# Instead of every Submit click opening its own transaction in the streamlit callback, the page hands its filled
+# BatchWriter (shared/sql_writer.py) to submit() and returns immediately. Every table has its own queue and worker
+# thread, which waits WINDOW seconds after the first submission to collect the submissions of all sessions arriving
+# meanwhile, and commits them as one batched transaction. Each session follows its own submission with
+# show_submission, a fragment that polls it and reports its stats and conflicts once the batch committed.
+# - Submissions touching the same row as a submission already in the batch wait for the next batch, so every
+#   optimistic version check (and every conflict) still belongs to exactly one submission.
+# - When a batch fails, its submissions are retried one by one, so a bad row only fails its own submission.
+# - Parquet files a submission staged for a bulk load (BatchWriter.load_parquet) are loaded in the batch transaction
+#   and cleaned up once the submission finished, not after a failed batch, as its retry still needs them.
+# - Batches are committed on the shared query pool (shared/query_executor.py) with run_with_timeout, so a hanging
+#   commit is cancelled on the server after COMMIT_TIMEOUT seconds and fails its submissions instead of blocking the
+#   table's queue. A timed out batch is not retried, it may still have committed.
+
+import copy
+import threading
+import time
+from collections import deque
+
+import streamlit as st
+
+from shared import metrics
+from shared.query_executor import run_with_timeout
+
+WINDOW = 0.2  # seconds a batch collects submissions after the first one arrived
+MAX_BATCH_ROWS = 5000  # changed rows from which a batch is committed without waiting for the window to pass
+POLL_INTERVAL = 0.5  # seconds between checks of a pending submission
+COMMIT_TIMEOUT = 300  # seconds a batch commit may take (queue time on the query pool included) before it is cancelled
+SLOW_AFTER = 30  # seconds after which a pending submission is shown as slow
+
+_queues = {}  # (engine, table) -> _TableQueue
+_queues_lock = threading.Lock()
+
+
+class Submission:
+    """
+    The changes of one Submit click, queued by submit().
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.status = 'queued'  # queued -> committing -> committed / failed
+        self.stats = None
+        self.error = None
+        self.submitted = time.perf_counter()
+        self.committing = None  # when its batch started committing
+        self.finished = None
+        self._done = threading.Event()
+
+    @property
+    def rows(self):
+        return self.writer.rows
+
+    @property
+    def keys(self):
+        return set(self.writer.deletes) | set(self.writer.updates)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _finish(self, stats=None, error=None):
+        self.stats, self.error = stats, error
+        self.status = 'failed' if error is not None else 'committed'
+        self.finished = time.perf_counter()
+        self._done.set()
+
+
+class _TableQueue:
+
+    def __init__(self, name):
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name=f"write-behind {name}", daemon=True)
+        self.thread.start()
+
+    def put(self, submission):
+        with self.condition:
+            self.pending.append(submission)
+            self.condition.notify()
+
+    def _collect(self):
+        # waits for the first submission, then for the window to pass or the batch to fill up
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            deadline = self.pending[0].submitted + WINDOW
+            while sum(s.rows for s in self.pending) < MAX_BATCH_ROWS and time.perf_counter() < deadline:
+                self.condition.wait(deadline - time.perf_counter())
+            batch, keys, deferred = [], set(), deque()
+            while self.pending:
+                submission = self.pending.popleft()
+                if submission.keys & keys:
+                    deferred.append(submission)  # same row as an earlier submission of this batch, next batch
+                    continue
+                batch.append(submission)
+                keys |= submission.keys
+            self.pending = deferred + self.pending
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            for submission in batch:
+                submission.status, submission.committing = 'committing', time.perf_counter()
+            try:
+                results = _commit_batch(batch)
+            except TimeoutError as e:
+                # cancelled, or still running and it may yet commit: retrying could apply the changes twice
+                metrics.count('write_behind_timeouts', len(batch))
+                results = [(submission, None, e) for submission in batch]
+            except Exception:
+                # one bad submission fails the whole transaction, commit them one by one to find it
+                results = []
+                metrics.count('write_behind_retries', len(batch))
+                for submission in batch:
+                    try:
+                        results.extend(_commit_batch([submission]))
+                    except Exception as e:
+                        results.append((submission, None, e))
+            self.batches += 1
+            for submission, stats, error in results:
+                try:
+                    submission.writer.cleanup()
+                except Exception:
+                    metrics.count('write_behind_cleanup_errors')  # a staged file left behind mustn't stop the queue
+                submission._finish(stats, error)
+
+
+def _merged_writer(batch):
+    writer = copy.copy(batch[0].writer)
+    writer.inserts, writer.deletes, writer.updates, writer.versions, writer.loads = [], [], {}, {}, []
+    for submission in batch:
+        source = submission.writer
+        writer.insert(source.inserts)
+        for load in source.loads:
+            writer.load_parquet(load['url'], load['columns'], load['rows'])  # cleaned up by the submission
+        writer.delete(source.deletes, source.versions)
+        for key, changes in source.updates.items():
+            writer.update(key, changes, source.versions.get(key))
+    return writer
+
+
+def _commit_batch(batch):
+    start = time.perf_counter()
+    writer = _merged_writer(batch)
+    stats = run_with_timeout(lambda job: writer.commit(on_cursor=job.set_cursor), timeout=COMMIT_TIMEOUT, description='Group commit')
+    conflicts = {}
+    for conflict in stats['conflicts']:
+        conflicts.setdefault(conflict['key'], []).append(conflict)
+    results = []
+    for submission in batch:
+        source = submission.writer
+        own_conflicts = [c for key in submission.keys for c in conflicts.get(key, [])]
+        results.append((submission, {
+            'inserted': len(source.inserts) + sum(load['rows'] for load in source.loads),
+            'loaded': sum(load['rows'] for load in source.loads),
+            'deleted': len(source.deletes) - sum(1 for c in own_conflicts if c['operation'] == 'delete'),
+            'updated': len(set(source.updates) - set(source.deletes)) - sum(1 for c in own_conflicts if c['operation'] == 'update'),
+            'mode': f"{stats['mode']}, group commit of {len(batch)} submissions",
+            'statements': stats['statements'],
+            'chunks': stats['chunks'],
+            'seconds': stats['seconds'],
+            'rows_per_sec': stats['rows_per_sec'],
+            'queued_seconds': start - submission.submitted,
+            'conflicts': own_conflicts,
+        }, None))
+    return results
+
+
+def submit(writer):
+    """
+    Queues the changes of a filled BatchWriter for the next group commit of its table and returns right away.
+
+    Returns:
+        Submission: Follow it with show_submission, or wait() for it.
+    """
+    key = (writer.engine, writer.table)
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            queue = _queues[key] = _TableQueue(writer.table_name)
+    submission = Submission(writer)
+    queue.put(submission)
+    return submission
+
+
+def show_submission(key, render):
+    """
+    Shows the status of the submission in st.session_state[key] while it is queued, and render(stats) once it committed.
+    The page reruns when it finished (so it shows the committed rows), the result is shown once.
+    """
+    submission = st.session_state.get(key)
+    if submission is None:
+        return
+    if not submission.done():
+        _pending(key, submission)
+        return
+    del st.session_state[key]
+    if submission.error is not None:
+        st.error(f"Submitting the changes failed: {submission.error}")
+        return
+    render(submission.stats)
+    st.caption(f"Queued for {submission.stats['queued_seconds']:.2f}s before the group commit.")
+
+
+@st.fragment(run_every=POLL_INTERVAL)
+def _pending(key, submission):
+    # reruns on its own until the submission is committed, then reruns the whole page to show the result
+    if submission.done():
+        st.rerun()
+    seconds = time.perf_counter() - submission.submitted
+    if seconds < SLOW_AFTER:
+        st.info(f"⏳ Changes {submission.status} for {seconds:.1f}s")
+    elif submission.status == 'queued':
+        st.warning(f"⏳ Changes queued for {seconds:.0f}s, the table's previous group commit is still running")
+    else:
+        st.warning(f"⏳ Changes committing for {time.perf_counter() - submission.committing:.0f}s, "
+                   f"the commit is cancelled and reported as failed after {COMMIT_TIMEOUT}s")
@@ -0,0 +1,29 @@
+import pytest
+from sqlalchemy.pool import QueuePool
+
+pytest.importorskip('pyarrow')
+
+from shared.arrow_fetch import fetch_arrow  # noqa: E402
+from shared.connections import get_engine  # noqa: E402
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = get_engine('local', str(tmp_path / 'arrow.db'), 'tester', url=f"sqlite:///{tmp_path / 'arrow.db'}", poolclass=QueuePool)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE product (id INTEGER, name TEXT)")
+        conn.exec_driver_sql("INSERT INTO product VALUES " + ", ".join(f"({i}, 'p{i}')" for i in range(25)))
+    return engine
+
+
+def test_rows_are_fetched_in_batches_into_one_table(engine):
+    cursors = []
+    table = fetch_arrow(engine, "SELECT id, name FROM product ORDER BY id", batch_size=10, on_cursor=cursors.append)
+    assert table.column_names == ['id', 'name'] and table.num_rows == 25
+    assert table.column('name').to_pylist()[-1] == 'p24'
+    assert len(cursors) == 1
+
+
+def test_empty_result_keeps_its_columns(engine):
+    table = fetch_arrow(engine, "SELECT id, name FROM product WHERE id < 0")
+    assert table.column_names == ['id', 'name'] and table.num_rows == 0
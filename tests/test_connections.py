@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from shared import connections
+from shared.connections import connect, current_session_id, get_engine, session_scope
+from shared.query_executor import run_with_timeout
+
+
+def _engine(database):
+    return get_engine('local', database, 'tester', url='sqlite://', poolclass=QueuePool)
+
+
+def test_session_scope_binds_the_session_to_the_thread():
+    assert current_session_id() is None
+    with session_scope('session-1'):
+        assert current_session_id() == 'session-1'
+        assert run_with_timeout(lambda job: current_session_id(), timeout=5) == 'session-1'
+    assert current_session_id() is None
+
+
+def test_checkout_limit_applies_to_the_jobs_of_a_session(monkeypatch):
+    monkeypatch.setattr(connections, 'POOL_TIMEOUT', 0.2)
+    engine = _engine('limit')
+
+    def checkout(job):
+        with connect(engine):
+            return 'connected'
+
+    release, held = threading.Event(), threading.Barrier(connections.SESSION_CHECKOUT_LIMIT + 1)
+
+    def hold():
+        with session_scope('busy-session'), connect(engine):
+            held.wait(5)
+            release.wait(5)
+
+    holders = [threading.Thread(target=hold) for _ in range(connections.SESSION_CHECKOUT_LIMIT)]
+    for thread in holders:
+        thread.start()
+    try:
+        held.wait(5)
+        with session_scope('busy-session'):
+            with pytest.raises(TimeoutError, match='holds 2 connections'):
+                run_with_timeout(checkout, timeout=5)
+            # the limit is per engine, another database of the same session still gets a connection
+            assert run_with_timeout(lambda job: _connect_other(), timeout=5) == 'other'
+        with session_scope('other-session'):
+            assert run_with_timeout(checkout, timeout=5) == 'connected'
+    finally:
+        release.set()
+        for thread in holders:
+            thread.join(5)
+
+
+def _connect_other():
+    with connect(_engine('other')):
+        return 'other'
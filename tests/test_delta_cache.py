@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+deltalake = pytest.importorskip('deltalake')
+
+from deltalake.exceptions import TableNotFoundError  # noqa: E402
+
+from shared import delta_cache  # noqa: E402
+from shared.delta_cache import forget_table, load_table  # noqa: E402
+
+
+@pytest.fixture
+def table_uri(tmp_path):
+    uri = str(tmp_path / 'product')
+    deltalake.write_deltalake(uri, pd.DataFrame({'id': [1, 2], 'name': ['a', 'b']}))
+    yield uri
+    forget_table(uri)
+
+
+def _break_refresh(uri, error):
+    def update_incremental():
+        raise error
+    for key, entry in delta_cache._tables.items():
+        if key[0] == uri:
+            entry['table'].update_incremental = update_incremental
+
+
+def test_frame_is_served_until_the_table_gets_a_new_version(table_uri):
+    first, version = load_table(table_uri, {})
+    hits = delta_cache.stats['hits']
+    assert load_table(table_uri, {})[1] == version and delta_cache.stats['hits'] == hits + 1
+
+    deltalake.write_deltalake(table_uri, pd.DataFrame({'id': [3], 'name': ['c']}), mode='append')
+    frame, new_version = load_table(table_uri, {})
+    assert new_version == version + 1 and sorted(frame['id']) == [1, 2, 3]
+
+
+def test_missing_table_is_reopened(table_uri):
+    load_table(table_uri, {})
+    _break_refresh(table_uri, TableNotFoundError('gone'))
+    frame, _ = load_table(table_uri, {})
+    assert sorted(frame['id']) == [1, 2]
+
+
+def test_unexpected_refresh_error_is_raised(table_uri, caplog):
+    load_table(table_uri, {})
+    _break_refresh(table_uri, ValueError('corrupt log'))
+    with pytest.raises(ValueError, match='corrupt log'):
+        load_table(table_uri, {})
+    assert 'Reading the new log entries' in caplog.text
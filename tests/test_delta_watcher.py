@@ -0,0 +1,46 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+deltalake = pytest.importorskip('deltalake')
+
+from shared.delta_watcher import forget_table, subscribe  # noqa: E402
+
+
+def _write(uri, mode='append'):
+    deltalake.write_deltalake(uri, pd.DataFrame({'id': [1]}), mode=mode)
+
+
+@pytest.fixture
+def table_uri(tmp_path):
+    uri = str(tmp_path / 'product')
+    _write(uri)
+    yield uri
+    forget_table(uri)
+
+
+def _options():
+    return {}
+
+
+def test_subscription_is_reached_by_a_later_commit(table_uri):
+    subscription = subscribe(table_uri, _options, 1, timeout=10)
+    assert not subscription.wait(0.8)
+    _write(table_uri)
+    assert subscription.wait(5) and subscription.seen_version == 1
+
+
+def test_recreated_table_is_not_reported_at_its_old_version(table_uri):
+    _write(table_uri)
+    _write(table_uri)
+    assert subscribe(table_uri, _options, 2, timeout=10).wait(5)
+
+    shutil.rmtree(table_uri)
+    forget_table(table_uri)
+    _write(table_uri)
+    # the recorded version 2 is from before the recreate, only a probe of the new table counts
+    subscription = subscribe(table_uri, _options, 1, timeout=10)
+    assert not subscription.wait(0.8)
+    first = subscribe(table_uri, _options, 0, timeout=10)
+    assert first.wait(5) and first.seen_version == 0
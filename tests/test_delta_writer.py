@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+
+deltalake = pytest.importorskip('deltalake')
+
+from deltalake.exceptions import CommitFailedError  # noqa: E402
+
+from shared import delta_writer  # noqa: E402
+from shared.delta_writer import apply_changes  # noqa: E402
+from shared.staging_frame import added_rows_frame  # noqa: E402
+
+DTYPES = {'id': 'int64', 'name': 'string', 'category': 'string'}
+
+
+@pytest.fixture
+def table_uri(tmp_path):
+    uri = str(tmp_path / 'product')
+    df = pd.DataFrame({'id': [1, 2, 3], 'name': ['a', 'b', 'c'], 'category': ['x', 'y', 'z']})
+    deltalake.write_deltalake(uri, df)
+    return uri
+
+
+def _rows(uri):
+    return deltalake.DeltaTable(uri).to_pandas().sort_values('id').to_dict('records')
+
+
+def test_delete_update_and_insert_are_one_commit(table_uri):
+    edited = pd.DataFrame({'id': [1, 2], 'name': ['a2', 'b2'], 'category': ['x2', 'y2']})
+    added = pd.DataFrame({'id': [4], 'name': ['d'], 'category': ['w']})
+    stats = apply_changes(table_uri, None, deleted_keys=[3], edited_rows=edited, added_rows=added,
+                          edited_columns={1: ['name'], 2: ['category']})
+
+    assert (stats['deleted'], stats['updated'], stats['appended'], stats['version']) == (1, 2, 1, 1)
+    assert len(deltalake.DeltaTable(table_uri).history()) == 2  # the create and one merge
+    # each edited row only takes the columns edited in it
+    assert _rows(table_uri) == [{'id': 1, 'name': 'a2', 'category': 'x'},
+                                {'id': 2, 'name': 'b', 'category': 'y2'},
+                                {'id': 4, 'name': 'd', 'category': 'w'}]
+
+
+def test_edit_of_a_deleted_row_only_deletes_it(table_uri):
+    edited = pd.DataFrame({'id': [2], 'name': ['b2'], 'category': ['y']})
+    stats = apply_changes(table_uri, None, deleted_keys=[2], edited_rows=edited, edited_columns=['name'])
+    assert (stats['deleted'], stats['updated']) == (1, 0)
+    assert [row['id'] for row in _rows(table_uri)] == [1, 3]
+
+
+def test_no_changes_make_no_commit(table_uri):
+    stats = apply_changes(table_uri, None, edited_rows=pd.DataFrame(columns=['id', 'name', 'category']))
+    assert stats['version'] == 0
+
+
+def test_added_rows_get_keys_after_the_highest_key_of_the_table(table_uri):
+    added = added_rows_frame([{'name': 'd'}, {'id': 10, 'name': 'e'}, {'name': 'f'}], DTYPES)
+    assert added['id'].isna().sum() == 2
+    apply_changes(table_uri, None, added_rows=added)
+    assert [row['id'] for row in _rows(table_uri)] == [1, 2, 3, 10, 11, 12]
+
+
+def test_keys_assigned_before_a_concurrent_insert_are_not_committed(table_uri, monkeypatch):
+    assign_keys = delta_writer.assign_keys
+
+    def assign_keys_then_other_session_inserts(dt, added_rows, key_column):
+        keys = assign_keys(dt, added_rows, key_column)
+        monkeypatch.setattr(delta_writer, 'assign_keys', assign_keys)
+        apply_changes(table_uri, None, added_rows=added_rows_frame([{'name': 'theirs'}], DTYPES))
+        return keys
+
+    monkeypatch.setattr(delta_writer, 'assign_keys', assign_keys_then_other_session_inserts)
+    with pytest.raises(CommitFailedError):
+        apply_changes(table_uri, None, added_rows=added_rows_frame([{'name': 'mine'}], DTYPES))
+    assert [(row['id'], row['name']) for row in _rows(table_uri)][-1] == (4, 'theirs')
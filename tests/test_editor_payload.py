@@ -0,0 +1,32 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from shared.editor_payload import normalize_payload, payload_to_keys, row_versions
+
+
+def _frame():
+    return pd.DataFrame({'id': [10, 20, 30], 'name': ['a', 'b', None], 'price': [1.5, np.nan, 3.0],
+                         'day': [datetime.date(2024, 1, 1)] * 3, '__row_version': [b'v1', b'v2', b'v3']})
+
+
+def test_normalize_payload_drops_unchanged_cells_and_rows():
+    payload = {'added_rows': [], 'deleted_rows': [],
+               'edited_rows': {'0': {'name': 'a', 'price': 2.0}, '1': {'price': None}, '2': {'name': None, 'day': '2024-01-01'}}}
+    assert normalize_payload(payload, _frame())['edited_rows'] == {0: {'price': 2.0}}
+
+
+def test_normalize_payload_drops_edits_of_deleted_rows_and_empty_added_rows():
+    payload = {'added_rows': [{'name': None, 'price': None}, {'name': 'new'}],
+               'edited_rows': {'1': {'name': 'changed'}}, 'deleted_rows': [1, 1]}
+    result = normalize_payload(payload, _frame())
+    assert result == {'added_rows': [{'name': 'new'}], 'edited_rows': {}, 'deleted_rows': [1]}
+
+
+def test_payload_to_keys_and_row_versions():
+    df = _frame()
+    keyed = payload_to_keys({'added_rows': [], 'edited_rows': {0: {'name': 'x'}}, 'deleted_rows': [2]}, df, key_column='id')
+    assert keyed['edited_rows'] == {10: {'name': 'x'}} and keyed['deleted_rows'] == [30]
+    assert all(type(key) is int for key in [*keyed['edited_rows'], *keyed['deleted_rows']])
+    assert row_versions(keyed, df, key_column='id') == {10: b'v1', 30: b'v3'}
@@ -0,0 +1,80 @@
+import threading
+import time
+import types
+
+import pyarrow as pa
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from shared import fan_out as fan_out_module
+from shared.connections import get_engine
+from shared.fan_out import SOURCE_COLUMN, combine_results, fan_out
+from shared.query_executor import run_with_timeout, submit
+
+
+def test_combine_results_adds_the_source_column():
+    combined = combine_results({'wh': pa.table({'n': [1, 2]}), 'lh': pa.table({'n': [3], 'extra': ['x']})})
+    assert combined.column_names[0] == SOURCE_COLUMN
+    assert combined.column(SOURCE_COLUMN).to_pylist() == ['wh', 'wh', 'lh']
+    assert combined.column('extra').to_pylist() == [None, None, 'x']
+
+
+def test_combine_results_falls_back_to_text_for_mismatching_types():
+    combined = combine_results({'a': pa.table({'v': [1]}), 'b': pa.table({'v': ['one']})})
+    assert combined.schema.field('v').type == pa.string()
+    assert combined.column('v').to_pylist() == ['1', 'one']
+
+
+def test_combine_results_without_sources():
+    combined = combine_results({})
+    assert combined.num_rows == 0 and combined.column_names == [SOURCE_COLUMN]
+
+
+@pytest.fixture
+def engines(tmp_path):
+    engines = {}
+    for name, rows in {'wh': 2, 'lh': 1}.items():
+        path = tmp_path / f'{name}.db'
+        engines[name] = get_engine('local', str(path), 'tester', url=f'sqlite:///{path}', poolclass=QueuePool)
+        with engines[name].begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE product (id INTEGER)")
+            conn.exec_driver_sql("INSERT INTO product VALUES " + ", ".join(f"({i})" for i in range(rows)))
+    return engines
+
+
+def test_fan_out_combines_the_databases_and_reports_errors(engines):
+    query = "SELECT COUNT(*) AS n FROM product"
+    engines['broken'] = get_engine('local', 'broken', 'tester', url='sqlite:///file:missing?mode=ro&uri=true', poolclass=QueuePool)
+    combined, summaries = run_with_timeout(fan_out, engines, query, timeout=10)
+    assert dict(zip(combined.column(SOURCE_COLUMN).to_pylist(), combined.column('n').to_pylist())) == {'wh': 2, 'lh': 1}
+    assert [(s[SOURCE_COLUMN], s['error'] is None) for s in summaries] == [('wh', True), ('lh', True), ('broken', False)]
+
+
+def test_fan_outs_share_one_pool(engines, monkeypatch):
+    release, running = threading.Event(), []
+
+    def blocked_query(source, job, engine, query, session_id):
+        running.append(threading.current_thread().name)
+        release.wait(5)
+        return pa.table({'n': [1]}), {SOURCE_COLUMN: source, 'rows': 1, 'seconds': 0.0, 'error': None}
+
+    monkeypatch.setattr(fan_out_module, '_query_one', blocked_query)
+    many = {f'db{i}': engines['wh'] for i in range(fan_out_module.MAX_PARALLEL)}
+    jobs = [submit(fan_out, many, 'SELECT 1', timeout=10) for _ in range(2)]
+    try:
+        deadline = time.monotonic() + 5
+        while len(running) < fan_out_module.MAX_PARALLEL and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        # two fan-outs of MAX_PARALLEL databases each still query at most MAX_PARALLEL at a time
+        assert len(running) == fan_out_module.MAX_PARALLEL
+        assert all(name.startswith('fan-out') for name in running)
+    finally:
+        release.set()
+    assert all(job.result(5)[0].num_rows == fan_out_module.MAX_PARALLEL for job in jobs)
+
+
+def test_queries_waiting_for_a_thread_are_skipped_after_a_cancel(engines):
+    job = types.SimpleNamespace(done=lambda: True, set_cursor=lambda cursor: None)
+    table, summary = fan_out_module._query_one('wh', job, engines['wh'], 'SELECT 1', None)
+    assert table is None and summary['error'] == 'not run, the query was cancelled'
@@ -0,0 +1,82 @@
+import contextlib
+import types
+
+import pandas as pd
+import pytest
+
+from shared import incremental
+from shared.connections import get_engine
+from shared.incremental import enable_change_tracking, refresh_table
+from shared.sql_writer import VERSION_COLUMN
+
+VERSION_SQL = "HASHBYTES('SHA2_256', t.[name])"
+
+
+class FakeServer:
+    # answers the change tracking queries of shared/incremental.py, records the statements it was sent
+    def __init__(self):
+        self.version = 1
+        self.rows = pd.DataFrame({'id': [1, 2], 'name': ['a', 'b'], VERSION_COLUMN: [b'a1', b'b1']})
+        self.changes = pd.DataFrame(columns=['__key', 'id', 'name', VERSION_COLUMN])
+        self.has_primary_key = 1
+        self.statements = []
+
+    def scalar(self, connection, sql, params=()):
+        self.statements.append(sql)
+        if 'TableHasPrimaryKey' in sql:
+            return self.has_primary_key
+        return 0 if 'MIN_VALID_VERSION' in sql else self.version
+
+    def read(self, connection, sql, params=None):
+        self.statements.append(sql)
+        return (self.changes if 'CHANGETABLE' in sql else self.rows).copy()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+
+    @contextlib.contextmanager
+    def connect(engine, begin=False):
+        yield types.SimpleNamespace(
+            exec_driver_sql=server.statements.append,
+            execution_options=lambda **options: types.SimpleNamespace(exec_driver_sql=server.statements.append))
+
+    monkeypatch.setattr(incremental, 'connect', connect)
+    monkeypatch.setattr(incremental, '_scalar', server.scalar)
+    monkeypatch.setattr(incremental, '_read', server.read)
+    return server
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return get_engine('local', str(tmp_path / 'ct.db'), 'tester', url=f"sqlite:///{tmp_path / 'ct.db'}")
+
+
+def test_change_tracking_is_not_enabled_without_a_primary_key(server, engine):
+    server.has_primary_key = 0
+    with pytest.raises(ValueError, match=r'needs a primary key.*ADD CONSTRAINT \[PK_product\] PRIMARY KEY \(\[id\]\)'):
+        enable_change_tracking(engine, 'dbo', 'product')
+    assert not any('ALTER' in sql for sql in server.statements)
+
+
+def test_incrementally_refreshed_rows_carry_their_version(server, engine):
+    df, info = refresh_table(engine, 'dbo', 'product', ['id', 'name'], version_sql=VERSION_SQL)
+    assert info['refresh'] == 'full' and list(df[VERSION_COLUMN]) == [b'a1', b'b1']
+    assert f"{VERSION_SQL} AS [{VERSION_COLUMN}]" in server.statements[-1]
+
+    server.version = 2
+    server.changes = pd.DataFrame({'__key': [2, 3], 'id': [2, None], 'name': ['b2', None], VERSION_COLUMN: [b'b2', None]})
+    df, info = refresh_table(engine, 'dbo', 'product', ['id', 'name'], version_sql=VERSION_SQL)
+    assert (info['refresh'], info['upserted']) == ('incremental', 1)
+    assert "CHANGETABLE" in server.statements[-1] and VERSION_SQL in server.statements[-1]
+    assert df.to_dict('records') == [{'id': 1, 'name': 'a', VERSION_COLUMN: b'a1'},
+                                     {'id': 2, 'name': 'b2', VERSION_COLUMN: b'b2'}]
+
+
+def test_least_recently_refreshed_frames_are_dropped(server, engine, monkeypatch):
+    monkeypatch.setattr(incremental, 'MAX_SNAPSHOTS', 2)
+    monkeypatch.setattr(incremental, '_snapshots', incremental.OrderedDict())
+    for table in ('a', 'b', 'a', 'c'):
+        refresh_table(engine, 'dbo', table, ['id', 'name'])
+    assert [key[4] for key in incremental._snapshots] == ['a', 'c']
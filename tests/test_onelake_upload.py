@@ -0,0 +1,47 @@
+import os
+
+from shared.onelake_upload import LocalBackend, upload_folder
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_upload_folder_uploads_then_skips_unchanged(tmp_path):
+    source, target = tmp_path / 'source', tmp_path / 'target'
+    _write(str(source / 'part-0.parquet'), b'a' * 100)
+    _write(str(source / '_delta_log' / '00000.json'), b'{}')
+    backend = LocalBackend(str(target))
+
+    first = upload_folder(str(source), backend, 'Tables/product')
+    assert (first['files'], first['uploaded'], first['skipped']) == (2, 2, 0)
+    assert (target / 'Tables' / 'product' / '_delta_log' / '00000.json').read_bytes() == b'{}'
+
+    second = upload_folder(str(source), backend, 'Tables/product')
+    assert (second['uploaded'], second['skipped'], second['bytes']) == (0, 2, 0)
+
+
+def test_upload_folder_sends_changed_files_again(tmp_path):
+    source = tmp_path / 'source'
+    _write(str(source / 'data.bin'), b'old')
+    backend = LocalBackend(str(tmp_path / 'target'))
+    upload_folder(str(source), backend, 'Files')
+
+    _write(str(source / 'data.bin'), b'new')  # same size, other content
+    stats = upload_folder(str(source), backend, 'Files')
+    assert (stats['uploaded'], stats['skipped']) == (1, 0)
+    assert (tmp_path / 'target' / 'Files' / 'data.bin').read_bytes() == b'new'
+
+
+def test_upload_folder_streams_large_files_in_blocks(tmp_path):
+    source = tmp_path / 'source'
+    data = bytes(range(256)) * 40
+    _write(str(source / 'large.bin'), data)
+    backend = LocalBackend(str(tmp_path / 'target'))
+
+    stats = upload_folder(str(source), backend, 'Files', block_size=1000)
+    assert stats['uploaded'] == 1
+    assert (tmp_path / 'target' / 'Files' / 'large.bin').read_bytes() == data
+    assert upload_folder(str(source), backend, 'Files', block_size=1000)['skipped'] == 1
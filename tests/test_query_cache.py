@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from shared.connections import get_engine
+from shared.query_cache import cached_select, invalidate, is_read_only, referenced_tables
+
+
+def test_referenced_tables_finds_reads_and_writes():
+    assert referenced_tables("SELECT * FROM dbo.product p JOIN [sales].[order] o ON o.id = p.id") == {'dbo.product', 'sales.order'}
+    assert referenced_tables("insert into Product (name) values ('a')") == {'dbo.product'}
+    assert referenced_tables("UPDATE db.dbo.product SET name = 'a'") == {'dbo.product'}
+    assert referenced_tables("MERGE dbo.target AS t USING #changes AS s ON t.id = s.id") == {'dbo.target'}
+
+
+def test_referenced_tables_ignores_keywords_after_table_words():
+    assert referenced_tables("DELETE FROM (SELECT 1) x") == set()
+    assert referenced_tables("DROP TABLE dbo.product") == {'dbo.product'}
+
+
+def test_is_read_only():
+    assert is_read_only("  with x as (select 1 as a) select a from x")
+    assert not is_read_only("select * into dbo.copy from dbo.product")
+    assert not is_read_only("delete from dbo.product")
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return get_engine('local', str(tmp_path / 'cache.db'), 'tester', url=f"sqlite:///{tmp_path / 'cache.db'}", poolclass=QueuePool)
+
+
+def test_cached_result_is_served_until_its_table_is_written(engine):
+    calls = []
+    fetch = lambda: calls.append(1) or len(calls)  # noqa: E731
+    assert cached_select(engine, "SELECT * FROM dbo.product", fetch) == 1
+    assert cached_select(engine, "SELECT *  FROM dbo.product;", fetch) == 1
+    invalidate(engine, tables=['dbo.other'])
+    assert cached_select(engine, "SELECT * FROM dbo.product", fetch) == 1
+    invalidate(engine, "UPDATE dbo.product SET name = 'a'")
+    assert cached_select(engine, "SELECT * FROM dbo.product", fetch) == 2
+
+
+def test_result_fetched_across_an_invalidation_is_not_stored(engine):
+    def fetch_while_someone_writes():
+        invalidate(engine, tables=['dbo.product'])  # the write commits while the select runs
+        return 'before the write'
+
+    assert cached_select(engine, "SELECT * FROM dbo.product", fetch_while_someone_writes) == 'before the write'
+    assert cached_select(engine, "SELECT * FROM dbo.product", lambda: 'after the write') == 'after the write'
+
+
+def test_invalidation_of_the_whole_database_also_skips_the_store(engine):
+    def fetch_while_someone_writes():
+        invalidate(engine, "EXEC dbo.load_products")
+        return 'before the write'
+
+    cached_select(engine, "SELECT * FROM dbo.product", fetch_while_someone_writes)
+    assert cached_select(engine, "SELECT * FROM dbo.product", lambda: 'after the write') == 'after the write'
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from shared import query_executor
+from shared.query_executor import run_with_timeout, submit
+
+
+class FakeCursor:
+    # stands in for a pyodbc cursor: cancel() makes the running statement fail
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def execute(self, seconds):
+        if self.cancelled.wait(seconds):
+            raise RuntimeError('Operation canceled')
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def _block_workers(release):
+    jobs = [submit(lambda job: release.wait(10), timeout=30) for _ in range(query_executor.MAX_WORKERS)]
+    return jobs
+
+
+def test_job_timing_out_in_the_queue_never_runs():
+    release, ran = threading.Event(), threading.Event()
+    blockers = _block_workers(release)
+    try:
+        with pytest.raises(TimeoutError, match='before it started'):
+            run_with_timeout(lambda job: ran.set(), timeout=0.2, description='Commit')
+    finally:
+        release.set()
+    for job in blockers:
+        job.future.result(5)
+    assert not ran.wait(0.2)
+
+
+def test_cancelled_statement_raises_timeout():
+    def statement(job):
+        cursor = FakeCursor()
+        job.set_cursor(cursor)
+        cursor.execute(10)
+
+    with pytest.raises(TimeoutError, match='timed out after 0.2s'):
+        run_with_timeout(statement, timeout=0.2)
+
+
+def test_job_finishing_while_cancelled_returns_its_result():
+    def commit(job):
+        # ignores the cancel, like a commit that reached the server just before the timeout
+        threading.Event().wait(0.4)
+        return 'committed'
+
+    assert run_with_timeout(commit, timeout=0.2) == 'committed'
+
+
+def test_job_ignoring_the_cancel_is_reported_as_still_running(monkeypatch):
+    monkeypatch.setattr(query_executor, 'CANCEL_GRACE', 0.1)
+    release = threading.Event()
+    try:
+        with pytest.raises(TimeoutError, match='may still complete'):
+            run_with_timeout(lambda job: release.wait(10), timeout=0.1)
+    finally:
+        release.set()
@@ -0,0 +1,202 @@
+import contextlib
+import types
+
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from shared import sql_writer
+from shared.connections import get_engine
+from shared.sql_writer import BatchWriter, quote_name, row_hash_sql, WAREHOUSE_STAGING_OPTIONS
+
+SQL_TYPES = {'id': 'INT', 'name': 'VARCHAR(100)', 'category': 'VARCHAR(100)'}
+
+
+def _writer(**options):
+    return BatchWriter(None, 'dbo', 'product', sql_types=SQL_TYPES, **options)
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    # a file database, so every pooled connection sees the same table; rv stands in for a rowversion column
+    engine = get_engine('local', str(tmp_path / 'writer.db'), 'tester', url=f"sqlite:///{tmp_path / 'writer.db'}", poolclass=QueuePool)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE product (id INTEGER PRIMARY KEY, name TEXT, category TEXT, rv INTEGER DEFAULT 1)")
+        conn.exec_driver_sql("INSERT INTO product (id, name, category) VALUES (1, 'a', 'x'), (2, 'b', 'y'), (3, 'c', 'z')")
+    return engine
+
+
+def _rows(engine):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT id, name, category FROM product ORDER BY id").fetchall()
+
+
+def test_quote_name_escapes_brackets():
+    assert quote_name('a]b') == '[a]]b]'
+
+
+def test_statements_group_rows_by_column_set():
+    writer = _writer()
+    writer.insert([{'name': 'a', 'category': 'x'}, {'name': 'b', 'category': 'y'}, {'name': 'c'}])
+    writer.delete([1, 2])
+    writer.update(3, {'name': 'n'})
+    writer.update(4, {'name': 'm'})
+    writer.update(5, {'category': 'c'})
+    statements = writer.statements()
+    assert [sql for sql, _ in statements] == [
+        "INSERT INTO [dbo].[product] ([name], [category]) VALUES (?, ?)",
+        "INSERT INTO [dbo].[product] ([name]) VALUES (?)",
+        "DELETE FROM [dbo].[product] WHERE [id] = ?",
+        "UPDATE [dbo].[product] SET [name] = ? WHERE [id] = ?",
+        "UPDATE [dbo].[product] SET [category] = ? WHERE [id] = ?",
+    ]
+    assert statements[3][1] == [('n', 3), ('m', 4)]
+
+
+def test_small_commit_writes_rows_with_executemany(sqlite_engine):
+    writer = BatchWriter(sqlite_engine, 'main', 'product', sql_types=SQL_TYPES, set_based_threshold=500)
+    writer.insert([{'id': 4, 'name': 'd', 'category': 'w'}])
+    writer.delete([2])
+    writer.update(1, {'name': 'a2'})
+    stats = writer.commit()
+    assert (stats['mode'], stats['inserted'], stats['deleted'], stats['updated']) == ('rows', 1, 1, 1)
+    assert _rows(sqlite_engine) == [(1, 'a2', 'x'), (3, 'c', 'z'), (4, 'd', 'w')]
+
+
+def test_small_optimistic_commit_skips_rows_changed_meanwhile(sqlite_engine):
+    writer = BatchWriter(sqlite_engine, 'main', 'product', sql_types=SQL_TYPES, rowversion_column='rv', lock_rows=False)
+    writer.update(1, {'name': 'mine'}, version=1)
+    writer.update(2, {'name': 'mine'}, version=1)
+    writer.delete([3], {3: 1})
+    with sqlite_engine.begin() as conn:
+        conn.exec_driver_sql("UPDATE product SET name = 'theirs', rv = 2 WHERE id = 2")
+        conn.exec_driver_sql("DELETE FROM product WHERE id = 3")
+
+    stats = writer.commit()
+    # a small batch stays on the per-row statements, its versions are checked with one SELECT
+    assert stats['mode'] == 'rows'
+    assert stats['conflicts'] == [{'key': 2, 'operation': 'update', 'reason': 'changed by someone else'},
+                                  {'key': 3, 'operation': 'delete', 'reason': 'deleted by someone else'}]
+    assert (stats['updated'], stats['deleted']) == (1, 0)
+    assert _rows(sqlite_engine) == [(1, 'mine', 'x'), (2, 'theirs', 'y')]
+
+
+def test_set_based_statements_flag_the_edited_columns():
+    writer = _writer(use_merge=False)
+    writer.update(1, {'name': 'n'})
+    writer.update(2, {'category': None})
+    writer.delete([2])
+    create, load, params, apply, drop = writer.set_based_statements()
+    assert create.startswith("CREATE TABLE #editor_changes ([__op] CHAR(1) NOT NULL, [id] INT NULL")
+    assert "[__set_name] BIT NOT NULL" in create and "[__set_category] BIT NOT NULL" in create
+    # the update of a deleted row is left out
+    assert params == [('D', 2, None, None, 0, 0), ('U', 1, 'n', None, 1, 0)]
+    assert apply[0].startswith("DELETE t FROM [dbo].[product]")
+    assert "CASE WHEN s.[__set_name] = 1 THEN s.[name] ELSE t.[name] END" in apply[1]
+    assert drop == "DROP TABLE #editor_changes"
+
+
+def test_warehouse_staging_table_is_round_robin():
+    writer = _writer(use_merge=False, staging_options=WAREHOUSE_STAGING_OPTIONS)
+    writer.update(1, {'name': 'n'})
+    create = writer.set_based_statements()[0]
+    assert create.endswith("[__set_name] BIT NOT NULL) WITH (DISTRIBUTION = ROUND_ROBIN)")
+
+
+def test_updates_of_deleted_rows_are_not_counted(sqlite_engine):
+    writer = BatchWriter(sqlite_engine, 'main', 'product', sql_types=SQL_TYPES)
+    writer.update(1, {'name': 'n'})
+    writer.update(2, {'name': 'n'})
+    writer.delete([2])
+    assert [sql for sql, _ in writer.statements()] == ["DELETE FROM [main].[product] WHERE [id] = ?",
+                                                       "UPDATE [main].[product] SET [name] = ? WHERE [id] = ?"]
+    stats = writer.commit()
+    assert (stats['deleted'], stats['updated']) == (1, 1)
+    assert _rows(sqlite_engine) == [(1, 'n', 'x'), (3, 'c', 'z')]
+
+
+class RecordingCursor:
+    # stands in for the pyodbc cursor of a commit, records the statements it is given
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def executemany(self, sql, params):
+        self.statements.append(sql)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def recording_cursor(monkeypatch):
+    cursor = RecordingCursor()
+
+    @contextlib.contextmanager
+    def connect(engine, begin=False):
+        yield types.SimpleNamespace(connection=types.SimpleNamespace(cursor=lambda: cursor))
+
+    monkeypatch.setattr(sql_writer, 'connect', connect)
+    monkeypatch.setattr(sql_writer, 'invalidate', lambda engine, tables: None)
+    return cursor
+
+
+def test_assign_keys_numbers_inserted_rows_in_the_statement():
+    writer = _writer(use_merge=True, assign_keys=True, lock_rows=False)
+    writer.insert([{'name': 'a'}])
+    _, _, _, apply, _ = writer.set_based_statements()
+    assert "WHEN NOT MATCHED" not in apply[0]
+    assert apply[1] == ("INSERT INTO [dbo].[product] ([id], [name]) SELECT (SELECT ISNULL(MAX([id]), 0) FROM [dbo].[product]) "
+                        "+ ROW_NUMBER() OVER (ORDER BY (SELECT NULL)), s.[name] FROM #editor_changes AS s WHERE s.[__op] = 'I'")
+
+
+def test_assign_keys_without_locks_claims_the_keys_first(recording_cursor):
+    writer = _writer(use_merge=False, assign_keys=True, lock_rows=False)
+    writer.insert([{'name': 'a'}])
+    writer.load_parquet('https://onelake/staged.parquet', ['name'], 5000)
+    stats = writer.commit()
+    # the claim conflicts with any other transaction inserting into the table, before any key is read
+    assert recording_cursor.statements[0] == ("UPDATE [dbo].[product] SET [id] = [id] "
+                                              "WHERE [id] = (SELECT MAX([id]) FROM [dbo].[product])")
+    assert recording_cursor.statements[-1].startswith("INSERT INTO [dbo].[product] ([id], [name]) SELECT (SELECT ISNULL(MAX([id]), 0)")
+    assert (stats['mode'], stats['inserted'], stats['loaded']) == ('set', 5001, 5000)
+
+
+def test_assign_keys_with_locks_reads_the_highest_key_locked(recording_cursor):
+    writer = _writer(use_merge=False, assign_keys=True)
+    writer.insert([{'name': 'a'}])
+    writer.commit()
+    assert not any(sql.startswith("UPDATE [dbo].[product] SET [id] = [id]") for sql in recording_cursor.statements)
+    assert "FROM [dbo].[product] WITH (UPDLOCK, HOLDLOCK)" in recording_cursor.statements[-2]
+
+
+def test_optimistic_writer_stages_versions_and_checks_them():
+    writer = _writer(hash_columns=['name', 'category'], lock_rows=False)
+    writer.update(1, {'name': 'n'}, version=b'v1')
+    create, _, params, _, _ = writer.set_based_statements()
+    assert create.endswith("[__row_version] VARBINARY(32) NULL)")
+    assert params[0][-1] == b'v1'
+    select, delete = writer.conflict_statements()
+    assert row_hash_sql(['name', 'category'], 't', SQL_TYPES) in select
+    assert "UPDLOCK" not in select and delete.startswith("DELETE s FROM #editor_changes AS s LEFT JOIN [dbo].[product] AS t")
+
+
+def test_large_optimistic_commit_removes_conflicts_from_the_staging_table(recording_cursor):
+    writer = _writer(hash_columns=['name'], set_based_threshold=2)
+    writer.update(1, {'name': 'n'}, version=b'v1')
+    writer.update(2, {'name': 'm'}, version=b'v2')
+    recording_cursor.fetchall = lambda: [(2, 'U', 0)]
+    stats = writer.commit()
+    assert stats['mode'] == 'set'
+    assert stats['conflicts'] == [{'key': 2, 'operation': 'update', 'reason': 'changed by someone else'}]
+    assert stats['updated'] == 1
+    assert any(sql.startswith("DELETE s FROM #editor_changes") for sql in recording_cursor.statements)
+
+
+def test_row_hash_sql_converts_dates_with_style_126():
+    assert row_hash_sql(['d'], sql_types={'d': 'DATETIME2(3)'}) == \
+        "HASHBYTES('SHA2_256', ISNULL(CONVERT(nvarchar(max), [d], 126), N'<null>'))"
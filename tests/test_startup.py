@@ -0,0 +1,39 @@
+import sys
+import threading
+import time
+import types
+
+from shared import startup
+from shared.query_executor import run_with_timeout
+
+
+def _page(title, run):
+    return types.SimpleNamespace(title=title, run=run)
+
+
+def test_first_run_separates_waiting_from_the_script():
+    def run():
+        run_with_timeout(lambda job: threading.Event().wait(0.3), timeout=5)
+        time.sleep(0.1)
+
+    startup.run_page(_page('waits', run))
+    startup.run_page(_page('waits', lambda: None))
+    page = next(p for p in startup.startup_report()[0] if p['page'] == 'waits')
+    assert 0.3 <= page['waiting'] < page['first_run']
+    assert 0.1 <= page['script'] < page['waiting']
+    assert page['runs'] == 2
+
+
+def test_waiting_outside_of_a_page_run_is_not_booked():
+    with startup.waiting():
+        time.sleep(0.01)
+    assert getattr(startup._local, 'waiting', None) is None
+
+
+def test_first_run_lists_the_packages_it_loaded(monkeypatch):
+    def run():
+        monkeypatch.setitem(sys.modules, 'fake_heavy_package', types.ModuleType('fake_heavy_package'))
+
+    startup.run_page(_page('loads', run))
+    page = next(p for p in startup.startup_report()[0] if p['page'] == 'loads')
+    assert 'fake_heavy_package' in page['modules']
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from shared import write_behind
+from shared.connections import get_engine
+from shared.sql_writer import BatchWriter
+
+SQL_TYPES = {'id': 'INT', 'name': 'VARCHAR(100)', 'category': 'VARCHAR(100)'}
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    engine = get_engine('local', str(tmp_path / 'behind.db'), 'tester', url=f"sqlite:///{tmp_path / 'behind.db'}", poolclass=QueuePool)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE product (id INTEGER PRIMARY KEY, name TEXT, category TEXT)")
+        conn.exec_driver_sql("INSERT INTO product (id, name, category) VALUES (1, 'a', 'x'), (2, 'b', 'y')")
+    return engine
+
+
+def _writer(engine):
+    return BatchWriter(engine, 'main', 'product', sql_types=SQL_TYPES)
+
+
+def _rows(engine):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT id, name FROM product ORDER BY id").fetchall()
+
+
+def test_submissions_of_a_window_are_one_group_commit(sqlite_engine):
+    first, second = _writer(sqlite_engine), _writer(sqlite_engine)
+    first.update(1, {'name': 'a2'})
+    second.insert([{'id': 3, 'name': 'c', 'category': 'z'}])
+    submissions = [write_behind.submit(first), write_behind.submit(second)]
+    assert all(submission.wait(5) for submission in submissions)
+    assert [submission.status for submission in submissions] == ['committed', 'committed']
+    assert submissions[0].stats['mode'].endswith('group commit of 2 submissions')
+    assert (submissions[0].stats['updated'], submissions[1].stats['inserted']) == (1, 1)
+    assert _rows(sqlite_engine) == [(1, 'a2'), (2, 'b'), (3, 'c')]
+
+
+class HangingWriter:
+    # a merged writer whose statement hangs until its cursor is cancelled, like a commit blocked on a lock
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def commit(self, on_cursor=None):
+        on_cursor(self)
+        self.cancelled.wait(10)
+        raise RuntimeError('Operation canceled')
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def test_hanging_commit_fails_its_submissions_without_a_retry(sqlite_engine, monkeypatch):
+    monkeypatch.setattr(write_behind, 'COMMIT_TIMEOUT', 0.2)
+    hanging = HangingWriter()
+    merged = []
+    monkeypatch.setattr(write_behind, '_merged_writer', lambda batch: merged.append(batch) or hanging)
+    writer = _writer(sqlite_engine)
+    writer.update(2, {'name': 'b2'})
+    submission = write_behind.submit(writer)
+    assert submission.wait(5)
+    assert submission.status == 'failed' and isinstance(submission.error, TimeoutError)
+    assert hanging.cancelled.is_set() and len(merged) == 1
+
+    # the table's queue keeps committing the next submissions
+    monkeypatch.undo()
+    writer = _writer(sqlite_engine)
+    writer.update(2, {'name': 'b3'})
+    submission = write_behind.submit(writer)
+    assert submission.wait(5) and submission.status == 'committed'
+    assert _rows(sqlite_engine) == [(1, 'a'), (2, 'b3')]